@@ -0,0 +1,129 @@
+import asyncio
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from fastapi import Request, status
+from fastapi.exceptions import HTTPException
+
+from db.utils.metrics import admission_rejections, admission_in_use, admission_queued
+
+# Admission control of the CPU heavy routes (bcrypt, upload writes): each group of routes runs at most
+# `limit` requests at once, `queue` more wait up to ADMISSION_QUEUE_TIMEOUT seconds for a slot, the
+# others are rejected at once with 503 + Retry-After instead of piling up on the workers and starving
+# the cheap reads. Per group: ADMISSION_<NAME>_LIMIT / ADMISSION_<NAME>_QUEUE, a limit of 0 disables it.
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", 5))
+ADMISSION_RETRY_AFTER = int(os.environ.get("ADMISSION_RETRY_AFTER", 1))
+# Logins per second and burst allowed to one client address, 0 disables the throttling
+LOGIN_RATE = float(os.environ.get("LOGIN_RATE", 1))
+LOGIN_BURST = int(os.environ.get("LOGIN_BURST", 10))
+# Client addresses tracked by the login buckets, the least recently seen are dropped first
+LOGIN_RATE_CLIENTS = int(os.environ.get("LOGIN_RATE_CLIENTS", 100_000))
+
+
+def _rejected(reason: str, retry_after: float) -> HTTPException:
+    code = status.HTTP_429_TOO_MANY_REQUESTS if reason == "rate_limited" else status.HTTP_503_SERVICE_UNAVAILABLE
+    return HTTPException(status_code=code, detail="Too many requests, retry later",
+                         headers={"Retry-After": str(max(1, math.ceil(retry_after)))})
+
+
+class ConcurrencyLimiter:
+    """async with limiter: ... runs the block when a slot is free, waits in a bounded queue otherwise"""
+
+    def __init__(self, name: str, limit: int, queue: int, timeout: float = ADMISSION_QUEUE_TIMEOUT,
+                 retry_after: int = ADMISSION_RETRY_AFTER):
+        self.name = name
+        self.limit = limit
+        self.queue = queue
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.waiting = 0
+        self._loop = None
+        self._semaphore: asyncio.Semaphore | None = None
+
+    @classmethod
+    def from_env(cls, name: str, limit: int, queue: int) -> "ConcurrencyLimiter":
+        prefix = f"ADMISSION_{name.upper()}"
+        return cls(name, int(os.environ.get(f"{prefix}_LIMIT", limit)), int(os.environ.get(f"{prefix}_QUEUE", queue)))
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._semaphore = loop, asyncio.Semaphore(self.limit)
+        return self._semaphore
+
+    def _reject(self, reason: str):
+        admission_rejections.inc(self.name, reason)
+        raise _rejected(reason, self.retry_after)
+
+    async def __aenter__(self):
+        if self.limit <= 0:
+            return self
+        semaphore = self._get_semaphore()
+        if semaphore.locked():
+            if self.waiting >= self.queue:
+                self._reject("queue_full")
+            self.waiting += 1
+            admission_queued.inc(self.name)
+            try:
+                await asyncio.wait_for(semaphore.acquire(), self.timeout)
+            except asyncio.TimeoutError:
+                self._reject("queue_timeout")
+            finally:
+                self.waiting -= 1
+                admission_queued.dec(self.name)
+        else:
+            await semaphore.acquire()
+        admission_in_use.inc(self.name)
+        return self
+
+    async def __aexit__(self, *exc_info):
+        if self.limit > 0:
+            admission_in_use.dec(self.name)
+            self._semaphore.release()
+
+
+class TokenBucketLimiter:
+    """Per client token buckets: `rate` tokens per second up to `burst`, a request takes one"""
+
+    def __init__(self, name: str, rate: float, burst: int, max_clients: int = LOGIN_RATE_CLIENTS):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        self.max_clients = max_clients
+        self._buckets: OrderedDict[str, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, client: str) -> float:
+        """0 when the request may go, otherwise the seconds until the client gets a token back"""
+        if self.rate <= 0:
+            return 0.0
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0.0 if tokens >= 1 else (1 - tokens) / self.rate
+            self._buckets[client] = (tokens - 1 if not wait else tokens, now)
+            while len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+    async def __call__(self, request: Request):
+        """FastAPI dependency"""
+        wait = self.take(request.client.host if request.client else "unknown")
+        if wait:
+            admission_rejections.inc(self.name, "rate_limited")
+            raise _rejected("rate_limited", wait)
+
+
+login_limiter = ConcurrencyLimiter.from_env("login", limit=16, queue=64)
+user_write_limiter = ConcurrencyLimiter.from_env("user_write", limit=8, queue=32)
+import_limiter = ConcurrencyLimiter.from_env("import", limit=2, queue=4)
+upload_limiter = ConcurrencyLimiter.from_env("upload", limit=16, queue=64)
+login_rate_limit = TokenBucketLimiter("login", LOGIN_RATE, LOGIN_BURST)
@@ -0,0 +1,63 @@
+import calendar
+import hashlib
+import time
+from dataclasses import dataclass
+from datetime import datetime
+from email.utils import formatdate, parsedate
+
+from fastapi.responses import Response
+from sqlalchemy.engine import Row
+from starlette.datastructures import Headers
+
+from api.serialization import VARY
+
+# Conditional GET of the JSON / MessagePack read endpoints. The route first reads the version of what it would
+# answer (the *_version queries of db/crud.py: ids, counts and latest change, from the indexes) and answers 304
+# from it alone when the client copy is current: no ORM object is loaded, nothing is serialized.
+# The version is read before the data: when they change in between, the body is newer than its ETag and the
+# client fetches it again on its next request, it never keeps a stale copy.
+# The ETag is weak, the JSON and MessagePack bodies, compressed or not, share it.
+
+# The clients revalidate on every use instead of guessing a freshness from Last-Modified
+CONDITIONAL_CACHE_CONTROL = "no-cache"
+
+
+@dataclass(frozen=True)
+class Version:
+    etag: str
+    changed_at: float | None  # epoch seconds of the latest change, None for an empty response
+
+    @classmethod
+    def from_row(cls, row: Row) -> "Version":
+        digest = hashlib.blake2b(repr(tuple(row)).encode(), digest_size=16).hexdigest()
+        # the timestamps of the rows are naive local times
+        changed_at = datetime.fromisoformat(row.changed_at).timestamp() if row.changed_at else None
+        return cls(f'W/"{digest}"', changed_at)
+
+    @property
+    def last_modified(self) -> int | None:
+        """Last-Modified has a 1 second resolution: it is only given once the second of the change is over,
+        a later change then always falls in a later second and If-Modified-Since can not miss it"""
+        if self.changed_at is None or int(self.changed_at) >= int(time.time()):
+            return None
+        return int(self.changed_at)
+
+    @property
+    def headers(self) -> dict:
+        headers = {"etag": self.etag, "cache-control": CONDITIONAL_CACHE_CONTROL}
+        if self.last_modified is not None:
+            headers["last-modified"] = formatdate(self.last_modified, usegmt=True)
+        return headers
+
+    def is_current(self, request_headers: Headers) -> bool:
+        """The client copy is current. If-Modified-Since only counts without If-None-Match"""
+        if "if-none-match" in request_headers:
+            tags = [tag.strip().removeprefix("W/") for tag in request_headers["if-none-match"].split(",")]
+            return self.etag.removeprefix("W/") in tags or "*" in tags
+        if_modified_since = parsedate(request_headers.get("if-modified-since", ""))
+        return if_modified_since is not None and self.last_modified is not None \
+            and calendar.timegm(if_modified_since) >= self.last_modified
+
+
+def not_modified_response(version: Version) -> Response:
+    return Response(status_code=304, headers={**version.headers, "vary": VARY})
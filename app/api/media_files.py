@@ -0,0 +1,133 @@
+import os
+import stat
+from email.utils import formatdate, parsedate
+from mimetypes import guess_type
+
+import anyio
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.staticfiles import StaticFiles
+from starlette.types import Scope, Receive, Send
+
+# With a reverse proxy in front, the file transfer can be handed over to it:
+# MEDIA_OFFLOAD=x-accel-redirect (nginx, internal location MEDIA_OFFLOAD_PREFIX) or x-sendfile (apache, lighttpd)
+MEDIA_OFFLOAD = os.environ.get("MEDIA_OFFLOAD", "").lower()
+MEDIA_OFFLOAD_PREFIX = os.environ.get("MEDIA_OFFLOAD_PREFIX", "/protected/media_user/")
+# Media files are never rewritten: a new content gets a new name
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+
+def parse_range(range_header: str, size: int) -> tuple[int, int] | None:
+    """(first, last) byte of a single `bytes=` range, None when the header has to be ignored.
+    Raises ValueError for a range outside of the file."""
+    unit, _, ranges = range_header.partition("=")
+    if unit.strip().lower() != "bytes" or "," in ranges:  # multiple ranges are answered with the whole file
+        return None
+    first, _, last = ranges.strip().partition("-")
+    if not (first or last) or not (first or "0").isdigit() or not (last or "0").isdigit():
+        return None
+    if not first:  # suffix range: the last N bytes
+        if int(last) == 0:
+            raise ValueError("Empty suffix range")
+        return max(size - int(last), 0), size - 1
+    if last and int(last) < int(first):  # invalid, not unsatisfiable: RFC 9110 ignores the header
+        return None
+    first, last = int(first), min(int(last) if last else size - 1, size - 1)
+    if first >= size:
+        raise ValueError("Range not satisfiable")
+    return first, last
+
+
+def if_range_matches(if_range: str, etag: str, last_modified: str) -> bool:
+    """If-Range holds an entity tag, compared strongly, or the HTTP date of the Last-Modified sent before"""
+    if_range = if_range.strip()
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    if_range_date = parsedate(if_range)
+    return if_range_date is not None and if_range_date == parsedate(last_modified)
+
+
+class MediaFileResponse(Response):
+    """FileResponse for immutable media: strong ETag, long lived cache headers, 304 answers,
+    single byte ranges, zero-copy send when the server supports it, or transfer offload to the proxy."""
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: str, stat_result: os.stat_result, request_headers: Headers, method: str = "GET",
+                 offload: str = MEDIA_OFFLOAD, offload_uri: str | None = None):
+        self.path = path
+        self.background = None
+        self.send_header_only = method.upper() == "HEAD"
+        self.offset, self.count = 0, stat_result.st_size
+        self.status_code = 200
+        self.media_type = guess_type(path)[0] or "application/octet-stream"
+        self.init_headers()
+        etag = f'"{os.path.basename(path)}"'
+        last_modified = formatdate(stat_result.st_mtime, usegmt=True)
+        self.headers.update({"etag": etag, "cache-control": IMMUTABLE_CACHE_CONTROL, "accept-ranges": "bytes",
+                             "last-modified": last_modified})
+
+        if self.is_not_modified(request_headers, etag, stat_result.st_mtime):
+            self.status_code, self.count = 304, 0
+            del self.headers["content-type"]
+        elif offload in ("x-accel-redirect", "x-sendfile"):
+            uri = offload_uri or MEDIA_OFFLOAD_PREFIX + os.path.basename(path)
+            self.headers[offload] = uri if offload == "x-accel-redirect" else os.path.abspath(path)
+            self.count = 0  # the proxy sends the file, ranges included
+        elif "range" in request_headers and if_range_matches(request_headers.get("if-range", etag), etag,
+                                                             last_modified):
+            try:
+                byte_range = parse_range(request_headers["range"], stat_result.st_size)
+            except ValueError:
+                self.status_code, self.count = 416, 0
+                self.headers["content-range"] = f"bytes */{stat_result.st_size}"
+            else:
+                if byte_range is not None:
+                    self.status_code = 206
+                    self.offset, self.count = byte_range[0], byte_range[1] - byte_range[0] + 1
+                    self.headers["content-range"] = f"bytes {byte_range[0]}-{byte_range[1]}/{stat_result.st_size}"
+        if self.status_code == 304:
+            del self.headers["content-length"]
+        else:
+            self.headers["content-length"] = str(self.count)
+
+    @staticmethod
+    def is_not_modified(request_headers: Headers, etag: str, mtime: float) -> bool:
+        if "if-none-match" in request_headers:
+            tags = [tag.strip().removeprefix("W/") for tag in request_headers["if-none-match"].split(",")]
+            return etag in tags or "*" in tags
+        if_modified_since = parsedate(request_headers.get("if-modified-since", ""))
+        return if_modified_since is not None and if_modified_since >= parsedate(formatdate(mtime, usegmt=True))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only or not self.count:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif "http.response.zerocopysend" in scope.get("extensions", {}):
+            # opened off the event loop, like the streamed path; the server sends from the descriptor
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await send({"type": "http.response.zerocopysend", "file": file.wrapped,
+                            "offset": self.offset, "count": self.count, "more_body": False})
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(self.offset)
+                remaining = self.count
+                while remaining:
+                    chunk = await file.read(min(self.chunk_size, remaining))
+                    remaining = remaining - len(chunk) if chunk else 0
+                    await send({"type": "http.response.body", "body": chunk, "more_body": bool(remaining)})
+
+
+class MediaFiles(StaticFiles):
+    """StaticFiles for static/media_user answering with MediaFileResponse"""
+
+    def __init__(self, *, offload: str = MEDIA_OFFLOAD, offload_prefix: str = MEDIA_OFFLOAD_PREFIX, **kwargs):
+        super().__init__(**kwargs)
+        self.offload = offload
+        self.offload_prefix = offload_prefix
+
+    def file_response(self, full_path, stat_result: os.stat_result, scope: Scope, status_code: int = 200) -> Response:
+        if status_code != 200 or not stat.S_ISREG(stat_result.st_mode):
+            return super().file_response(full_path, stat_result, scope, status_code)
+        relative_path = os.path.relpath(full_path, os.path.realpath(self.directory))
+        return MediaFileResponse(str(full_path), stat_result, Headers(scope=scope), scope["method"],
+                                 offload=self.offload, offload_uri=self.offload_prefix + relative_path)
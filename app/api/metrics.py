@@ -0,0 +1,115 @@
+import logging
+import os
+import time
+from uuid import uuid4
+
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+from starlette.routing import Mount
+from starlette.types import ASGIApp, Receive, Scope, Send, Message
+
+from db.cache import token_cache
+from db.utils.metrics import (registry, current_request, RequestStats, http_requests, http_request_duration,
+                              http_requests_in_flight, db_queries_per_request)
+
+# One structured log line per request (request_id, route, status, duration_ms, db_queries, db_time_ms)
+METRICS_LOG_REQUESTS = os.environ.get("METRICS_LOG_REQUESTS", "false").lower() in ("1", "true", "yes")
+REQUEST_ID_HEADER = "x-request-id"
+
+logger = logging.getLogger("api.requests")
+
+api_router = APIRouter()
+
+
+@api_router.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics():
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4")
+
+
+def _token_cache_metrics() -> list[str]:
+    stats = token_cache.stats()
+    return [
+        "# HELP token_cache_entries Bearer tokens in the verified token cache",
+        "# TYPE token_cache_entries gauge",
+        f"token_cache_entries {stats['size']}",
+        "# HELP token_cache_lookups_total Token cache lookups by result",
+        "# TYPE token_cache_lookups_total counter",
+        f'token_cache_lookups_total{{result="hit"}} {stats["hits"]}',
+        f'token_cache_lookups_total{{result="miss"}} {stats["misses"]}',
+        "# HELP token_cache_invalidations_total Token cache entries dropped because their user changed",
+        "# TYPE token_cache_invalidations_total counter",
+        f"token_cache_invalidations_total {stats['invalidations']}",
+    ]
+
+
+registry.add_collector(_token_cache_metrics)
+
+
+def _route_templates(routes, prefix: str = "") -> dict:
+    """endpoint -> path template, the route label: one series per route instead of one per URL"""
+    templates = {}
+    for route in routes:
+        if isinstance(route, Mount):
+            templates.setdefault(route.app, prefix + route.path + "/{path}")
+            templates.update({endpoint: template for endpoint, template
+                              in _route_templates(route.routes or [], prefix + route.path).items()
+                              if endpoint not in templates})
+        elif hasattr(route, "endpoint"):
+            templates.setdefault(route.endpoint, prefix + route.path)
+    return templates
+
+
+class MetricsMiddleware:
+    """Times every HTTP request and counts the SQL statements it runs (see db.utils.metrics).
+
+    The request id comes from the X-Request-ID header or is generated, and is sent back in the response.
+    """
+
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._templates: dict | None = None
+
+    def route_label(self, scope: Scope) -> str:
+        endpoint = scope.get("endpoint")
+        if endpoint is None:
+            return "unmatched"
+        if self._templates is None or endpoint not in self._templates:
+            self._templates = _route_templates(scope["app"].routes)
+        return self._templates.get(endpoint, "unmatched")
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        request_id = next((value.decode("latin-1") for name, value in scope["headers"]
+                           if name == REQUEST_ID_HEADER.encode()), None) or uuid4().hex
+        stats = RequestStats(request_id)
+        token = current_request.set(stats)
+        status_code = 500
+
+        async def send_wrapper(message: Message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                message["headers"] = [*message.get("headers", []),
+                                      (REQUEST_ID_HEADER.encode(), request_id.encode("latin-1"))]
+            await send(message)
+
+        http_requests_in_flight.inc()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            duration = time.perf_counter() - start
+            http_requests_in_flight.dec()
+            current_request.reset(token)
+            method, route = scope["method"], self.route_label(scope)
+            http_requests.inc(method, route, str(status_code))
+            http_request_duration.observe(duration, method, route)
+            db_queries_per_request.observe(stats.db_queries, route)
+            if METRICS_LOG_REQUESTS:
+                logger.info("%s %s %s", method, route, status_code, extra={
+                    "request_id": request_id, "route": route, "status": status_code,
+                    "duration_ms": round(duration * 1000, 3), "db_queries": stats.db_queries,
+                    "db_time_ms": round(stats.db_seconds * 1000, 3)})
@@ -1,32 +1,202 @@
+import os
 from typing import List
-from fastapi import APIRouter, Depends, status, File, UploadFile
+from fastapi import APIRouter, Depends, Query, status, Request, Response, BackgroundTasks
 from fastapi.exceptions import HTTPException
 
-from models.models import MediaUserResponse, MediaUserCreate
-from db.database import get_session
-from db.utils.utils import save_file
-import db.crud as db
+from models.models import MediaUserResponse, MediaUserCreate, MediaUserPage, UploadSessionCreate, \
+    UploadSessionResponse
+from db.database import get_async_session, get_async_read_session, get_async_session_factory
+from db.utils.utils import save_file, check_extension, UPLOAD_OPENAPI, MAX_MEDIA_SIZE
+from db.utils.uploads import create_upload_file, upload_status, append_chunks, finalize_upload, forget_upload, \
+    upload_path, UPLOAD_CHUNK_OPENAPI
+from db.utils.pagination import decode_cursor, make_page, PAGE_MAX_LIMIT
+from db.utils.derivatives import derivative_pipeline, NOT_RESIZABLE
+from db.utils.export import ExportFormat, export_response
+import db.async_crud as db
+from api.media_files import MediaFileResponse
+from api.serialization import serialized_response, media_user_payload
+from api.admission import upload_limiter
+from api.conditional import Version, not_modified_response
 
 api_router = APIRouter()
 
 
-@api_router.get("/{user_id}", response_model=List[MediaUserResponse])
-def get_media_user(user_id: int, session=Depends(get_session)):
-    return db.get_medias_user_by_user_id(session, user_id)
+async def produce_derivatives(session_factory, media_path: str):
+    # runs after the response is sent, the resizing itself happens in the pipeline processes.
+    # A connection is only taken for the update, not while the resizing runs or waits for the pool
+    derivatives = await derivative_pipeline.process(media_path)
+    async with session_factory() as session:
+        await db.set_media_derivatives(session, media_path, derivatives)
+
+
+async def schedule_derivatives(background_tasks: BackgroundTasks, session, session_factory, media_path: str):
+    # the request session is closed after the background tasks: release its connection now
+    await session.close()
+    background_tasks.add_task(produce_derivatives, session_factory, media_path)
+
+
+@api_router.get("/export")
+async def export_medias(format: ExportFormat = ExportFormat.ndjson, user_id: int | None = None,
+                        session=Depends(get_async_read_session)):
+    """Every media, or the media of user_id, as NDJSON or CSV streamed from a server-side cursor"""
+    return export_response(db.export_medias(session, format, user_id), format, "media_user")
+
+
+@api_router.get("/{user_id}", response_model=List[MediaUserResponse] | MediaUserPage)
+async def get_media_user(user_id: int, request: Request, session=Depends(get_async_read_session),
+                         limit: int = Query(100, ge=1, le=PAGE_MAX_LIMIT), offset: int = Query(0, ge=0),
+                         cursor: str | None = None):
+    """Same pagination modes, encodings and conditional requests as GET /api/v1/users/"""
+    after_id = None if cursor is None else decode_cursor(cursor)
+    version = Version.from_row(await db.get_medias_version(session, user_id, limit, offset, after_id))
+    if version.is_current(request.headers):
+        return not_modified_response(version)
+    medias = await db.get_media_rows_by_user_id(session, user_id, limit, offset, after_id)
+    items = [media_user_payload(media) for media in medias]
+    if cursor is None:
+        return serialized_response(request, items, headers=version.headers)
+    return serialized_response(request, {**make_page(medias, limit), "items": items}, headers=version.headers)
+
+
+def media_file_response(file_path: str, request: Request) -> MediaFileResponse:
+    try:
+        stat_result = os.stat(file_path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Media file not found")
+    return MediaFileResponse(file_path, stat_result, request.headers, request.method)
+
+
+@api_router.get("/{media_id}/file")
+async def get_media_file(media_id: int, request: Request, size: str = "original",
+                         session=Depends(get_async_read_session)):
+    """The media file itself, or one of its resized derivatives (size=thumbnail, medium, ...).
+    A derivative that is not produced yet is made on demand and kept for the next requests."""
+    db_media_user = await db.get_media_user_by_media_id(session, media_id)
+    if not db_media_user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Incorrect media_id")
+    if size == "original":
+        return media_file_response(db_media_user.media_path, request)
+    if size not in derivative_pipeline.sizes:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Unknown size. Support original, {', '.join(derivative_pipeline.sizes)}")
+    try:
+        file_path = await derivative_pipeline.get(db_media_user.media_path, size)
+    except NOT_RESIZABLE:
+        file_path = db_media_user.media_path
+    return media_file_response(file_path, request)
 
 
 @api_router.delete("/{media_id}", status_code=status.HTTP_202_ACCEPTED)
-def delete_media_user(media_id: int, session=Depends(get_session)):
-    return db.delete_media_user(session, media_id)
+async def delete_media_user(media_id: int, session=Depends(get_async_session)):
+    return await db.delete_media_user(session, media_id)
+
+
+@api_router.post("/{user_id}", response_model=MediaUserResponse, openapi_extra=UPLOAD_OPENAPI)
+async def create_file(user_id: int, request: Request, background_tasks: BackgroundTasks,
+                      session=Depends(get_async_session), session_factory=Depends(get_async_session_factory)):
+    """Multipart upload of `in_file`, the body is streamed to disk instead of being parsed up front"""
+    user_db = await db.get_user_by_id(session, user_id)
+    if not user_db:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Incorrect user_id")
+    await session.close()  # no connection held while waiting for a slot or while the body arrives
+    async with upload_limiter:
+        saved_file = await save_file(request, "static/media_user/")
+    media_user_create = MediaUserCreate(user_id=user_id, media_path=saved_file.path, sha256=saved_file.sha256)
+    db_media_user = await db.add_media_user(session, media_user_create, saved_file.size)
+    await schedule_derivatives(background_tasks, session, session_factory, db_media_user.media_path)
+    return db_media_user
 
 
-@api_router.post("/{user_id}", response_model=MediaUserResponse)
-def create_file(user_id: int, in_file: UploadFile = File(...), session=Depends(get_session)):
-    user_db = db.get_user_by_id(session, user_id)
+@api_router.post("/{user_id}/by_hash/{sha256}", response_model=MediaUserResponse)
+async def create_file_by_hash(user_id: int, sha256: str, background_tasks: BackgroundTasks,
+                              session=Depends(get_async_session),
+                              session_factory=Depends(get_async_session_factory)):
+    """Adds an already stored media without sending it again. 404 means the content is unknown:
+    upload it with POST /{user_id}"""
+    user_db = await db.get_user_by_id(session, user_id)
     if not user_db:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect user_id")
-    file_path = save_file(in_file, "static/media_user/")
-    media_user_create = MediaUserCreate(user_id=user_id, media_path=file_path)
-    db_media_user = db.add_media_user(session, media_user_create)
+    db_blob = await db.get_media_blob(session, sha256.lower())
+    if not db_blob:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Unknown media hash")
+    media_user_create = MediaUserCreate(user_id=user_id, media_path=db_blob.path, sha256=db_blob.sha256)
+    db_media_user = await db.add_media_user(session, media_user_create, db_blob.size)
+    await schedule_derivatives(background_tasks, session, session_factory, db_media_user.media_path)
     return db_media_user
+
+
+# Resumable uploads, see db/utils/uploads.py. The upload routes use the primary: an upload is read right
+# after it was created or written.
+async def get_upload(session, upload_id: str):
+    db_upload = await db.get_upload_session(session, upload_id)
+    if not db_upload:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Unknown upload")
+    return db_upload
+
+
+@api_router.post("/{user_id}/uploads", response_model=UploadSessionResponse, status_code=status.HTTP_201_CREATED)
+async def create_upload(user_id: int, upload_create: UploadSessionCreate, session=Depends(get_async_session)):
+    """Starts a resumable upload of `size` bytes: PUT the bytes to /uploads/{id} in one or more chunks,
+    then POST /uploads/{id}/finalize. An upload without a new chunk until expires_at is dropped."""
+    user_db = await db.get_user_by_id(session, user_id)
+    if not user_db:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Incorrect user_id")
+    ext = check_extension(upload_create.filename)
+    if upload_create.size > MAX_MEDIA_SIZE:
+        raise HTTPException(status_code=status.HTTP_411_LENGTH_REQUIRED,
+                            detail=f"Media is too large, {MAX_MEDIA_SIZE / 1024 / 1024:g}MB max.")
+    if upload_create.size <= 0:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="Media is empty")
+    db_upload = await db.create_upload_session(session, user_id, ext, upload_create.size)
+    await create_upload_file(db_upload.id)
+    return upload_status(db_upload)
+
+
+@api_router.get("/uploads/{upload_id}", response_model=UploadSessionResponse)
+async def get_upload_status(upload_id: str, session=Depends(get_async_session)):
+    """`offset`: the bytes received, where the next chunk starts"""
+    return upload_status(await get_upload(session, upload_id))
+
+
+@api_router.put("/uploads/{upload_id}", response_model=UploadSessionResponse, openapi_extra=UPLOAD_CHUNK_OPENAPI)
+async def put_upload_chunk(upload_id: str, request: Request, offset: int = 0, session=Depends(get_async_session)):
+    """Raw bytes of the media from `offset`, which must be the offset of the upload: 409 with the current one
+    in Upload-Offset otherwise. A chunk cut short keeps the bytes received, resume from the offset."""
+    db_upload = await get_upload(session, upload_id)
+    await session.close()  # no connection held while the body arrives
+    async with upload_limiter:
+        await append_chunks(db_upload, offset, request.stream())
+    return upload_status(db_upload)
+
+
+@api_router.post("/uploads/{upload_id}/finalize", response_model=MediaUserResponse)
+async def finalize_media_upload(upload_id: str, background_tasks: BackgroundTasks,
+                                session=Depends(get_async_session),
+                                session_factory=Depends(get_async_session_factory)):
+    """Adds the media of a complete upload, 409 while bytes are missing"""
+    db_upload = await get_upload(session, upload_id)
+    saved_file = await finalize_upload(db_upload, "static/media_user/")
+    media_user_create = MediaUserCreate(user_id=db_upload.user_id, media_path=saved_file.path,
+                                        sha256=saved_file.sha256)
+    # the media row and the end of the upload commit together: when the insert fails the upload is kept
+    db_media_user = await db.add_uploaded_media_user(session, media_user_create, saved_file.size, upload_id,
+                                                     upload_path(upload_id))
+    await schedule_derivatives(background_tasks, session, session_factory, db_media_user.media_path)
+    return db_media_user
+
+
+@api_router.delete("/uploads/{upload_id}", status_code=status.HTTP_204_NO_CONTENT)
+async def delete_upload(upload_id: str, session=Depends(get_async_session)):
+    await get_upload(session, upload_id)
+    await db.delete_upload_sessions(session, [upload_id], [upload_path(upload_id)])
+    forget_upload(upload_id)
+    return Response(status_code=status.HTTP_204_NO_CONTENT)
+
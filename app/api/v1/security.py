@@ -1,14 +1,18 @@
 import datetime
 
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Request, status
 from fastapi.exceptions import HTTPException
 
 
-from db.secret import verify_password, generate_token, decode_token
-from db.database import get_session
-import db.crud as db
+from db.secret import generate_token, decode_token
+from db.hashing import password_hasher
+from db.cache import token_cache
+from db.database import get_async_session
+import db.async_crud as db
 from models.models import UserResponse
+from api.serialization import serialized_response, user_payload
+from api.admission import login_limiter, login_rate_limit
 
 api_router = APIRouter()
 
@@ -16,40 +20,51 @@ api_router = APIRouter()
 oauth2_scheme = OAuth2PasswordBearer("/api/v1/security/token")
 
 
-@api_router.post("/token")
-def login(form_data: OAuth2PasswordRequestForm = Depends(), session=Depends(get_session)):
-    db_user = db.get_user_by_email(session, form_data.username)
+@api_router.post("/token", dependencies=[Depends(login_rate_limit)])
+async def login(form_data: OAuth2PasswordRequestForm = Depends(), session=Depends(get_async_session)):
+    db_user = await db.get_user_by_email(session, form_data.username)
     if not db_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect username or password")
-    if not verify_password(form_data.password, db_user.hash_pass):
+    # no connection held while bcrypt runs or waits for it, the session is only taken again for a rehash
+    await session.close()
+    async with login_limiter:
+        is_valid, new_hash = await password_hasher.verify_and_update(form_data.password, db_user.hash_pass)
+    if not is_valid:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect username or password")
+    if new_hash:
+        await db.set_user_hash_pass(session, db_user, new_hash)
     token = generate_token(db_user.email)
     return {"access_token": token, "token_type": "bearer"}
 
 
-def authentication(token: str = Depends(oauth2_scheme), session=Depends(get_session)):
+# on the primary: a cache miss must see the user as of the last write, e.g. just created or just deactivated
+async def authentication(token: str = Depends(oauth2_scheme), session=Depends(get_async_session)):
+    cached = token_cache.get(token)
+    if cached:
+        return cached[1]
     token_data = decode_token(token)
     if not token_data:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"})
-    expiration_date = token_data.get('expiration_date', None)
-    if datetime.datetime.fromisoformat(expiration_date) <= datetime.datetime.utcnow():
+    expiration_date = datetime.datetime.fromisoformat(token_data.get('expiration_date', None))
+    if expiration_date <= datetime.datetime.utcnow():
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Invalid authentication credentials",
             headers={"WWW-Authenticate": "Bearer"})
-    db_user = db.get_user_by_email(session, token_data.get('email', None))
+    db_user = await db.get_user_by_email(session, token_data.get('email', None))
     if not db_user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="User not found")
+    token_cache.set(token, token_data, db_user, expiration_date)
     return db_user
 
 
 @api_router.get("/about_me", response_model=UserResponse)
-def about_me(user=Depends(authentication)):
-    return user
+async def about_me(request: Request, user=Depends(authentication)):
+    return serialized_response(request, user_payload(user))
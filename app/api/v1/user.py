@@ -1,35 +1,95 @@
 from typing import List
-from fastapi import APIRouter, Depends, status
+from fastapi import APIRouter, Depends, Query, Request, status
 
-from models.models import UserResponse, UserCreate, UserUpdate
-from db.database import get_session
-import db.crud as db
+from models.models import UserResponse, UserSummary, UserCreate, UserUpdate, UserPage, UserImportReport
+from db.database import get_async_session, get_async_read_session
+from db.utils.pagination import decode_cursor, make_page, PAGE_MAX_LIMIT
+from db.utils.bulk_import import read_import_rows, IMPORT_BATCH_SIZE, IMPORT_MAX_BATCH_SIZE, IMPORT_OPENAPI
+from db.utils.export import ExportFormat, export_response
+import db.async_crud as db
+from api.serialization import serialized_response, user_payload, user_summary_payload
+from api.admission import user_write_limiter, import_limiter
+from api.conditional import Version, not_modified_response
 
 api_router = APIRouter()
 
+SEARCH_MAX_LENGTH = 200
+SEARCH_MAX_LIMIT = 100
+
 
 @api_router.post("/", response_model=UserResponse)
-def add_user(user_create: UserCreate, session=Depends(get_session)):
-    return db.add_user(session, user_create)
+async def add_user(user_create: UserCreate, session=Depends(get_async_session)):
+    return await db.add_user(session, user_create, admission=user_write_limiter)
+
+
+@api_router.post("/import", response_model=UserImportReport, openapi_extra=IMPORT_OPENAPI)
+async def import_users(request: Request, batch_size: int = Query(IMPORT_BATCH_SIZE, ge=1, le=IMPORT_MAX_BATCH_SIZE),
+                       session=Depends(get_async_session)):
+    """Bulk creation from an application/x-ndjson or text/csv body (login, email, full_name, password).
+    The body is read as a stream and imported batch_size rows at a time, the report lists every row."""
+    async with import_limiter:
+        report = await db.import_users(session, read_import_rows(request), batch_size)
+    # the report has one entry per row, validating it against the response_model would double the work
+    return serialized_response(request, report)
+
+
+@api_router.get("/export")
+async def export_users(format: ExportFormat = ExportFormat.ndjson, session=Depends(get_async_read_session)):
+    """Every user as NDJSON or CSV, streamed from a server-side cursor whatever the table size"""
+    return export_response(db.export_users(session, format), format, "users")
+
+
+@api_router.get("/search", response_model=List[UserSummary])
+async def search_users(request: Request, q: str = Query(..., max_length=SEARCH_MAX_LENGTH),
+                       limit: int = Query(20, ge=1, le=SEARCH_MAX_LIMIT), offset: int = Query(0, ge=0),
+                       fuzzy: bool = False, session=Depends(get_async_read_session)):
+    """Users matching every word of `q` in their login, email or full name, best match first.
+    The words are word prefixes; `fuzzy=true` also finds the words of 3 characters and more inside a word.
+    Paginated by limit / offset, the media are not included."""
+    users = await db.search_users(session, q, limit, offset, fuzzy)
+    return serialized_response(request, [user_summary_payload(user) for user in users])
 
 
 @api_router.get("/{user_id_or_email}", response_model=UserResponse)
-def get_user_by_id_or_email(user_id_or_email: int | str, session=Depends(get_session)):
+async def get_user_by_id_or_email(user_id_or_email: int | str, request: Request,
+                                  session=Depends(get_async_read_session)):
+    """ETag / Last-Modified, answers 304 to If-None-Match / If-Modified-Since without loading the user"""
+    match user_id_or_email:
+        case int(): version = Version.from_row(await db.get_user_version(session, user_id=user_id_or_email))
+        case str(): version = Version.from_row(await db.get_user_version(session, email=user_id_or_email))
+    if version.is_current(request.headers):
+        return not_modified_response(version)
     match user_id_or_email:
-        case int(): return db.get_user_by_id(session, user_id_or_email)
-        case str(): return db.get_user_by_email(session, user_id_or_email)
+        case int(): db_user = await db.get_user_by_id(session, user_id_or_email)
+        case str(): db_user = await db.get_user_by_email(session, user_id_or_email)
+    return serialized_response(request, user_payload(db_user), headers=version.headers)
 
 
-@api_router.get("/", response_model=List[UserResponse])
-def get_users(session=Depends(get_session), limit: int = 100, offset: int = 0):
-    return db.get_user_all(session, limit, offset)
+@api_router.get("/", response_model=List[UserResponse] | UserPage)
+async def get_users(request: Request, session=Depends(get_async_read_session),
+                    limit: int = Query(100, ge=1, le=PAGE_MAX_LIMIT), offset: int = Query(0, ge=0),
+                    cursor: str | None = None, media: bool = True):
+    """Offset pagination by default. Passing `cursor` (empty for the first page) switches to keyset pagination:
+    the response becomes {"items": [...], "next_cursor": ...}, next_cursor is null on the last page.
+    `media=false` leaves the media list out of every user, the media are not loaded at all.
+    JSON by default, MessagePack with `Accept: application/msgpack`, gzipped when large and accepted.
+    Conditional requests as GET /{user_id_or_email}, the page is not loaded for a 304."""
+    after_id = None if cursor is None else decode_cursor(cursor)
+    version = Version.from_row(await db.get_users_version(session, limit, offset, after_id, with_media=media))
+    if version.is_current(request.headers):
+        return not_modified_response(version)
+    users = await db.get_user_rows(session, limit, offset, after_id, with_media=media)
+    items = [user_payload(user) if media else user_summary_payload(user) for user in users]
+    if cursor is None:
+        return serialized_response(request, items, headers=version.headers)
+    return serialized_response(request, {**make_page(users, limit), "items": items}, headers=version.headers)
 
 
 @api_router.put("/", response_model=UserResponse)
-def update_user(user_update: UserUpdate, session=Depends(get_session)):
-    return db.update_user(session, user_update)
+async def update_user(user_update: UserUpdate, session=Depends(get_async_session)):
+    return await db.update_user(session, user_update, admission=user_write_limiter)
 
 
 @api_router.delete("/{user_id}", status_code=status.HTTP_202_ACCEPTED)
-def delete_user_by_id(user_id: int, session=Depends(get_session)):
-    return db.delete_user_by_id(session, user_id)
+async def delete_user_by_id(user_id: int, session=Depends(get_async_session)):
+    return await db.delete_user_by_id(session, user_id)
@@ -0,0 +1,74 @@
+"""Throughput of the sync (threadpool) and async DB paths at high concurrency.
+
+The sync path reproduces what Starlette does for a plain `def` route: every request takes a
+worker from the anyio threadpool (40 threads by default) for its whole DB round trip.
+The async path runs db.async_crud on an AsyncSession in the event loop.
+"""
+import argparse
+import asyncio
+import random
+
+import anyio
+from sqlmodel import Session, create_engine
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine
+
+import db.crud as crud
+import db.async_crud as async_crud
+from benchmarks.common import temp_db_path, seed, timer, report
+
+
+def sync_request(engine, user_id: int):
+    with Session(engine) as session:
+        crud.get_user_by_id(session, user_id)
+
+
+async def run_sync_path(db_path: str, users: int, requests: int, concurrency: int) -> float:
+    engine = create_engine(f"sqlite:///{db_path}", connect_args={"check_same_thread": False})
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            await anyio.to_thread.run_sync(sync_request, engine, random.randint(1, users))
+
+    result = {}
+    with timer(result):
+        await asyncio.gather(*(one() for _ in range(requests)))
+    engine.dispose()
+    return requests / result["seconds"]
+
+
+async def run_async_path(db_path: str, users: int, requests: int, concurrency: int) -> float:
+    engine = create_async_engine(f"sqlite+aiosqlite:///{db_path}")
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            async with AsyncSession(engine, expire_on_commit=False) as session:
+                await async_crud.get_user_by_id(session, random.randint(1, users))
+
+    result = {}
+    with timer(result):
+        await asyncio.gather(*(one() for _ in range(requests)))
+    await engine.dispose()
+    return requests / result["seconds"]
+
+
+async def main(args):
+    db_path = temp_db_path()
+    seed(db_path, args.users, args.media_per_user)
+    rows = []
+    for concurrency in args.concurrency:
+        rows.append({"concurrency": concurrency,
+                     "sync req/s": await run_sync_path(db_path, args.users, args.requests, concurrency),
+                     "async req/s": await run_async_path(db_path, args.users, args.requests, concurrency)})
+    report(f"get_user_by_id, {args.requests} requests, {args.users} users", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--media-per-user", type=int, default=2)
+    parser.add_argument("--requests", type=int, default=5_000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[10, 100, 500])
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,94 @@
+"""Polling the read endpoints: a full GET against a conditional GET answered 304, and the gzip levels.
+
+The full GET runs the version query, loads the page and serializes it; the 304 only runs the version query
+(db/crud.py *_version, api/conditional.py). Requests go through the ASGI app in-process, on a seeded DB.
+The gzip rows show the body size and the latency of the full GET of the lists by compression level.
+"""
+import argparse
+import asyncio
+import time
+
+from fastapi import FastAPI
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import api.serialization as serialization
+from api.v1.media_user import api_router as media_user_route
+from api.v1.user import api_router as user_route
+from db.config import EngineSettings, build_engine, build_async_engine
+from db.database import get_async_session, get_async_read_session
+from db.migrations import upgrade
+from benchmarks.common import asgi_request, temp_db_path, seed, report
+
+
+def build_app(db_path: str) -> tuple[FastAPI, object]:
+    engine = build_async_engine(EngineSettings(url=f"sqlite:///{db_path}", echo=False))
+    app = FastAPI()
+    app.include_router(user_route, prefix='/api/v1/users')
+    app.include_router(media_user_route, prefix='/api/v1/media_user')
+
+    async def override_get_async_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_get_async_session
+    app.dependency_overrides[get_async_read_session] = override_get_async_session
+    return app, engine
+
+
+async def request_ms(app, path: str, query_string: str, headers: dict, repeat: int) -> tuple[float, int, dict]:
+    status, response_headers, body = await asgi_request(app, "GET", path, headers, query_string=query_string)
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await asgi_request(app, "GET", path, headers, query_string=query_string)
+    return (time.perf_counter() - start) / repeat * 1000, len(body), {"status": status, **response_headers}
+
+
+async def run(args, db_path: str) -> tuple[list[dict], list[dict]]:
+    app, engine = build_app(db_path)
+    middle = args.users // 2
+    endpoints = [
+        ("GET /users/{id}", f"/api/v1/users/{middle}", ""),
+        (f"GET /users/ page of {args.limit}", "/api/v1/users/", f"limit={args.limit}&cursor="),
+        (f"GET /users/ page of {args.limit}, media=false", "/api/v1/users/", f"limit={args.limit}&media=false"),
+        (f"GET /media_user/{{id}} ({args.media_per_user} media)", f"/api/v1/media_user/{middle}", ""),
+    ]
+    serialization.RESPONSE_GZIP_MIN_SIZE = 0
+    polling = []
+    for name, path, query_string in endpoints:
+        full_ms, size, headers = await request_ms(app, path, query_string, {}, args.repeat)
+        not_modified_ms, _, not_modified = await request_ms(app, path, query_string,
+                                                            {"if-none-match": headers["etag"]}, args.repeat)
+        assert not_modified["status"] == 304, not_modified
+        polling.append({"endpoint": name, "200 ms": full_ms, "304 ms": not_modified_ms,
+                        "speedup": full_ms / not_modified_ms, "200 bytes": size})
+    compression = []
+    serialization.RESPONSE_GZIP_MIN_SIZE = 1
+    for name, path, query_string in endpoints[1:3]:
+        for level in args.gzip_levels:
+            serialization.RESPONSE_GZIP_LEVEL = level
+            headers = {"accept-encoding": "gzip"} if level else {}
+            ms, size, _ = await request_ms(app, path, query_string, headers, args.repeat)
+            compression.append({"endpoint": name, "gzip level": level or "none", "ms": ms, "bytes": size})
+    await engine.dispose()
+    return polling, compression
+
+
+def main(args):
+    db_path = temp_db_path()
+    seed(db_path, args.users, args.media_per_user)
+    engine = build_engine(EngineSettings(url=f"sqlite:///{db_path}", echo=False))
+    upgrade(engine)
+    engine.dispose()
+    polling, compression = asyncio.run(run(args, db_path))
+    report(f"{args.users} users, mean of {args.repeat} requests", polling)
+    report("full GET by gzip level", compression)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--media-per-user", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--gzip-levels", type=int, nargs="+", default=[0, 1, 6, 9], help="0: not compressed")
+    main(parser.parse_args())
@@ -0,0 +1,58 @@
+"""Throughput of the derivative pipeline on a directory of JPG/PNG files.
+
+Without --dir, --count synthetic photos are generated. Every run starts from a fresh copy of the
+files, so no derivative is reused between runs.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+
+from PIL import Image
+
+from db.utils.derivatives import DerivativePipeline, DERIVATIVE_SIZES
+from db.utils.utils import AVAILABLE_MEDIA_EXTENSIONS
+from benchmarks.common import timer, report
+
+
+def generate_samples(directory: str, count: int, width: int, height: int):
+    for i in range(count):
+        image = Image.effect_mandelbrot((width, height), (-2 + i / count, -1.2, 1, 1.2), 64).convert("RGB")
+        image.save(os.path.join(directory, f"sample_{i}{'.jpg' if i % 2 else '.png'}"))
+
+
+async def run(source: str, workers: int) -> dict:
+    directory = tempfile.mkdtemp(prefix="weimfa_bench_derivatives_")
+    paths = []
+    for name in os.listdir(source):
+        if os.path.splitext(name)[1] in AVAILABLE_MEDIA_EXTENSIONS:
+            paths.append(shutil.copy(os.path.join(source, name), directory))
+    pipeline = DerivativePipeline(workers=workers)
+    pipeline._get_executor().submit(int).result()  # start the worker processes outside of the timing
+    result = {}
+    with timer(result):
+        await asyncio.gather(*(pipeline.process(path) for path in paths))
+    pipeline.shutdown()
+    shutil.rmtree(directory)
+    return {"workers": workers, "images": len(paths), "images/s": len(paths) / result["seconds"],
+            "derivatives/s": len(paths) * len(DERIVATIVE_SIZES) / result["seconds"]}
+
+
+def main(args):
+    source = args.dir
+    if source is None:
+        source = tempfile.mkdtemp(prefix="weimfa_bench_samples_")
+        generate_samples(source, args.count, args.width, args.height)
+    rows = [asyncio.run(run(source, workers)) for workers in args.workers]
+    report(f"sizes {DERIVATIVE_SIZES}", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--dir", help="directory of sample .jpg/.png files")
+    parser.add_argument("--count", type=int, default=40)
+    parser.add_argument("--width", type=int, default=1600)
+    parser.add_argument("--height", type=int, default=1200)
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({1, os.cpu_count() or 1}))
+    main(parser.parse_args())
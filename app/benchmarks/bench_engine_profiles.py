@@ -0,0 +1,72 @@
+"""Read and write throughput of every engine profile from db/config.py.
+
+Each profile runs against its own freshly seeded SQLite file. "baseline" is the engine the app
+used before the profiles existed: no pool, rollback journal, default pragmas.
+"""
+import argparse
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlmodel import Session, create_engine
+
+import db.crud as crud
+from db.config import PROFILES, EngineSettings, build_engine
+from models.models import MediaUser
+from benchmarks.common import temp_db_path, seed, timer, report
+
+
+def run(engine, users: int, operations: int, threads: int, write: bool) -> float:
+    lock = threading.Lock()
+    counter = iter(range(operations))
+
+    def worker():
+        with Session(engine) as session:
+            while True:
+                with lock:
+                    if next(counter, None) is None:
+                        return
+                user_id = random.randint(1, users)
+                if write:
+                    session.add(MediaUser(user_id=user_id, media_path="static/media_user/bench.png"))
+                    session.commit()
+                else:
+                    crud.get_user_by_id(session, user_id)
+
+    result = {}
+    with timer(result):
+        with ThreadPoolExecutor(threads) as pool:
+            for future in [pool.submit(worker) for _ in range(threads)]:
+                future.result()
+    return operations / result["seconds"]
+
+
+def main(args):
+    engines = {"baseline": lambda path: create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})}
+    for name, profile in PROFILES.items():
+        def factory(path, profile=profile):
+            settings = EngineSettings(**{**profile, "url": f"sqlite:///{path}"})
+            if not args.keep_echo:
+                settings.echo = False
+            return build_engine(settings)
+        engines[name] = factory
+
+    rows = []
+    for name, factory in engines.items():
+        db_path = temp_db_path(f"{name}.db")
+        seed(db_path, args.users)
+        engine = factory(db_path)
+        rows.append({"profile": name,
+                     "reads/s": run(engine, args.users, args.operations, args.threads, write=False),
+                     "writes/s": run(engine, args.users, args.operations // 10, args.threads, write=True)})
+        engine.dispose()
+    report(f"{args.threads} threads, {args.operations} reads, {args.operations // 10} writes", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--operations", type=int, default=20_000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--keep-echo", action="store_true", help="keep the profile's SQL echo (logs to stdout)")
+    main(parser.parse_args())
@@ -0,0 +1,89 @@
+"""Exporting the users table: the streaming export endpoints against the list endpoint.
+
+`paging` walks GET /api/v1/users/ with keyset pages of --page-size (what the analytics jobs do today),
+`export-*` stream GET /api/v1/users/export. The list endpoint does not serve the whole table in one page,
+its limit is capped at PAGE_MAX_LIMIT.
+Every mode runs in its own process on the same seeded DB, so the reported peak RSS belongs to that mode only.
+"""
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+
+from fastapi import FastAPI
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from api.v1.user import api_router as user_route
+from db.config import EngineSettings, build_async_engine
+from db.database import get_async_session, get_async_read_session
+from benchmarks.common import asgi_request, temp_db_path, seed, timer, peak_rss_mb, report
+
+MODES = ["paging", "export-ndjson", "export-csv"]
+
+
+def build_app(db_path: str) -> tuple[FastAPI, object]:
+    engine = build_async_engine(EngineSettings(url=f"sqlite:///{db_path}", echo=False))
+    app = FastAPI()
+    app.include_router(user_route, prefix='/api/v1/users')
+
+    async def override_get_async_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_get_async_session
+    app.dependency_overrides[get_async_read_session] = override_get_async_session
+    return app, engine
+
+
+async def run_mode(mode: str, db_path: str, rows: int, page_size: int) -> dict:
+    app, engine = build_app(db_path)
+    received = {"bytes": 0, "newlines": 0}
+
+    def on_body(chunk: bytes):
+        received["bytes"] += len(chunk)
+        received["newlines"] += chunk.count(b"\n")
+
+    result = {}
+    with timer(result):
+        if mode == "paging":
+            cursor, exported = "", 0
+            while cursor is not None:
+                status, _, body = await asgi_request(app, "GET", "/api/v1/users/",
+                                                     query_string=f"media=false&limit={page_size}&cursor={cursor}")
+                page = json.loads(body)
+                exported += len(page["items"])
+                cursor = page["next_cursor"]
+        else:
+            status, _, _ = await asgi_request(app, "GET", "/api/v1/users/export",
+                                              query_string=f"format={mode.split('-')[1]}", on_body=on_body)
+            exported = received["newlines"] - (mode == "export-csv")  # the csv header line
+    assert exported == rows, (mode, exported)
+    await engine.dispose()
+    return {"mode": mode, "rows": rows, "rows/s": rows / result["seconds"], "seconds": result["seconds"],
+            "peak RSS MB": peak_rss_mb()}
+
+
+def main(args):
+    if args.mode:
+        print(json.dumps(asyncio.run(run_mode(args.mode, args.db, args.rows, args.page_size))))
+        return
+    db_path = temp_db_path("export.db")
+    seed(db_path, args.rows)
+    results = []
+    for mode in args.modes:
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_export", "--mode", mode, "--db", db_path,
+                                 "--rows", str(args.rows), "--page-size", str(args.page_size)],
+                                check=True, capture_output=True, text=True).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    report(f"export of {args.rows} users", results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=1_000_000)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--modes", nargs="+", choices=MODES, default=MODES)
+    parser.add_argument("--mode", choices=MODES, help=argparse.SUPPRESS)
+    parser.add_argument("--db", help=argparse.SUPPRESS)
+    main(parser.parse_args())
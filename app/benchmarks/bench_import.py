@@ -0,0 +1,122 @@
+"""User onboarding: one POST /api/v1/users/ per user against POST /api/v1/users/import.
+
+The per-user path is measured on --single-rows users (bcrypt dominates it, a full run would take hours)
+and reported as rows/s. The bulk import runs on --rows users for every batch size and body format.
+bcrypt runs with --rounds so the numbers show the DB and request overhead; the hashing pool scales it
+with the number of cores either way.
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+
+from fastapi import FastAPI
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from api.admission import user_write_limiter
+from api.v1.user import api_router as user_route
+from db.config import EngineSettings, build_engine, build_async_engine
+from db.database import get_async_session
+from db.hashing import password_hasher
+from db.migrations import upgrade
+from benchmarks.common import asgi_request, temp_db_path, timer, report
+
+
+def build_app(db_path: str) -> tuple[FastAPI, object]:
+    # the app defaults: WAL and a busy timeout, the per-user requests write concurrently
+    engine = build_async_engine(EngineSettings(url=f"sqlite:///{db_path}", echo=False))
+    app = FastAPI()
+    app.include_router(user_route, prefix='/api/v1/users')
+
+    async def override_get_async_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_get_async_session
+    return app, engine
+
+
+def migrate(db_path: str):
+    # the schema of the app, with the search indexes the inserts keep in sync
+    engine = build_engine(EngineSettings(url=f"sqlite:///{db_path}", echo=False))
+    upgrade(engine)
+    engine.dispose()
+
+
+def make_users(count: int, prefix: str) -> list[dict]:
+    return [{"login": f"{prefix}{i}", "email": f"{prefix}{i}@mail.ru", "full_name": f"User{i} U",
+             "password": f"password{i}"} for i in range(count)]
+
+
+def ndjson_body(users: list[dict]) -> bytes:
+    return "".join(json.dumps(user) + "\n" for user in users).encode()
+
+
+def csv_body(users: list[dict]) -> bytes:
+    out = io.StringIO()
+    writer = csv.DictWriter(out, fieldnames=list(users[0]))
+    writer.writeheader()
+    writer.writerows(users)
+    return out.getvalue().encode()
+
+
+async def run_single(rows: int, concurrency: int) -> dict:
+    db_path = temp_db_path("import.db")
+    app, engine = build_app(db_path)
+    migrate(db_path)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(user: dict):
+        async with semaphore:
+            status, _, _ = await asgi_request(app, "POST", "/api/v1/users/", {"content-type": "application/json"},
+                                              json.dumps(user).encode())
+            assert status == 200, status
+
+    result = {}
+    with timer(result):
+        await asyncio.gather(*(one(user) for user in make_users(rows, "single")))
+    await engine.dispose()
+    return {"mode": "POST per user", "format": "json", "batch": 1, "rows": rows,
+            "rows/s": rows / result["seconds"], "seconds": result["seconds"]}
+
+
+async def run_bulk(rows: int, batch_size: int, body_format: str) -> dict:
+    db_path = temp_db_path("import.db")
+    app, engine = build_app(db_path)
+    migrate(db_path)
+    users = make_users(rows, "bulk")
+    content_type, body = ("application/x-ndjson", ndjson_body(users)) if body_format == "ndjson" \
+        else ("text/csv", csv_body(users))
+    result = {}
+    with timer(result):
+        status, _, response = await asgi_request(app, "POST", "/api/v1/users/import", {"content-type": content_type},
+                                                 body, query_string=f"batch_size={batch_size}")
+    assert status == 200 and json.loads(response)["created"] == rows, (status, response[:200])
+    await engine.dispose()
+    return {"mode": "import", "format": body_format, "batch": batch_size, "rows": rows,
+            "rows/s": rows / result["seconds"], "seconds": result["seconds"]}
+
+
+async def main(args):
+    password_hasher.rounds = args.rounds
+    # every client waits for a slot of the admission control instead of getting a 503, whatever --concurrency
+    user_write_limiter.queue = args.concurrency
+    await password_hasher.hash("warmup")  # start the hashing pool outside of the timings
+    results = [await run_single(args.single_rows, args.concurrency)]
+    for body_format in args.formats:
+        for batch_size in args.batch_sizes:
+            results.append(await run_bulk(args.rows, batch_size, body_format))
+    password_hasher.shutdown()
+    report(f"user import, bcrypt rounds {args.rounds}", results)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--rows", type=int, default=100_000)
+    parser.add_argument("--single-rows", type=int, default=2_000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 500, 2_000])
+    parser.add_argument("--formats", nargs="+", choices=["ndjson", "csv"], default=["ndjson", "csv"])
+    parser.add_argument("--rounds", type=int, default=4)
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,72 @@
+"""Media serving: the plain StaticFiles mount against MediaFiles, for full, conditional and range GETs.
+
+A browser revalidating its cache sends If-None-Match; a video player seeking sends Range.
+Both run in-process through the ASGI apps, so the numbers exclude the network.
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import tempfile
+
+from starlette.staticfiles import StaticFiles
+
+from api.media_files import MediaFiles
+from benchmarks.common import asgi_request, timer, report
+
+
+async def run_case(app, requests: int, concurrency: int, path: str, headers: dict) -> dict:
+    semaphore = asyncio.Semaphore(concurrency)
+    sent = {"bytes": 0, "status": None}
+
+    async def one():
+        async with semaphore:
+            status, _, body = await asgi_request(app, "GET", path, headers)
+            sent["bytes"] += len(body)
+            sent["status"] = status
+
+    result = {}
+    with timer(result):
+        await asyncio.gather(*(one() for _ in range(requests)))
+    return {"req/s": requests / result["seconds"], "status": sent["status"],
+            "MB sent": sent["bytes"] / 1024 / 1024}
+
+
+async def run(directory: str, args) -> list[dict]:
+    name = "media.png"
+    with open(os.path.join(directory, name), "wb") as file:
+        file.write(os.urandom(args.size))
+    apps = {"StaticFiles": StaticFiles(directory=directory), "MediaFiles": MediaFiles(directory=directory)}
+    _, headers, _ = await asgi_request(apps["StaticFiles"], "GET", f"/{name}")
+    static_etag = headers["etag"]
+    _, headers, _ = await asgi_request(apps["MediaFiles"], "GET", f"/{name}")
+    media_etag = headers["etag"]
+    cases = {
+        "full": lambda etag: {},
+        "if-none-match": lambda etag: {"If-None-Match": etag},
+        "range 64KB": lambda etag: {"Range": "bytes=0-65535"},
+    }
+    rows = []
+    for case, make_headers in cases.items():
+        for mount, app in apps.items():
+            headers = make_headers(static_etag if mount == "StaticFiles" else media_etag)
+            row = await run_case(app, args.requests, args.concurrency, f"/{name}", headers)
+            rows.append({"case": case, "mount": mount, **row})
+    return rows
+
+
+def main(args):
+    directory = tempfile.mkdtemp(prefix="weimfa_bench_media_")
+    try:
+        rows = asyncio.run(run(directory, args))
+    finally:
+        shutil.rmtree(directory)
+    report(f"{args.requests} GETs of a {args.size / 1024 / 1024:g}MB file, concurrency {args.concurrency}", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--size", type=int, default=2 * 1024 * 1024)
+    main(parser.parse_args())
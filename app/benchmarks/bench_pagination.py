@@ -0,0 +1,60 @@
+"""Per-page latency of offset and keyset (cursor) pagination at increasing depth.
+
+Offset pages scan and discard every skipped row, keyset pages seek by primary key,
+so their latency should stay flat whatever the depth.
+"""
+import argparse
+import time
+
+from sqlmodel import Session, create_engine
+
+import db.crud as crud
+from models.models import User, MediaUser, Privileges
+from benchmarks.common import temp_db_path, seed, report
+
+
+def page_ms(func, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1000
+
+
+def main(args):
+    db_path = temp_db_path()
+    seed(db_path, args.users)
+    engine = create_engine(f"sqlite:///{db_path}")
+    # media rows all belong to one extra user past the user pages, so media depth is measured on a single listing
+    media_owner = args.users + 1
+    with engine.begin() as conn:
+        conn.execute(User.__table__.insert(), {
+            "id": media_owner, "login": "media_owner", "email": "media_owner@mail.ru", "full_name": "Media Owner",
+            "hash_pass": "x", "privileges": Privileges.user.name, "is_active": True,
+            "created_at": "2022-01-01T00:00:00", "updated_at": None})
+        conn.execute(MediaUser.__table__.insert(), [
+            {"id": i, "user_id": media_owner, "media_path": f"static/media_user/{i}.png", "created_at": "2022-01-01T00:00:00"}
+            for i in range(1, args.users + 1)])
+    rows = []
+    with Session(engine) as session:
+        for depth in args.depths:
+            depth = min(depth, args.users - args.limit)
+            rows.append({
+                "depth": depth,
+                "offset ms": page_ms(lambda: crud.get_user_all(session, args.limit, offset=depth), args.repeat),
+                "cursor ms": page_ms(lambda: crud.get_user_all(session, args.limit, after_id=depth), args.repeat),
+                "media offset ms": page_ms(lambda: crud.get_medias_user_by_user_id(
+                    session, media_owner, args.limit, offset=depth), args.repeat),
+                "media cursor ms": page_ms(lambda: crud.get_medias_user_by_user_id(
+                    session, media_owner, args.limit, after_id=depth), args.repeat),
+            })
+            session.expunge_all()
+    report(f"{args.users} users, {args.users} media of one user, page of {args.limit}", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=500_000)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--depths", type=int, nargs="+", default=[0, 10_000, 100_000, 250_000, 499_900])
+    main(parser.parse_args())
@@ -0,0 +1,74 @@
+"""Per-row CPU and memory of the list endpoints: the ORM path against the column projections (UserRow, ...).
+
+`orm` loads the page as User / MediaUser instances (crud.get_user_all, get_medias_user_by_user_id): identity
+map, instance state and every column including hash_pass. `rows` selects only the response columns into
+named tuples (crud.get_user_rows, get_media_rows_by_user_id). Both then build the response payloads of
+api/serialization.py. Each call runs in a fresh session, as a request does. Memory is the tracemalloc peak
+of the load while the page is alive, divided by the rows of the page.
+"""
+import argparse
+import time
+import tracemalloc
+
+from sqlmodel import Session, create_engine
+
+import db.crud as crud
+from api.serialization import user_payload, user_summary_payload, media_user_payload
+from benchmarks.common import temp_db_path, seed, report
+
+
+def load(engine, loader, build):
+    with Session(engine) as session:
+        items = loader(session)
+        payloads = [build(item) for item in items]
+    return items, payloads
+
+
+def main(args):
+    db_path = temp_db_path()
+    seed(db_path, args.users, args.media_per_user)
+    engine = create_engine(f"sqlite:///{db_path}")
+    middle = args.users // 2
+    limit = args.limit
+    media_limit = args.media_per_user
+    endpoints = {
+        f"GET /users/ page of {limit}": (
+            lambda session: crud.get_user_all(session, limit, after_id=middle),
+            lambda session: crud.get_user_rows(session, limit, after_id=middle), user_payload),
+        f"GET /users/?media=false page of {limit}": (
+            lambda session: crud.get_user_all(session, limit, after_id=middle, with_media=False),
+            lambda session: crud.get_user_rows(session, limit, after_id=middle, with_media=False),
+            user_summary_payload),
+        f"GET /media_user/{{id}} page of {media_limit}": (
+            lambda session: crud.get_medias_user_by_user_id(session, middle, media_limit),
+            lambda session: crud.get_media_rows_by_user_id(session, middle, media_limit), media_user_payload),
+    }
+    rows = []
+    for endpoint, (orm_loader, row_loader, build) in endpoints.items():
+        baseline = None
+        for path, loader in (("orm", orm_loader), ("rows", row_loader)):
+            items, _ = load(engine, loader, build)  # warm up, the statement cache included
+            count = len(items)
+            start = time.perf_counter()
+            for _ in range(args.repeat):
+                load(engine, loader, build)
+            ms = (time.perf_counter() - start) / args.repeat * 1000
+            tracemalloc.start()
+            page = load(engine, loader, build)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            del page
+            baseline = baseline or ms
+            rows.append({"endpoint": endpoint, "path": path, "ms/page": ms, "us/row": ms * 1000 / count,
+                         "bytes/row": peak // count, "speedup": baseline / ms})
+    engine.dispose()
+    report(f"{args.users} users, {args.media_per_user} media per user, mean of {args.repeat}", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--media-per-user", type=int, default=3)
+    parser.add_argument("--limit", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=200)
+    main(parser.parse_args())
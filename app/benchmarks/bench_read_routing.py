@@ -0,0 +1,103 @@
+"""Read latency under a concurrent write load, reads sharing the pool of the writes or on their own pool.
+
+Readers poll GET /users/{id} and GET /users/?limit=20 through the ASGI app in-process, writers add media
+rows in transactions that hold their connection while they wait for the SQLite write lock. With one pool
+the reads queue for a connection behind the waiting writes; with the read-only pool of db/database.py
+(get_async_read_session) they only wait for a read connection. The split helps while the pool is the
+bottleneck; once the process is CPU bound, e.g. many readers on one core, the reads are not faster.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from fastapi import FastAPI
+from sqlalchemy.exc import OperationalError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import db.async_crud as async_crud
+from api.v1.user import api_router as user_route
+from db.config import EngineSettings, build_engine, build_async_engine
+from db.database import get_async_session, get_async_read_session
+from db.migrations import upgrade
+from models.models import MediaUserCreate
+from benchmarks.common import asgi_request, temp_db_path, seed, report
+
+
+def build_app(engine, read_engine) -> FastAPI:
+    app = FastAPI()
+    app.include_router(user_route, prefix='/api/v1/users')
+
+    async def override_get_async_session():
+        async with AsyncSession(engine, expire_on_commit=False) as session:
+            yield session
+
+    async def override_get_async_read_session():
+        async with AsyncSession(read_engine, expire_on_commit=False) as session:
+            yield session
+
+    app.dependency_overrides[get_async_session] = override_get_async_session
+    app.dependency_overrides[get_async_read_session] = override_get_async_read_session
+    return app
+
+
+async def run(args, db_path: str, read_pool: bool, writers: int) -> dict:
+    settings = EngineSettings(url=f"sqlite:///{db_path}", pool_size=args.pool_size, max_overflow=0)
+    engine = build_async_engine(settings)
+    read_engine = build_async_engine(settings.for_reads(), read_only=True) if read_pool else engine
+    app = build_app(engine, read_engine)
+    latencies, writes, failed = [], [0], [0]
+    deadline = time.perf_counter() + args.seconds
+
+    async def reader():
+        while time.perf_counter() < deadline:
+            user_id = random.randint(1, args.users)
+            path, query_string = random.choice([(f"/api/v1/users/{user_id}", ""), ("/api/v1/users/", "limit=20")])
+            start = time.perf_counter()
+            status, _, _ = await asgi_request(app, "GET", path, query_string=query_string)
+            latencies.append(time.perf_counter() - start)
+            assert status == 200, status
+
+    async def writer():
+        while time.perf_counter() < deadline:
+            try:
+                async with AsyncSession(engine, expire_on_commit=False) as session:
+                    await async_crud.add_media_user(session, MediaUserCreate(
+                        user_id=random.randint(1, args.users), media_path="static/media_user/bench.png"))
+                writes[0] += 1
+            except OperationalError:  # database is locked
+                failed[0] += 1
+
+    await asyncio.gather(*(reader() for _ in range(args.readers)), *(writer() for _ in range(writers)))
+    await engine.dispose()
+    if read_engine is not engine:
+        await read_engine.dispose()
+    latencies.sort()
+    return {"reads/s": len(latencies) / args.seconds, "read p50 ms": latencies[len(latencies) // 2] * 1000,
+            "read p99 ms": latencies[int(len(latencies) * 0.99)] * 1000, "writes/s": writes[0] / args.seconds,
+            "failed writes": failed[0]}
+
+
+def main(args):
+    db_path = temp_db_path()
+    seed(db_path, args.users, args.media_per_user)
+    engine = build_engine(EngineSettings(url=f"sqlite:///{db_path}", echo=False))
+    upgrade(engine)
+    engine.dispose()
+    rows = []
+    for writers in args.writers:
+        for read_pool in (False, True):
+            result = asyncio.run(run(args, db_path, read_pool, writers))
+            rows.append({"writers": writers, "pools": "read + write" if read_pool else "shared", **result})
+    report(f"{args.readers} readers, pools of {args.pool_size}, {args.seconds} s per run", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--media-per-user", type=int, default=3)
+    parser.add_argument("--readers", type=int, default=4)
+    parser.add_argument("--writers", type=int, nargs="+", default=[0, 5, 20])
+    parser.add_argument("--pool-size", type=int, default=5)
+    parser.add_argument("--seconds", type=float, default=5)
+    main(parser.parse_args())
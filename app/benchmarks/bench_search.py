@@ -0,0 +1,123 @@
+"""Latency of the user search (full text indexes of migration 4) against a LIKE scan, on a large users table.
+
+The users get names drawn from small first / last name lists, so a query matches from one user to a good part
+of the table. The LIKE baseline reads the table until it has a page: fast when the words are frequent, a full
+scan of the table when they are rare or absent. The index answers every query from the matching rows only,
+ranking them all (bm25) before the page is cut, so its cost grows with the number of matches instead.
+Also reports the index build on the existing rows and the insert rate with the sync triggers.
+"""
+import argparse
+import os
+import random
+import time
+
+from sqlalchemy import and_, or_
+from sqlmodel import Session, SQLModel, create_engine, select
+
+import db.crud as crud
+from db.migrations import upgrade
+from db.utils.bulk_import import IMPORT_BATCH_SIZE
+from models.models import User, Privileges
+from benchmarks.common import temp_db_path, report
+
+FIRST_NAMES = ["Anna", "Boris", "Clara", "Dmitri", "Elena", "Fedor", "Galina", "Igor", "Irina", "John", "Julia",
+               "Kirill", "Lena", "Maria", "Mikhail", "Natalia", "Oleg", "Olga", "Pavel", "Renée", "Sergei", "Sofia",
+               "Tatiana", "Viktor", "Yulia"]
+LAST_NAMES = ["Smith", "Ivanov", "Petrova", "Sidorov", "Kuznetsova", "Popov", "Vasiliev", "Sokolova", "Mikhailov",
+              "Novikova", "Fedorov", "Morozova", "Volkov", "Alekseeva", "Lebedev", "Semenova", "Egorov", "Pavlova",
+              "Kozlov", "Stepanova", "Nikolaev", "Orlova", "Andreev", "Makarova", "Zakharov", "Müller", "Johnson"]
+DOMAINS = ["mail.ru", "gmail.com", "yandex.ru", "example.org"]
+
+
+def user_rows(start: int, stop: int, rng: random.Random) -> list[dict]:
+    rows = []
+    for i in range(start, stop):
+        first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+        rows.append({"id": i, "login": f"{first}.{last}{i}".lower(),
+                     "email": f"{first[0]}{last}{i}@{rng.choice(DOMAINS)}", "full_name": f"{first} {last}",
+                     "hash_pass": "x", "privileges": Privileges.user.value, "is_active": True,
+                     "created_at": "2022-01-01T00:00:00", "updated_at": None})
+    return rows
+
+
+def seed_users(engine, users: int, rng: random.Random, batch: int = 10_000):
+    SQLModel.metadata.create_all(engine)
+    with engine.begin() as conn:
+        for start in range(1, users + 1, batch):
+            conn.execute(User.__table__.insert(), user_rows(start, min(start + batch, users + 1), rng))
+
+
+def like_search(session: Session, query: str, limit: int) -> list[User]:
+    """The search without the indexes: every word inside one of the columns, case-insensitive for ASCII"""
+    conditions = [or_(User.login.like(f"%{word}%"), User.email.like(f"%{word}%"), User.full_name.like(f"%{word}%"))
+                  for word in query.split()]
+    return session.exec(select(User).where(and_(*conditions)).order_by(User.id).limit(limit)).all()
+
+
+def query_ms(func, repeat: int) -> tuple[float, int]:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        results = func()
+    return (time.perf_counter() - start) / repeat * 1000, len(results)
+
+
+def main(args):
+    rng = random.Random(args.seed)
+    db_path = temp_db_path()
+    engine = create_engine(f"sqlite:///{db_path}")
+    start = time.perf_counter()
+    seed_users(engine, args.users, rng)
+    seed_seconds = time.perf_counter() - start
+    size = os.path.getsize(db_path)
+    start = time.perf_counter()
+    upgrade(engine)  # migration 4 indexes the existing rows
+    build_seconds = time.perf_counter() - start
+    report(f"{args.users} users", [{
+        "seed s": seed_seconds, "index build s": build_seconds, "table MB": size / 2 ** 20,
+        "with indexes MB": os.path.getsize(db_path) / 2 ** 20}])
+
+    with Session(engine) as session:
+        rare_user = crud.get_user_by_id(session, args.users // 2)
+    queries = [
+        ("one login", rare_user.login, False),
+        ("email as typed", rare_user.email, False),
+        ("first + last prefix", "ann smi", False),
+        ("one frequent word", "olga", False),
+        ("absent word", "zzyzx", False),
+        ("fragment, fuzzy", "ikha", True),
+        ("fragment + prefix, fuzzy", "kolov ir", True),
+    ]
+    rows = []
+    with Session(engine) as session:
+        for label, query, fuzzy in queries:
+            index_ms, found = query_ms(lambda: crud.search_users(session, query, args.limit, fuzzy=fuzzy), args.repeat)
+            deep_ms, _ = query_ms(lambda: crud.search_users(session, query, args.limit, args.deep_offset, fuzzy),
+                                  args.repeat)
+            scan_ms, scan_found = query_ms(lambda: like_search(session, query, args.limit), args.repeat)
+            rows.append({"query": f"{label}: {query!r}", "found": found, "index ms": index_ms,
+                         f"offset {args.deep_offset} ms": deep_ms, "LIKE ms": scan_ms, "LIKE found": scan_found})
+            session.expunge_all()
+    report(f"search, page of {args.limit}, mean of {args.repeat}", rows)
+
+    # the triggers index every new row in both tables: inserts through the import path, batch by batch
+    rows = [{key: row[key] for key in ("login", "email", "full_name", "hash_pass")}
+            for row in user_rows(args.users + 1, args.users + 1 + args.inserts, rng)]
+    start = time.perf_counter()
+    with Session(engine) as session:
+        for batch_start in range(0, len(rows), IMPORT_BATCH_SIZE):
+            crud.insert_users(session, rows[batch_start:batch_start + IMPORT_BATCH_SIZE])
+    insert_seconds = time.perf_counter() - start
+    report(f"import inserts with the search triggers, batches of {IMPORT_BATCH_SIZE}",
+           [{"rows": args.inserts, "rows/s": args.inserts / insert_seconds}])
+    engine.dispose()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--deep-offset", type=int, default=1000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--inserts", type=int, default=10_000)
+    parser.add_argument("--seed", type=int, default=1)
+    main(parser.parse_args())
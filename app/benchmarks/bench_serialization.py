@@ -0,0 +1,85 @@
+"""Response serialization of the read endpoints, on in-memory rows so that only the encoding is measured.
+
+`response_model` is the previous path: FastAPI validates the ORM objects through the declared
+response_model, then encodes the result with jsonable_encoder and stdlib json.
+`orjson` / `msgpack` build the payload straight from the rows (api/serialization.py).
+"""
+import argparse
+import asyncio
+import time
+from typing import List
+
+from fastapi.responses import JSONResponse, ORJSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+from api.serialization import MsgPackResponse, user_payload, user_summary_payload, media_user_payload
+from models.models import User, MediaUser, UserResponse, UserSummary, MediaUserResponse, Privileges
+from benchmarks.common import report
+
+
+def make_rows(users: int, media_per_user: int) -> list[User]:
+    rows = []
+    for i in range(1, users + 1):
+        user = User(id=i, login=f"user{i}", email=f"user{i}@mail.ru", full_name=f"User{i} U", hash_pass="x",
+                    privileges=Privileges.user, is_active=True, created_at="2022-01-01T00:00:00", updated_at=None)
+        user.media = [MediaUser(id=i * media_per_user + j, user_id=i, media_path=f"static/media_user/{i}_{j}.png",
+                                sha256="0" * 64, derivatives="thumbnail,medium", created_at="2022-01-01T00:00:00")
+                      for j in range(media_per_user)]
+        rows.append(user)
+    return rows
+
+
+async def measure(encode, repeat: int) -> tuple[float, int]:
+    size = len(await encode())  # warm up
+    start = time.perf_counter()
+    for _ in range(repeat):
+        await encode()
+    return (time.perf_counter() - start) / repeat * 1000, size
+
+
+async def run(args) -> list[dict]:
+    users = make_rows(args.page_size, args.media_per_user)
+    medias = [media for user in users for media in user.media][:args.page_size]
+    for media in medias:
+        media.user = next(user for user in users if user.id == media.user_id)
+    endpoints = {
+        "GET /users/": (List[UserResponse], users, user_payload),
+        "GET /users/?media=false": (List[UserSummary], users, user_summary_payload),
+        "GET /media_user/{id}": (List[MediaUserResponse], medias, media_user_payload),
+        "GET /users/{id}": (UserResponse, users[0], user_payload),
+    }
+    rows = []
+    for endpoint, (response_type, content, build) in endpoints.items():
+        field = create_response_field(name="response", type_=response_type)
+        many = isinstance(content, list)
+
+        async def previous():
+            return JSONResponse(await serialize_response(field=field, response_content=content)).body
+
+        async def fast_json():
+            return ORJSONResponse([build(row) for row in content] if many else build(content)).body
+
+        async def fast_msgpack():
+            return MsgPackResponse([build(row) for row in content] if many else build(content)).body
+
+        baseline = None
+        for path, encode in (("response_model", previous), ("orjson", fast_json), ("msgpack", fast_msgpack)):
+            ms, size = await measure(encode, args.repeat)
+            baseline = baseline or ms
+            rows.append({"endpoint": endpoint, "path": path, "ms/response": ms, "speedup": baseline / ms,
+                         "bytes": size})
+    return rows
+
+
+def main(args):
+    rows = asyncio.run(run(args))
+    report(f"pages of {args.page_size} rows, {args.media_per_user} media per user", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--media-per-user", type=int, default=3)
+    parser.add_argument("--repeat", type=int, default=200)
+    main(parser.parse_args())
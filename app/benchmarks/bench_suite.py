@@ -0,0 +1,427 @@
+"""Load test of the api/v1 endpoints with a mixed workload, compared against a JSON baseline.
+
+A SQLite DB is seeded with --users users and --media-per-user media rows, all sharing one password.
+Then --concurrency clients send requests for --duration seconds. Each request's operation is drawn from
+--mix (op=weight,...). Requests go to the real application (main.app, middlewares and startup included).
+It runs either in-process through ASGI (--target asgi) or in a server started on the seeded DB: plain
+uvicorn (--target uvicorn) or the production launcher serve.py (--target serve), extra flags with
+--server-args. Either way the application runs in a separate process from a scratch directory, so the
+uploads never touch static/.
+
+p50/p95/p99 latency, RPS and errors are reported per operation and for the whole mix.
+
+    python -m benchmarks.bench_suite --save-baseline baseline.json
+    python -m benchmarks.bench_suite --compare baseline.json --threshold 0.15
+
+--compare exits with status 1 in three cases: an operation's p95 or p99 grew by more than --threshold,
+its RPS dropped by more than --threshold, or its error rate is above --max-error-rate.
+bcrypt dominates login/update_user: run with the BCRYPT_ROUNDS of the target hardware, and compare runs
+made with the same value (it is stored in the baseline). Every client shares one address, so the per-client
+login throttling is off unless LOGIN_RATE is set; the admission limits (api/admission.py) stay on.
+"""
+import argparse
+import asyncio
+import io
+import json
+import math
+import os
+import random
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable
+from urllib.parse import urlencode
+
+from PIL import Image
+
+from db.hashing import BCRYPT_ROUNDS, hash_password
+from benchmarks.common import asgi_request, HttpClient, multipart_body, seed, report
+
+APP_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PASSWORD = "bench-password"
+DEFAULT_MIX = ("login=2,about_me=10,list_users=8,list_users_summary=4,get_user=10,create_user=1,"
+               "update_user=1,delete_user=1,import_users=0,export_users=0,list_media=8,media_file=4,upload=2,"
+               "upload_by_hash=1,delete_media=2,export_media=0")
+# Fields of the arguments stored with the baseline: runs are only comparable with the same values
+CONFIG_FIELDS = ("target", "users", "media_per_user", "concurrency", "duration", "mix", "server_args")
+
+
+@dataclass
+class Call:
+    method: str
+    path: str
+    query_string: str = ""
+    headers: dict = field(default_factory=dict)
+    body: bytes = b""
+    expect: tuple[int, ...] = (200,)
+    on_response: Callable[[bytes], None] | None = None
+
+
+def form(fields: dict) -> tuple[dict, bytes]:
+    return {"content-type": "application/x-www-form-urlencoded"}, urlencode(fields).encode()
+
+
+def json_body(payload) -> tuple[dict, bytes]:
+    return {"content-type": "application/json"}, json.dumps(payload).encode()
+
+
+def make_images(count: int) -> list[bytes]:
+    images = []
+    for i in range(count):
+        buffer = io.BytesIO()
+        Image.new("RGB", (640, 480), (i * 37 % 256, i * 91 % 256, i * 53 % 256)).save(buffer, "PNG")
+        images.append(buffer.getvalue())
+    return images
+
+
+class Workload:
+    """What the operations need to build valid requests: known ids, tokens, uploaded files.
+    Every choice goes through one seeded Random, so a run replays the same sequence of operations."""
+
+    def __init__(self, users: int, media_per_user: int, seed_value: int):
+        self.rng = random.Random(seed_value)
+        self.users = users
+        self.tokens: list[str] = []
+        # seeded media rows have no file, they are the ones deleted; uploaded media serve the file reads
+        self.deletable_media = list(range(1, users * media_per_user + 1))
+        self.file_media: list[int] = []
+        self.hashes: list[str] = []
+        self.images = make_images(8)
+        self.created_users: list[int] = []
+        self.created = 0
+        self.cursor = ""
+
+    def user_id(self) -> int:
+        return self.rng.randint(1, self.users)
+
+    def email(self) -> str:
+        return f"user{self.user_id()}@mail.ru"
+
+    def new_user(self) -> dict:
+        self.created += 1
+        return {"login": f"bench{self.created}", "email": f"bench{self.created}@mail.ru",
+                "full_name": f"Bench{self.created} U", "password": PASSWORD}
+
+    def pop(self, items: list[int]) -> int | None:
+        if not items:
+            return None
+        index = self.rng.randrange(len(items))
+        items[index], items[-1] = items[-1], items[index]
+        return items.pop()
+
+    def _on_page(self, body: bytes):
+        self.cursor = json.loads(body)["next_cursor"] or ""
+
+    def _on_media(self, body: bytes):
+        media = json.loads(body)
+        self.deletable_media.append(media["id"])
+
+    # operations, each returns the Call to send
+
+    def login(self) -> Call:
+        headers, body = form({"username": self.email(), "password": PASSWORD})
+        return Call("POST", "/api/v1/security/token", headers=headers, body=body,
+                    on_response=lambda body: self.tokens.append(json.loads(body)["access_token"]))
+
+    def about_me(self) -> Call:
+        if not self.tokens:
+            return self.login()
+        return Call("GET", "/api/v1/security/about_me",
+                    headers={"authorization": f"Bearer {self.rng.choice(self.tokens)}"})
+
+    def list_users(self) -> Call:
+        return Call("GET", "/api/v1/users/", f"limit=20&cursor={self.cursor}", on_response=self._on_page)
+
+    def list_users_summary(self) -> Call:
+        return Call("GET", "/api/v1/users/", f"limit=100&media=false&offset={self.rng.randrange(self.users)}")
+
+    def get_user(self) -> Call:
+        return Call("GET", f"/api/v1/users/{self.user_id() if self.rng.random() < 0.5 else self.email()}")
+
+    def create_user(self) -> Call:
+        headers, body = json_body(self.new_user())
+        return Call("POST", "/api/v1/users/", headers=headers, body=body,
+                    on_response=lambda body: self.created_users.append(json.loads(body)["id"]))
+
+    def update_user(self) -> Call:
+        user_id = self.user_id()
+        headers, body = json_body({"login": f"user{user_id}", "email": f"user{user_id}@mail.ru",
+                                   "full_name": f"User{user_id} Updated", "password": PASSWORD,
+                                   "old_password": PASSWORD})
+        return Call("PUT", "/api/v1/users/", headers=headers, body=body)
+
+    def delete_user(self) -> Call:
+        user_id = self.pop(self.created_users)
+        if user_id is None:
+            return self.create_user()
+        return Call("DELETE", f"/api/v1/users/{user_id}", expect=(200, 202))
+
+    def import_users(self) -> Call:
+        rows = [json.dumps(self.new_user()) for _ in range(100)]
+        return Call("POST", "/api/v1/users/import", headers={"content-type": "application/x-ndjson"},
+                    body="\n".join(rows).encode())
+
+    def export_users(self) -> Call:
+        return Call("GET", "/api/v1/users/export")
+
+    def list_media(self) -> Call:
+        return Call("GET", f"/api/v1/media_user/{self.user_id()}")
+
+    def media_file(self) -> Call:
+        if not self.file_media:
+            return self.upload()
+        return Call("GET", f"/api/v1/media_user/{self.rng.choice(self.file_media)}/file")
+
+    def upload(self) -> Call:
+        headers, body = multipart_body("in_file", "img.png", self.rng.choice(self.images))
+        return Call("POST", f"/api/v1/media_user/{self.user_id()}", headers=headers, body=body,
+                    on_response=self._on_media)
+
+    def upload_by_hash(self) -> Call:
+        if not self.hashes:
+            return self.upload()
+        return Call("POST", f"/api/v1/media_user/{self.user_id()}/by_hash/{self.rng.choice(self.hashes)}",
+                    on_response=self._on_media)
+
+    def delete_media(self) -> Call:
+        media_id = self.pop(self.deletable_media)
+        if media_id is None:
+            return self.upload()
+        return Call("DELETE", f"/api/v1/media_user/{media_id}", expect=(200, 202))
+
+    def export_media(self) -> Call:
+        return Call("GET", "/api/v1/media_user/export", f"user_id={self.user_id()}")
+
+
+OPERATIONS = [name for name in DEFAULT_MIX.replace("=", ",").split(",")[::2]]
+
+
+def parse_mix(mix: str) -> dict[str, float]:
+    weights = {}
+    for item in mix.split(","):
+        name, _, weight = item.partition("=")
+        if name not in OPERATIONS:
+            raise SystemExit(f"unknown operation {name!r}, one of {', '.join(OPERATIONS)}")
+        weights[name] = float(weight or 1)
+    return {name: weight for name, weight in weights.items() if weight > 0}
+
+
+Send = Callable[[Call], Awaitable[tuple[int, dict, bytes]]]
+
+
+async def prepare(workload: Workload, send: Send):
+    """Tokens for about_me and stored files for the reads, done before the clock starts"""
+    for _ in range(8):
+        call = workload.login()
+        status, _, body = await send(call)
+        assert status == 200, (status, body)
+        call.on_response(body)
+    for image in workload.images:
+        headers, body = multipart_body("in_file", "img.png", image)
+        status, _, body = await send(Call("POST", f"/api/v1/media_user/{workload.user_id()}",
+                                          headers=headers, body=body))
+        assert status == 200, (status, body)
+        media = json.loads(body)
+        workload.file_media.append(media["id"])
+        workload.hashes.append(media["sha256"])
+
+
+async def run_load(workload: Workload, clients: list[Send], mix: dict[str, float], duration: float,
+                   warmup: float) -> dict[str, dict]:
+    names, weights = list(mix), list(mix.values())
+    samples: dict[str, list[float]] = defaultdict(list)
+    errors: dict[str, int] = defaultdict(int)
+    start = time.perf_counter()
+    measure_from, deadline = start + warmup, start + warmup + duration
+
+    async def client(send: Send):
+        while (now := time.perf_counter()) < deadline:
+            name = workload.rng.choices(names, weights)[0]
+            call = getattr(workload, name)()
+            try:
+                status, _, body = await send(call)
+                ok = status in call.expect
+            except (OSError, asyncio.IncompleteReadError, ValueError):
+                ok = False
+            if ok and call.on_response is not None:
+                call.on_response(body)
+            if now >= measure_from:
+                samples[name].append(time.perf_counter() - now)
+                errors[name] += not ok
+
+    await asyncio.gather(*(client(send) for send in clients))
+    results = {name: summarize(samples[name], errors[name], duration) for name in names if samples[name]}
+    results["all"] = summarize([value for name in names for value in samples[name]], sum(errors.values()), duration)
+    return results
+
+
+def percentile(values: list[float], p: float) -> float:
+    """Nearest rank, values sorted"""
+    return values[max(0, math.ceil(p * len(values)) - 1)] if values else 0.0
+
+
+def summarize(latencies: list[float], errors: int, duration: float) -> dict:
+    latencies = sorted(latencies)
+    return {"requests": len(latencies), "errors": errors, "rps": len(latencies) / duration,
+            "p50_ms": percentile(latencies, 0.50) * 1000, "p95_ms": percentile(latencies, 0.95) * 1000,
+            "p99_ms": percentile(latencies, 0.99) * 1000}
+
+
+async def run_asgi(args) -> dict[str, dict]:
+    """In the child process: cwd is the scratch directory and DB_URL points to the seeded DB"""
+    from main import app
+    await app.router.startup()
+    background: set[asyncio.Task] = set()
+
+    async def send(call: Call):
+        return await asgi_request(app, call.method, call.path, call.headers, call.body,
+                                  query_string=call.query_string, background=background)
+
+    workload = Workload(args.users, args.media_per_user, args.seed)
+    await prepare(workload, send)
+    results = await run_load(workload, [send] * args.concurrency, parse_mix(args.mix), args.duration, args.warmup)
+    await asyncio.gather(*background)
+    await app.router.shutdown()
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+async def wait_for_port(port: int, server: subprocess.Popen, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if server.poll() is not None:
+            raise SystemExit(f"the server exited with status {server.returncode}")
+        try:
+            _, writer = await asyncio.open_connection("127.0.0.1", port)
+            writer.close()
+            return
+        except OSError:
+            await asyncio.sleep(0.1)
+    raise SystemExit("the server did not start")
+
+
+def server_command(target: str, port: int, server_args: str) -> list[str]:
+    if target == "serve":
+        # the production launcher (serve.py), uvloop + httptools workers
+        command = [sys.executable, os.path.join(APP_DIR, "serve.py")]
+    else:
+        command = [sys.executable, "-m", "uvicorn", "main:app", "--app-dir", APP_DIR, "--no-access-log"]
+    return command + ["--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+                      *shlex.split(server_args)]
+
+
+async def run_server(args, workdir: str, env: dict) -> dict[str, dict]:
+    port = free_port()
+    server = subprocess.Popen(server_command(args.target, port, args.server_args), cwd=workdir, env=env)
+    try:
+        await wait_for_port(port, server)
+        connections = [HttpClient("127.0.0.1", port) for _ in range(args.concurrency)]
+
+        def sender(connection: HttpClient) -> Send:
+            async def send(call: Call):
+                return await connection.request(call.method, call.path, call.headers, call.body, call.query_string)
+            return send
+
+        workload = Workload(args.users, args.media_per_user, args.seed)
+        await prepare(workload, sender(connections[0]))
+        results = await run_load(workload, [sender(connection) for connection in connections],
+                                 parse_mix(args.mix), args.duration, args.warmup)
+        for connection in connections:
+            await connection.close()
+        return results
+    finally:
+        server.terminate()
+        server.wait(timeout=60)
+
+
+def make_workdir(args) -> tuple[str, dict]:
+    """Scratch directory with the seeded DB and the environment of the application processes"""
+    workdir = tempfile.mkdtemp(prefix="weimfa_bench_suite_")
+    os.makedirs(os.path.join(workdir, "static", "media_user"))
+    db_path = os.path.join(workdir, "bench.db")
+    seed(db_path, args.users, args.media_per_user, hash_pass=hash_password(PASSWORD, BCRYPT_ROUNDS))
+    env = {**os.environ, "DB_URL": f"sqlite:///{db_path}", "PYTHONPATH": APP_DIR,
+           "BCRYPT_ROUNDS": str(BCRYPT_ROUNDS), "LOGIN_RATE": os.environ.get("LOGIN_RATE", "0")}
+    return workdir, env
+
+
+def compare(results: dict[str, dict], baseline: dict, threshold: float, max_error_rate: float,
+            min_requests: int) -> list[str]:
+    """The regressions of results against the baseline results, as readable lines"""
+    regressions = []
+    for name, current in results.items():
+        if current["requests"] and current["errors"] / current["requests"] > max_error_rate:
+            regressions.append(f"{name}: {current['errors']} errors in {current['requests']} requests")
+        previous = baseline.get(name)
+        if previous is None or min(previous["requests"], current["requests"]) < min_requests:
+            continue
+        for key in ("p95_ms", "p99_ms"):
+            if current[key] > previous[key] * (1 + threshold):
+                regressions.append(f"{name}: {key} {previous[key]:.2f} -> {current[key]:.2f}")
+        if current["rps"] < previous["rps"] * (1 - threshold):
+            regressions.append(f"{name}: rps {previous['rps']:.2f} -> {current['rps']:.2f}")
+    return regressions
+
+
+def main(args):
+    if args.child:
+        print(json.dumps(asyncio.run(run_asgi(args))))
+        return
+
+    workdir, env = make_workdir(args)
+    if args.target == "asgi":
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_suite", *sys.argv[1:], "--child"],
+                                cwd=workdir, env=env, check=True, capture_output=True, text=True).stdout
+        results = json.loads(output.strip().splitlines()[-1])
+    else:
+        results = asyncio.run(run_server(args, workdir, env))
+
+    config = {name: getattr(args, name) for name in CONFIG_FIELDS} | {"bcrypt_rounds": BCRYPT_ROUNDS}
+    report(f"{args.target}, {args.users} users x {args.media_per_user} media, {args.concurrency} clients, "
+           f"{args.duration:g}s", [{"operation": name, **values} for name, values in results.items()])
+
+    status = 0
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+        if baseline["config"] != config:
+            print(f"warning: the baseline was made with {baseline['config']}")
+        regressions = compare(results, baseline["results"], args.threshold, args.max_error_rate, args.min_requests)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        status = 1 if regressions else 0
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as file:
+            json.dump({"config": config, "results": results}, file, indent=2)
+    sys.exit(status)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--target", choices=["asgi", "uvicorn", "serve"], default="asgi")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--media-per-user", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=20, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=2, help="seconds run before measuring")
+    parser.add_argument("--mix", default=DEFAULT_MIX, help=f"op=weight,... among {', '.join(OPERATIONS)}")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--server-args", default="", help="extra server flags, e.g. '--workers 4 --preload'")
+    parser.add_argument("--save-baseline", metavar="FILE")
+    parser.add_argument("--compare", metavar="FILE", help="baseline to check this run against")
+    parser.add_argument("--threshold", type=float, default=0.15, help="tolerated relative regression")
+    parser.add_argument("--max-error-rate", type=float, default=0.01)
+    parser.add_argument("--min-requests", type=int, default=50,
+                        help="operations with fewer requests in either run are not compared")
+    parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+    main(parser.parse_args())
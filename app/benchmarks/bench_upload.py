@@ -0,0 +1,115 @@
+"""Concurrent 5MB uploads: the previous UploadFile + copyfileobj path against the streaming save_file,
+and the resumable upload (db/utils/uploads.py): raw chunks of --chunk-size PUT one after the other, then
+finalized. The DB part of the upload routes is left out, the modes only differ by how the body is handled.
+
+Every mode runs in its own process so that the reported peak RSS belongs to that mode only.
+"""
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from fastapi import FastAPI, File, UploadFile, Request
+
+from db.utils.utils import save_file
+from db.utils.uploads import create_upload_file, append_chunks, finalize_upload
+from models.models import UploadSession
+from benchmarks.common import asgi_request, multipart_body, timer, peak_rss_mb, report
+
+
+def build_app(directory: str) -> FastAPI:
+    app = FastAPI()
+
+    @app.post("/legacy")
+    def legacy(in_file: UploadFile = File(...)):
+        # save_file before the streaming rework: size measured after the full body is spooled
+        in_file.file.seek(0, os.SEEK_END)
+        in_file.file.seek(0, os.SEEK_SET)
+        with open(os.path.join(directory, os.urandom(8).hex() + ".png"), "wb") as out_file:
+            shutil.copyfileobj(in_file.file, out_file)
+        return {}
+
+    @app.post("/streaming")
+    async def streaming(request: Request):
+        await save_file(request, directory + "/")
+        return {}
+
+    upload_directory = os.path.join(directory, "uploads")
+    sessions = {}
+
+    @app.post("/chunked/{upload_id}")
+    async def create_upload(upload_id: str, size: int):
+        sessions[upload_id] = UploadSession(id=upload_id, user_id=1, ext=".png", size=size)
+        await create_upload_file(upload_id, upload_directory)
+        return {}
+
+    @app.put("/chunked/{upload_id}")
+    async def put_chunk(upload_id: str, offset: int, request: Request):
+        return {"offset": await append_chunks(sessions[upload_id], offset, request.stream(), upload_directory)}
+
+    @app.post("/chunked/{upload_id}/finalize")
+    async def finalize(upload_id: str):
+        await finalize_upload(sessions.pop(upload_id), directory + "/", upload_directory)
+        return {}
+
+    return app
+
+
+async def run_mode(mode: str, uploads: int, concurrency: int, size: int, chunk_size: int) -> dict:
+    directory = tempfile.mkdtemp(prefix="weimfa_bench_upload_")
+    app = build_app(directory)
+    content = os.urandom(size)
+    headers, body = multipart_body("in_file", "img.png", content)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one():
+        async with semaphore:
+            if mode != "chunked":
+                status, _, _ = await asgi_request(app, "POST", f"/{mode}", headers, body)
+                assert status == 200, status
+                return
+            upload_id = os.urandom(16).hex()
+            await asgi_request(app, "POST", f"/chunked/{upload_id}", query_string=f"size={size}")
+            for offset in range(0, size, chunk_size):
+                status, _, _ = await asgi_request(app, "PUT", f"/chunked/{upload_id}",
+                                                  body=content[offset:offset + chunk_size],
+                                                  query_string=f"offset={offset}")
+                assert status == 200, status
+            status, _, _ = await asgi_request(app, "POST", f"/chunked/{upload_id}/finalize")
+            assert status == 200, status
+
+    result = {}
+    with timer(result):
+        await asyncio.gather(*(one() for _ in range(uploads)))
+    shutil.rmtree(directory)
+    return {"mode": mode, "uploads/s": uploads / result["seconds"],
+            "MB/s": uploads * size / 1024 / 1024 / result["seconds"], "peak RSS MB": peak_rss_mb()}
+
+
+def main(args):
+    if args.mode:
+        print(json.dumps(asyncio.run(run_mode(args.mode, args.uploads, args.concurrency, args.size,
+                                              args.chunk_size))))
+        return
+    rows = []
+    for mode in ("legacy", "streaming", "chunked"):
+        output = subprocess.run([sys.executable, "-m", "benchmarks.bench_upload", "--mode", mode,
+                                 "--uploads", str(args.uploads), "--concurrency", str(args.concurrency),
+                                 "--size", str(args.size), "--chunk-size", str(args.chunk_size)],
+                                check=True, capture_output=True, text=True).stdout
+        rows.append(json.loads(output.strip().splitlines()[-1]))
+    report(f"{args.uploads} uploads of {args.size / 1024 / 1024:.1f}MB, concurrency {args.concurrency}", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--mode", choices=["legacy", "streaming", "chunked"])
+    parser.add_argument("--uploads", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--size", type=int, default=5 * 1024 * 1024 - 1024)
+    parser.add_argument("--chunk-size", type=int, default=1024 * 1024, help="chunked mode: bytes per PUT")
+    main(parser.parse_args())
@@ -0,0 +1,43 @@
+"""Throughput of the production launcher (serve.py) by number of workers, on the same machine.
+
+Every worker count runs the same read-mostly mix of bench_suite against a fresh serve.py on a DB seeded
+once. The load generator is a single process, so the client side saturates first when the server has as
+many workers as the machine has cores: leave it a core, or run the clients from another host.
+"""
+import argparse
+import asyncio
+import os
+
+from benchmarks.bench_suite import make_workdir, run_server
+from benchmarks.common import report
+
+READ_MIX = "about_me=4,list_users=4,list_users_summary=2,get_user=6,list_media=4,media_file=2"
+
+
+def main(args):
+    workdir, env = make_workdir(args)
+    rows = []
+    for workers in args.workers:
+        args.target = "serve"
+        args.server_args = f"--workers {workers} --loop {args.loop} --http {args.http}" + \
+            (" --preload" if args.preload else "")
+        results = asyncio.run(run_server(args, workdir, env))["all"]
+        rows.append({"workers": workers, "rps": results["rps"], "p50_ms": results["p50_ms"],
+                     "p99_ms": results["p99_ms"], "errors": results["errors"]})
+    report(f"serve.py, {args.concurrency} clients, {args.duration:g}s per run, {os.cpu_count()} CPUs", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--media-per-user", type=int, default=3)
+    parser.add_argument("--concurrency", type=int, default=64)
+    parser.add_argument("--duration", type=float, default=20)
+    parser.add_argument("--warmup", type=float, default=3, help="seconds of load before measuring")
+    parser.add_argument("--mix", default=READ_MIX)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--loop", choices=["uvloop", "asyncio"], default="uvloop")
+    parser.add_argument("--http", choices=["httptools", "h11"], default="httptools")
+    parser.add_argument("--preload", action=argparse.BooleanOptionalAction, default=True)
+    main(parser.parse_args())
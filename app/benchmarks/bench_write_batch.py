@@ -0,0 +1,94 @@
+"""Writes per second with and without group commit (db/utils/write_batch.py), at a given concurrency.
+
+Every simulated request opens its own session and runs one write of db.async_crud: a media row added to
+a random user, or a new user (the password hash is precomputed, bcrypt is not what is measured here).
+Without coalescing each write is its own transaction and waits for the SQLite write lock; with it the
+writer task commits the pending writes together. synchronous=FULL syncs the WAL on every commit, where
+the cost of a transaction is the highest.
+Without coalescing some writes fail on "database is locked" at high concurrency: a transaction that read
+first can not take the write lock once another writer committed, and the others time out in the queue.
+"""
+import argparse
+import asyncio
+import random
+import time
+
+from sqlalchemy.exc import OperationalError
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+import db.async_crud as async_crud
+import db.crud as crud
+from db.config import EngineSettings, build_engine, build_async_engine
+from db.migrations import upgrade
+from db.utils.write_batch import write_batcher
+from models.models import UserCreate, MediaUserCreate
+from benchmarks.common import temp_db_path, seed, report
+
+
+async def add_media(session: AsyncSession, i: int, users: int):
+    await async_crud.add_media_user(session, MediaUserCreate(user_id=random.randint(1, users),
+                                                             media_path=f"static/media_user/bench_{i}.png"))
+
+
+async def add_user(session: AsyncSession, i: int, users: int):
+    user_create = UserCreate(login=f"bench{i}", email=f"bench{i}@mail.ru", full_name="Bench U", password="x")
+    await write_batcher.run(session, crud.create_user, user_create, "x")
+
+
+async def run(args, db_path: str, synchronous: str, coalescing: bool, write, offset: int) -> dict:
+    engine = build_async_engine(EngineSettings(url=f"sqlite:///{db_path}", sqlite_synchronous=synchronous,
+                                               pool_size=args.concurrency))
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies, errors = [], []
+
+    async def one(i: int):
+        async with semaphore:
+            start = time.perf_counter()
+            try:
+                async with AsyncSession(engine, expire_on_commit=False) as session:
+                    await write(session, offset + i, args.users)
+            except OperationalError as ex:  # "database is locked": busy_timeout exceeded or a lock upgrade
+                errors.append(ex)
+            latencies.append(time.perf_counter() - start)
+
+    if coalescing:
+        write_batcher.start(engine)
+    start = time.perf_counter()
+    try:
+        await asyncio.gather(*(one(i) for i in range(args.writes)))
+    finally:
+        seconds = time.perf_counter() - start
+        await write_batcher.stop()
+        await engine.dispose()
+    latencies.sort()
+    return {"writes/s": (args.writes - len(errors)) / seconds, "failed": len(errors),
+            "p50 ms": latencies[len(latencies) // 2] * 1000, "p99 ms": latencies[int(len(latencies) * 0.99)] * 1000}
+
+
+def main(args):
+    db_path = temp_db_path()
+    seed(db_path, args.users)
+    engine = build_engine(EngineSettings(url=f"sqlite:///{db_path}", echo=False))
+    upgrade(engine)
+    engine.dispose()
+    write_batcher.max_ops, write_batcher.delay = args.max_ops, args.delay_ms / 1000
+    rows, offset = [], 0
+    for name, write in (("add media", add_media), ("add user", add_user)):
+        for synchronous in args.synchronous:
+            for coalescing in (False, True):
+                result = asyncio.run(run(args, db_path, synchronous, coalescing, write, offset))
+                offset += args.writes
+                rows.append({"write": name, "synchronous": synchronous, "coalescing": coalescing, **result})
+    report(f"{args.writes} writes, {args.concurrency} concurrent, batches of up to {args.max_ops} "
+           f"every {args.delay_ms} ms", rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--writes", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--max-ops", type=int, default=64)
+    parser.add_argument("--delay-ms", type=float, default=2)
+    parser.add_argument("--synchronous", nargs="+", default=["NORMAL", "FULL"])
+    main(parser.parse_args())
@@ -0,0 +1,190 @@
+import asyncio
+import os
+import resource
+import tempfile
+import time
+from contextlib import contextmanager
+from typing import Callable
+
+from sqlmodel import SQLModel, create_engine
+
+import db.database  # noqa: F401  (enables statement caching for the sqlmodel select classes)
+from models.models import User, MediaUser, Privileges
+
+# Benchmarks are run from the app directory: python -m benchmarks.<name> --help
+
+
+def temp_db_path(name: str = "bench.db") -> str:
+    path = os.path.join(tempfile.mkdtemp(prefix="weimfa_bench_"), name)
+    return path
+
+
+def seed(db_path: str, users: int, media_per_user: int = 0, batch: int = 10_000, hash_pass: str = "x"):
+    """Fills a fresh SQLite file with `users` users (and their media rows) through Core bulk inserts.
+    Every user gets hash_pass, pass a real bcrypt hash when the benchmark logs in."""
+    engine = create_engine(f"sqlite:///{db_path}")
+    SQLModel.metadata.create_all(engine)
+    now = "2022-01-01T00:00:00"
+    with engine.begin() as conn:
+        for start in range(1, users + 1, batch):
+            stop = min(start + batch, users + 1)
+            conn.execute(User.__table__.insert(), [
+                {"id": i, "login": f"user{i}", "email": f"user{i}@mail.ru", "full_name": f"User{i} U",
+                 "hash_pass": hash_pass, "privileges": Privileges.user.value, "is_active": True,
+                 "created_at": now, "updated_at": None}
+                for i in range(start, stop)])
+            if media_per_user:
+                conn.execute(MediaUser.__table__.insert(), [
+                    {"user_id": i, "media_path": f"static/media_user/{i}_{j}.png", "created_at": now}
+                    for i in range(start, stop) for j in range(media_per_user)])
+    engine.dispose()
+
+
+@contextmanager
+def timer(result: dict, key: str = "seconds"):
+    start = time.perf_counter()
+    yield
+    result[key] = time.perf_counter() - start
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss is in KB on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def report(title: str, rows: list[dict]):
+    print(f"== {title}")
+    if not rows:
+        return
+    keys = list(rows[0].keys())
+    print(" | ".join(f"{k:>14}" for k in keys))
+    for row in rows:
+        print(" | ".join(f"{v:>14.2f}" if isinstance(v, float) else f"{v!s:>14}" for v in row.values()))
+
+
+async def asgi_request(app, method: str, path: str, headers: dict | None = None, body: bytes = b"",
+                       chunk_size: int = 64 * 1024, query_string: str = "",
+                       on_body: Callable[[bytes], None] | None = None,
+                       background: set | None = None) -> tuple[int, dict, bytes]:
+    """Drives one request through an ASGI app in-process, the body arrives in chunk_size pieces
+    like it does from uvicorn. Returns (status, headers, body).
+    With on_body the response chunks are handed to it instead of being kept, the body returned is empty.
+    With background the call returns once the response is complete, like a client would see it, and the
+    app task still running its background tasks is added to the set."""
+    view, offset = memoryview(body), 0
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query_string.encode(),
+        "headers": [(k.lower().encode(), v.encode()) for k, v in (headers or {}).items()],
+        "client": ("127.0.0.1", 50000), "server": ("127.0.0.1", 8000),
+    }
+    response = {"status": None, "headers": {}, "body": []}
+
+    response_done = asyncio.Event()
+
+    async def receive():
+        nonlocal offset
+        if offset > len(body):
+            # like a server: the client only goes away once the response is complete
+            await response_done.wait()
+            return {"type": "http.disconnect"}
+        # sliced lazily, only the chunk in flight is copied
+        chunk = bytes(view[offset:offset + chunk_size])
+        offset += chunk_size
+        return {"type": "http.request", "body": chunk, "more_body": offset < len(body)}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+            response["headers"] = {k.decode(): v.decode() for k, v in message.get("headers", [])}
+        elif message["type"] == "http.response.body":
+            if on_body is not None:
+                on_body(message.get("body", b""))
+            else:
+                response["body"].append(message.get("body", b""))
+            if not message.get("more_body", False):
+                response_done.set()
+
+    if background is None:
+        await app(scope, receive, send)
+    else:
+        task = asyncio.ensure_future(app(scope, receive, send))
+        done_waiter = asyncio.ensure_future(response_done.wait())
+        await asyncio.wait([task, done_waiter], return_when=asyncio.FIRST_COMPLETED)
+        done_waiter.cancel()
+        if task.done():
+            task.result()
+        else:
+            background.add(task)
+            task.add_done_callback(background.discard)
+    return response["status"], response["headers"], b"".join(response["body"])
+
+
+class HttpClient:
+    """Minimal HTTP/1.1 keep-alive client for the out-of-process benchmarks: one connection, one request
+    at a time, content-length and chunked bodies. Same result as asgi_request."""
+
+    def __init__(self, host: str, port: int):
+        self.host = host
+        self.port = port
+        self._reader: asyncio.StreamReader | None = None
+        self._writer: asyncio.StreamWriter | None = None
+
+    async def request(self, method: str, path: str, headers: dict | None = None, body: bytes = b"",
+                      query_string: str = "") -> tuple[int, dict, bytes]:
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            return await self._exchange(method, path, headers or {}, body, query_string)
+        except BaseException:
+            await self.close()
+            raise
+
+    async def _exchange(self, method, path, headers, body, query_string) -> tuple[int, dict, bytes]:
+        target = f"{path}?{query_string}" if query_string else path
+        lines = [f"{method} {target} HTTP/1.1", f"host: {self.host}:{self.port}", f"content-length: {len(body)}"]
+        lines += [f"{name}: {value}" for name, value in headers.items() if name.lower() != "content-length"]
+        self._writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("connection closed by the server")
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while (line := await self._reader.readline()) not in (b"\r\n", b"\n", b""):
+            name, _, value = line.decode("latin-1").partition(":")
+            response_headers[name.strip().lower()] = value.strip()
+
+        if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+            response_body = b""
+        elif response_headers.get("transfer-encoding", "").lower() == "chunked":
+            chunks = []
+            while size := int((await self._reader.readline()).split(b";")[0], 16):
+                chunks.append(await self._reader.readexactly(size + 2))
+            while await self._reader.readline() not in (b"\r\n", b"\n", b""):  # trailers
+                pass
+            response_body = b"".join(chunk[:-2] for chunk in chunks)
+        elif "content-length" in response_headers:
+            response_body = await self._reader.readexactly(int(response_headers["content-length"]))
+        else:
+            response_body = await self._reader.read()
+            response_headers["connection"] = "close"
+        if response_headers.get("connection", "").lower() == "close":
+            await self.close()
+        return status, response_headers, response_body
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except OSError:
+                pass
+        self._reader = self._writer = None
+
+
+def multipart_body(field: str, filename: str, content: bytes, boundary: str = "benchboundary") -> tuple[dict, bytes]:
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"{field}\"; filename=\"{filename}\"\r\n"
+            f"Content-Type: application/octet-stream\r\n\r\n").encode() + content + f"\r\n--{boundary}--\r\n".encode()
+    return {"content-type": f"multipart/form-data; boundary={boundary}", "content-length": str(len(body))}, body
@@ -26,7 +26,7 @@ class InterceptHandler(logging.Handler):
             frame = frame.f_back
             depth += 1
 
-        log = logger.bind(request_id='app')
+        log = logger.bind(request_id=getattr(record, 'request_id', 'app'))
         log.opt(
             depth=depth,
             exception=record.exc_info
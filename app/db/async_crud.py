@@ -0,0 +1,235 @@
+from contextlib import nullcontext
+from typing import AsyncContextManager, AsyncIterator
+
+from fastapi.exceptions import HTTPException
+from fastapi import status
+from pydantic import ValidationError
+from sqlalchemy.engine import Row
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models.models import User, UserCreate, UserUpdate, MediaUser, MediaUserCreate, MediaBlob, UploadSession, \
+    UserRow, MediaUserRow
+from .hashing import password_hasher
+from .utils.bulk_import import IMPORT_BATCH_SIZE
+from .utils.deletion import deletion_worker
+from .utils.export import ExportFormat, stream_export
+from .utils.write_batch import write_batcher
+from . import crud
+
+# Async versions of the crud.py functions. The queries themselves are shared: run_sync executes the
+# sync function in a greenlet on top of the async driver, so the event loop is never blocked on the DB.
+# bcrypt is CPU bound and would stall the loop, so it runs on the hashing pool between the DB round trips.
+# The session is closed before it: a request waiting for bcrypt, or for its admission slot (the admission
+# argument, a limiter of api/admission.py), holds no pooled connection.
+# The writes go through write_batcher: in the session of the request, or group committed with the writes of
+# other requests when write coalescing is on (utils/write_batch.py).
+
+
+async def get_user_by_id(session: AsyncSession, user_id: int) -> User:
+    return await session.run_sync(crud.get_user_by_id, user_id)
+
+
+async def get_user_by_login(session: AsyncSession, login: str) -> User:
+    return await session.run_sync(crud.get_user_by_login, login)
+
+
+async def get_user_all(session: AsyncSession, limit: int = 100, offset: int = 0,
+                       after_id: int | None = None, with_media: bool = True) -> list[User]:
+    return await session.run_sync(crud.get_user_all, limit, offset, after_id, with_media)
+
+
+async def get_user_rows(session: AsyncSession, limit: int = 100, offset: int = 0,
+                        after_id: int | None = None, with_media: bool = True) -> list[UserRow]:
+    return await session.run_sync(crud.get_user_rows, limit, offset, after_id, with_media)
+
+
+async def get_user_by_email(session: AsyncSession, email: str) -> User:
+    return await session.run_sync(crud.get_user_by_email, email)
+
+
+async def search_users(session: AsyncSession, query: str, limit: int = 20, offset: int = 0,
+                       fuzzy: bool = False) -> list[User]:
+    return await session.run_sync(crud.search_users, query, limit, offset, fuzzy)
+
+
+async def add_user(session: AsyncSession, user_create: UserCreate,
+                   admission: AsyncContextManager = nullcontext()) -> User:
+    await session.run_sync(crud.check_user_create, user_create)
+    await session.close()
+    async with admission:
+        hash_pass = await password_hasher.hash(user_create.password)
+    return await write_batcher.run(session, crud.create_user, user_create, hash_pass)
+
+
+async def import_users(session: AsyncSession, rows: AsyncIterator[dict | str],
+                       batch_size: int = IMPORT_BATCH_SIZE) -> dict:
+    """Creates users from a stream of rows, batch_size rows at a time. A bad row is reported and skipped,
+    the other rows are still imported. Returns the counts and, for every row, the new id or the error."""
+    results, batch = [], []
+    seen_emails, seen_logins = set(), set()  # uniqueness inside the import itself
+    row_number = 0
+    async for row in rows:
+        row_number += 1
+        batch.append((row_number, row))
+        if len(batch) >= batch_size:
+            results += await _import_users_batch(session, batch, seen_emails, seen_logins)
+            batch = []
+    if batch:
+        results += await _import_users_batch(session, batch, seen_emails, seen_logins)
+    created = sum(1 for result in results if "id" in result)
+    return {"created": created, "failed": len(results) - created, "results": results}
+
+
+async def _import_users_batch(session: AsyncSession, batch: list[tuple[int, dict | str]],
+                              seen_emails: set[str], seen_logins: set[str]) -> list[dict]:
+    errors, candidates = {}, []
+    for row_number, row in batch:
+        if isinstance(row, str):
+            errors[row_number] = row
+            continue
+        try:
+            user_create = UserCreate(**row)
+        except ValidationError as ex:
+            errors[row_number] = "; ".join(f"{'.'.join(map(str, error['loc']))}: {error['msg']}"
+                                           for error in ex.errors())
+            continue
+        if not crud.has_required_user_fields(user_create):
+            errors[row_number] = crud.REQUIRED_USER_FIELDS
+        elif user_create.email in seen_emails:
+            errors[row_number] = "Email must be unique"
+        elif user_create.login in seen_logins:
+            errors[row_number] = "Login must be unique"
+        else:
+            seen_emails.add(user_create.email)
+            seen_logins.add(user_create.login)
+            candidates.append((row_number, user_create))
+
+    taken_emails, taken_logins = await session.run_sync(
+        crud.find_taken_users, [user_create.email for _, user_create in candidates],
+        [user_create.login for _, user_create in candidates])
+    await session.close()
+    new_users = []
+    for row_number, user_create in candidates:
+        if user_create.email in taken_emails:
+            errors[row_number] = "Email must be unique"
+        elif user_create.login in taken_logins:
+            errors[row_number] = "Login must be unique"
+        else:
+            new_users.append((row_number, user_create))
+
+    hashes = await password_hasher.hash_many([user_create.password for _, user_create in new_users])
+    ids = await session.run_sync(crud.insert_users, [
+        {**user_create.dict(exclude={"password"}), "hash_pass": hash_pass}
+        for (_, user_create), hash_pass in zip(new_users, hashes)])
+    await session.close()  # nor while the next rows arrive
+    created = {}
+    for row_number, user_create in new_users:
+        if user_create.email in ids:
+            created[row_number] = ids[user_create.email]
+        else:  # taken by a concurrent request after the check
+            errors[row_number] = "Email and login must be unique"
+    return [{"row": row_number, "id": created[row_number]} if row_number in created
+            else {"row": row_number, "error": errors[row_number]}
+            for row_number, _ in batch]
+
+
+async def update_user(session: AsyncSession, user_update: UserUpdate,
+                      admission: AsyncContextManager = nullcontext()) -> User:
+    db_user = await get_user_by_email(session, user_update.email)
+    if not db_user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Incorrect email")
+    await session.close()
+    async with admission:
+        if not await password_hasher.verify(user_update.old_password, db_user.hash_pass):
+            raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                                detail="Incorrect password")
+        hash_pass = await password_hasher.hash(user_update.password)
+    return await write_batcher.run(session, crud.apply_verified_user_update, db_user.id, db_user.hash_pass,
+                                   user_update, hash_pass)
+
+
+async def set_user_hash_pass(session: AsyncSession, db_user: User, hash_pass: str) -> User:
+    return await write_batcher.run(session, crud.set_user_hash_pass, db_user, hash_pass)
+
+
+async def delete_user_by_id(session: AsyncSession, user_id: int):
+    response = await write_batcher.run(session, crud.delete_user_by_id, user_id)
+    deletion_worker.wake()
+    return response
+
+
+async def get_media_user_by_media_id(session: AsyncSession, media_id: int) -> MediaUser:
+    return await session.run_sync(crud.get_media_user_by_media_id, media_id)
+
+
+async def get_medias_user_by_user_id(session: AsyncSession, user_id: int,
+                                     limit: int = 100, offset: int = 0,
+                                     after_id: int | None = None) -> list[MediaUser]:
+    return await session.run_sync(crud.get_medias_user_by_user_id, user_id, limit, offset, after_id)
+
+
+async def get_media_rows_by_user_id(session: AsyncSession, user_id: int, limit: int = 100, offset: int = 0,
+                                    after_id: int | None = None) -> list[MediaUserRow]:
+    return await session.run_sync(crud.get_media_rows_by_user_id, user_id, limit, offset, after_id)
+
+
+async def get_user_version(session: AsyncSession, user_id: int | None = None, email: str | None = None) -> Row:
+    return await session.run_sync(crud.get_user_version, user_id, email)
+
+
+async def get_users_version(session: AsyncSession, limit: int = 100, offset: int = 0,
+                            after_id: int | None = None, with_media: bool = True) -> Row:
+    return await session.run_sync(crud.get_users_version, limit, offset, after_id, with_media)
+
+
+async def get_medias_version(session: AsyncSession, user_id: int, limit: int = 100, offset: int = 0,
+                             after_id: int | None = None) -> Row:
+    return await session.run_sync(crud.get_medias_version, user_id, limit, offset, after_id)
+
+
+def export_users(session: AsyncSession, export_format: ExportFormat) -> AsyncIterator[bytes]:
+    return stream_export(session, crud.select_users_export(), export_format)
+
+
+def export_medias(session: AsyncSession, export_format: ExportFormat,
+                  user_id: int | None = None) -> AsyncIterator[bytes]:
+    return stream_export(session, crud.select_medias_export(user_id), export_format)
+
+
+async def get_media_blob(session: AsyncSession, sha256: str) -> MediaBlob:
+    return await session.run_sync(crud.get_media_blob, sha256)
+
+
+async def add_media_user(session: AsyncSession, media_user_create: MediaUserCreate, size: int = 0) -> MediaUser:
+    return await write_batcher.run(session, crud.add_media_user, media_user_create, size)
+
+
+async def add_uploaded_media_user(session: AsyncSession, media_user_create: MediaUserCreate, size: int,
+                                  upload_id: str, path_file: str) -> MediaUser:
+    return await write_batcher.run(session, crud.add_uploaded_media_user, media_user_create, size, upload_id,
+                                   path_file)
+
+
+async def set_media_derivatives(session: AsyncSession, media_path: str, derivatives: list[str]):
+    return await write_batcher.run(session, crud.set_media_derivatives, media_path, derivatives)
+
+
+async def delete_media_user(session: AsyncSession, media_id: int):
+    response = await write_batcher.run(session, crud.delete_media_user, media_id)
+    deletion_worker.wake()
+    return response
+
+
+async def create_upload_session(session: AsyncSession, user_id: int, ext: str, size: int) -> UploadSession:
+    return await write_batcher.run(session, crud.create_upload_session, user_id, ext, size)
+
+
+async def get_upload_session(session: AsyncSession, upload_id: str) -> UploadSession:
+    return await session.run_sync(crud.get_upload_session, upload_id)
+
+
+async def delete_upload_sessions(session: AsyncSession, upload_ids: list[str], path_files: list[str] = ()):
+    await write_batcher.run(session, crud.delete_upload_sessions, upload_ids, list(path_files))
+    if path_files:
+        deletion_worker.wake()
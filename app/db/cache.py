@@ -0,0 +1,87 @@
+import datetime
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from models.models import User
+
+TOKEN_CACHE_SIZE = int(os.environ.get("TOKEN_CACHE_SIZE", 10_000))
+# Worker processes serving the application, exported by serve.py to its workers
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", 1))
+# Upper bound of an entry lifetime. The invalidations only reach the cache of the process that made the change:
+# in the other workers a changed or deleted user is still served from the cache until the entry expires, so the
+# TTL is the staleness bound of the authentication. Short by default when several workers share the DB.
+TOKEN_CACHE_TTL = float(os.environ.get("TOKEN_CACHE_TTL", 60 if WEB_CONCURRENCY <= 1 else 5))
+
+
+class TokenCache:
+    """LRU cache of verified bearer tokens: token -> (decoded claims, user principal).
+
+    An entry lives until the token expires or ttl seconds pass, whichever comes first.
+    crud invalidates the entries of a user when the user or their media change, in this process only:
+    the other processes see the change when their entries expire, see TOKEN_CACHE_TTL.
+    """
+
+    def __init__(self, max_size: int = TOKEN_CACHE_SIZE, ttl: float = TOKEN_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries: OrderedDict[str, tuple[float, dict, User]] = OrderedDict()
+        self._tokens_by_email: dict[str, set[str]] = {}
+        # the sync crud functions invalidate from threadpool workers
+        self._lock = threading.Lock()
+
+    def get(self, token: str) -> tuple[dict, User] | None:
+        with self._lock:
+            entry = self._entries.get(token)
+            if entry is None or entry[0] <= time.monotonic():
+                if entry is not None:
+                    self._pop(token)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(token)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def set(self, token: str, claims: dict, user: User, expiration_date: datetime.datetime):
+        lifetime = min(self.ttl, (expiration_date - datetime.datetime.utcnow()).total_seconds())
+        if lifetime <= 0 or self.max_size <= 0:
+            return
+        with self._lock:
+            self._pop(token)
+            self._entries[token] = (time.monotonic() + lifetime, claims, user)
+            self._tokens_by_email.setdefault(user.email, set()).add(token)
+            while len(self._entries) > self.max_size:
+                self._pop(next(iter(self._entries)))
+
+    def invalidate_user(self, email: str):
+        with self._lock:
+            tokens = self._tokens_by_email.pop(email, set())
+            for token in tokens:
+                self._entries.pop(token, None)
+            self.invalidations += len(tokens)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tokens_by_email.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"size": len(self._entries), "hits": self.hits, "misses": self.misses,
+                    "invalidations": self.invalidations}
+
+    def _pop(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is not None:
+            tokens = self._tokens_by_email.get(entry[2].email)
+            if tokens is not None:
+                tokens.discard(token)
+                if not tokens:
+                    del self._tokens_by_email[entry[2].email]
+
+
+token_cache = TokenCache()
@@ -0,0 +1,151 @@
+import os
+from typing import Union
+
+from pydantic import BaseSettings
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
+from sqlalchemy.pool import QueuePool, AsyncAdaptedQueuePool, NullPool
+
+from .utils.metrics import instrument_engine
+
+# Engine profiles. The profile is picked by DB_PROFILE (dev by default), every field of EngineSettings
+# can then be overridden one by one with a DB_<FIELD> environment variable or a .env file,
+# e.g. DB_PROFILE=prod DB_URL=sqlite:////var/lib/weimfa/sql_app.db DB_POOL_SIZE=20
+PROFILES = {
+    "dev": {
+        "url": "sqlite:///sql_app.db",
+        "echo": True,
+    },
+    "test": {
+        "url": "sqlite:///test_sql_app.db",
+        "sqlite_synchronous": "OFF",
+    },
+    "prod": {
+        "url": "sqlite:///sql_app.db",
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_recycle": 3600,
+        "sqlite_mmap_size": 256 * 1024 * 1024,
+        "sqlite_cache_size": -64 * 1024,
+    },
+}
+DEFAULT_PROFILE = "dev"
+
+ASYNC_DRIVERS = {
+    "sqlite": "sqlite+aiosqlite",
+    "postgresql": "postgresql+asyncpg",
+    "mysql": "mysql+aiomysql",
+}
+
+
+class EngineSettings(BaseSettings):
+    url: str = "sqlite:///sql_app.db"
+    async_url: str | None = None  # derived from url when not set
+    # Pool of the read-only sessions (database.get_async_read_session): a replica URL, or for a SQLite file
+    # the same file through read-only connections when not set. "primary" makes the reads share the writes pool
+    read_url: str | None = None
+    read_pool_size: int | None = None  # pool_size when not set
+    echo: Union[bool, str] = False  # True logs statements, "debug" logs result rows too
+    pool_size: int = 5  # 0 disables pooling
+    max_overflow: int = 10
+    pool_recycle: int = -1
+    pool_timeout: int = 30
+    sqlite_journal_mode: str = "WAL"
+    sqlite_synchronous: str = "NORMAL"
+    sqlite_mmap_size: int = 0
+    sqlite_cache_size: int = -2000  # negative values are KiB, positive values are pages
+    sqlite_busy_timeout: int = 5000  # ms
+
+    class Config:
+        env_prefix = "DB_"
+        env_file = ".env"
+
+        @classmethod
+        def customise_sources(cls, init_settings, env_settings, file_secret_settings):
+            # profile values are passed as init kwargs, the environment has to win over them
+            return env_settings, init_settings, file_secret_settings
+
+    @property
+    def is_sqlite(self) -> bool:
+        return make_url(self.url).get_backend_name() == "sqlite"
+
+    def get_async_url(self) -> str:
+        if self.async_url:
+            return self.async_url
+        url = make_url(self.url)
+        return str(url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername)))
+
+    def get_read_url(self) -> str | None:
+        """URL of the read-only pool, None when the reads go to the primary"""
+        if self.read_url:
+            return None if self.read_url == "primary" else self.read_url
+        url = make_url(self.url)
+        if not self.is_sqlite or url.database in (None, "", ":memory:") or url.database.startswith("file:"):
+            return None
+        return str(url.set(database=f"file:{url.database}", query={**url.query, "mode": "ro", "uri": "true"}))
+
+    @property
+    def has_read_pool(self) -> bool:
+        return self.get_read_url() is not None
+
+    def for_reads(self) -> "EngineSettings":
+        """The settings of the read-only pool"""
+        url = make_url(self.get_read_url())
+        return self.copy(update={
+            "url": str(url), "read_url": "primary",
+            "async_url": str(url.set(drivername=ASYNC_DRIVERS.get(url.get_backend_name(), url.drivername))),
+            "pool_size": self.pool_size if self.read_pool_size is None else self.read_pool_size})
+
+
+def get_settings(profile: str | None = None) -> EngineSettings:
+    profile = profile or os.environ.get("DB_PROFILE", DEFAULT_PROFILE)
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown DB profile {profile!r}, expected one of {', '.join(PROFILES)}")
+    return EngineSettings(**PROFILES[profile])
+
+
+def _engine_kwargs(settings: EngineSettings, pool_class) -> dict:
+    kwargs = {"echo": settings.echo}
+    if settings.is_sqlite:
+        kwargs["connect_args"] = {"check_same_thread": False}
+    if settings.pool_size > 0:
+        kwargs.update(poolclass=pool_class, pool_size=settings.pool_size, max_overflow=settings.max_overflow,
+                      pool_recycle=settings.pool_recycle, pool_timeout=settings.pool_timeout)
+    else:
+        kwargs["poolclass"] = NullPool
+    return kwargs
+
+
+def set_sqlite_pragmas(engine: Engine, settings: EngineSettings, read_only: bool = False):
+    @event.listens_for(engine, "connect")
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        # busy_timeout first: switching the journal mode needs the write lock
+        cursor.execute(f"PRAGMA busy_timeout={int(settings.sqlite_busy_timeout)}")
+        if read_only:
+            # the journal mode is the one the primary set, a read-only connection can not change it
+            cursor.execute("PRAGMA query_only=1")
+        else:
+            cursor.execute(f"PRAGMA journal_mode={settings.sqlite_journal_mode}")
+            cursor.execute(f"PRAGMA synchronous={settings.sqlite_synchronous}")
+        cursor.execute(f"PRAGMA mmap_size={int(settings.sqlite_mmap_size)}")
+        cursor.execute(f"PRAGMA cache_size={int(settings.sqlite_cache_size)}")
+        cursor.close()
+
+
+def build_engine(settings: EngineSettings) -> Engine:
+    engine = create_engine(settings.url, **_engine_kwargs(settings, QueuePool))
+    if settings.is_sqlite:
+        set_sqlite_pragmas(engine, settings)
+    instrument_engine(engine)
+    return engine
+
+
+def build_async_engine(settings: EngineSettings, read_only: bool = False) -> AsyncEngine:
+    """With read_only, the engine of the read-only pool (settings.for_reads())"""
+    async_engine = create_async_engine(settings.get_async_url(), **_engine_kwargs(settings, AsyncAdaptedQueuePool))
+    if settings.is_sqlite:
+        set_sqlite_pragmas(async_engine.sync_engine, settings, read_only)
+    instrument_engine(async_engine.sync_engine)
+    return async_engine
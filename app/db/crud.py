@@ -1,51 +1,201 @@
-import os
+import re
+from collections import Counter
+from typing import Callable
 
 from sqlmodel import Session, select
+from sqlalchemy import update, delete, table, column, literal_column, text, func, distinct, cast, String
+from sqlalchemy.engine import Row
+from sqlalchemy.sql import Select, Subquery
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import selectinload, raiseload
 from fastapi.exceptions import HTTPException
 from fastapi.responses import JSONResponse
 from fastapi import status
 
-from models.models import User, UserCreate, Privileges, UserUpdate, MediaUser, MediaUserCreate
+from models.models import User, UserCreate, Privileges, UserUpdate, MediaUser, MediaUserCreate, MediaBlob, \
+    FileTombstone, ChangeMark, UploadSession, UserRow, MediaRow, MediaUserRow
 from .secret import get_password_hash, verify_password
+from .cache import token_cache
+from .utils.derivatives import derivative_paths, original_path
 
 from datetime import datetime
 
 
+def invalidate_cached_user(session: Session, email: str):
+    """Drops the cached principals of a user after a committed change. Under group commit (write_batch.py)
+    the commit of the crud function is not the final one: the batch invalidates them again after it."""
+    token_cache.invalidate_user(email)
+    session.info.setdefault("invalidated_users", set()).add(email)
+
+
+# Relationships are loaded eagerly: responses are serialized after the session work is done,
+# and an AsyncSession (see async_crud.py) can not lazy load there
 def get_user_by_id(session: Session, user_id: int) -> User:
-    return session.exec(select(User).where(User.id == user_id)).first()
+    return session.exec(select(User).where(User.id == user_id).options(selectinload(User.media))).first()
 
 
 def get_user_by_login(session: Session, login: str) -> User:
     return session.exec(select(User).where(User.login == login)).first()
 
 
-def get_user_all(session: Session, limit: int = 100, offset: int = 0) -> list[User]:
-    return session.exec(select(User).limit(limit).offset(offset)).all()
+def get_user_all(session: Session, limit: int = 100, offset: int = 0, after_id: int | None = None,
+                 with_media: bool = True) -> list[User]:
+    # after_id switches to keyset pagination: the page starts right after the given primary key,
+    # so deep pages cost the same as the first one instead of scanning `offset` rows.
+    # Without media the relationship is not loaded at all, and touching it raises instead of querying per user
+    media_loader = selectinload(User.media) if with_media else raiseload(User.media)
+    statement = select(User).options(media_loader).order_by(User.id).limit(limit)
+    if after_id is not None:
+        return session.exec(statement.where(User.id > after_id)).all()
+    return session.exec(statement.offset(offset)).all()
+
+
+# Column projections of the read model: Core selects of the response columns, the rows are built straight
+# from the result tuples, the ORM never sees them
+USER_ROW_COLUMNS = [User.__table__.c[name] for name in UserRow._fields if name != "media"]
+MEDIA_ROW_COLUMNS = [MediaUser.__table__.c[name] for name in MediaRow._fields]
+MEDIA_USER_ROW_COLUMNS = [MediaUser.__table__.c[name] for name in MediaUserRow._fields if name != "user"]
+
+
+def get_user_rows(session: Session, limit: int = 100, offset: int = 0, after_id: int | None = None,
+                  with_media: bool = True) -> list[UserRow]:
+    """get_user_all as UserRow, the media in a second query like selectinload"""
+    statement = select(*USER_ROW_COLUMNS).order_by(User.__table__.c.id).limit(limit)
+    if after_id is not None:
+        statement = statement.where(User.__table__.c.id > after_id)
+    else:
+        statement = statement.offset(offset)
+    rows = session.execute(statement).all()
+    if not with_media:
+        return [UserRow(*row) for row in rows]
+    medias = {row.id: [] for row in rows}
+    if medias:
+        for media in session.execute(select(*MEDIA_ROW_COLUMNS).where(MediaUser.__table__.c.user_id.in_(medias))
+                                     .order_by(MediaUser.__table__.c.id)).all():
+            medias[media.user_id].append(MediaRow(*media))
+    return [UserRow(*row, medias[row.id]) for row in rows]
 
 
 def get_user_by_email(session: Session, email: str) -> User:
-    return session.exec(select(User).where(User.email == email)).first()
+    return session.exec(select(User).where(User.email == email).options(selectinload(User.media))).first()
 
 
-def add_user(session: Session, user_create: UserCreate) -> User:
-    if not (user_create.login and user_create.email and user_create.full_name and user_create.password):
+# User search over the full text indexes of migration 4. Every word of the query must match, in any of login,
+# email and full name, results best first (bm25, a login match weighs more than a name match, than an email one).
+# Prefix: the words are word prefixes, "ann sm" finds "Anna Smith". Fuzzy: the words of 3 characters and more
+# may be anywhere inside a word, "mith" finds "Smith" too; shorter words stay prefixes.
+# A quoted word goes through the tokenizer as a phrase, so "anna.smith@mail" matches the email as written.
+users_fts = table("users_fts", column("rowid"))
+users_trigram = table("users_trigram", column("rowid"))
+SEARCH_WEIGHTS = "10.0, 2.0, 5.0"  # login, email, full_name
+_SEARCH_WORD = re.compile(r"\w")
+TRIGRAM_MIN_LENGTH = 3
+
+
+def _match_expression(words: list[str], prefix: bool) -> str:
+    return " ".join('"{}"{}'.format(word.replace('"', '""'), "*" if prefix else "") for word in words)
+
+
+def search_users(session: Session, query: str, limit: int = 20, offset: int = 0, fuzzy: bool = False) -> list[User]:
+    words = [word for word in query.split() if _SEARCH_WORD.search(word)]
+    substrings = [word for word in words if fuzzy and len(word) >= TRIGRAM_MIN_LENGTH]
+    prefixes = [word for word in words if word not in substrings]
+    if not words:
+        return []
+    index = users_trigram if substrings else users_fts
+    statement = (select(User).join(index, index.c.rowid == User.id).options(raiseload(User.media))
+                 .order_by(text(f"bm25({index.name}, {SEARCH_WEIGHTS})"), User.id).limit(limit).offset(offset))
+    if substrings:
+        statement = statement.where(literal_column(index.name).op("MATCH")(_match_expression(substrings, False)))
+        if prefixes:
+            statement = statement.where(User.id.in_(
+                select(users_fts.c.rowid).where(literal_column("users_fts").op("MATCH")(
+                    _match_expression(prefixes, True)))))
+    else:
+        statement = statement.where(literal_column(index.name).op("MATCH")(_match_expression(prefixes, True)))
+    return session.exec(statement).all()
+
+
+REQUIRED_USER_FIELDS = "Required fields: login, email, full name, password"
+
+
+def has_required_user_fields(user_create: UserCreate) -> bool:
+    return bool(user_create.login and user_create.email and user_create.full_name and user_create.password)
+
+
+def check_user_create(session: Session, user_create: UserCreate):
+    if not has_required_user_fields(user_create):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
-                            detail="Required fields: login, email, full name, password")
+                            detail=REQUIRED_USER_FIELDS)
     if get_user_by_email(session, user_create.email):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail="Email must be unique")
     if get_user_by_login(session, user_create.login):
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail="Login must be unique")
+
+
+def create_user(session: Session, user_create: UserCreate, hash_pass: str) -> User:
     db_user = User(**user_create.dict())
-    db_user.hash_pass = get_password_hash(user_create.password)
+    db_user.hash_pass = hash_pass
     db_user.privileges = Privileges.user
     db_user.is_active = True
     db_user.updated_at = None
     session.add(db_user)
     session.commit()
-    session.refresh(db_user)
-    return db_user
+    return get_user_by_id(session, db_user.id)
+
+
+def add_user(session: Session, user_create: UserCreate) -> User:
+    check_user_create(session, user_create)
+    return create_user(session, user_create, get_password_hash(user_create.password))
+
+
+def find_taken_users(session: Session, emails: list[str], logins: list[str]) -> tuple[set[str], set[str]]:
+    """Emails and logins among the given ones that already belong to a user, one IN query each"""
+    taken_emails = set(session.exec(select(User.email).where(User.email.in_(emails))).all()) if emails else set()
+    taken_logins = set(session.exec(select(User.login).where(User.login.in_(logins))).all()) if logins else set()
+    return taken_emails, taken_logins
+
+
+# 9 bound values per user row, under the 32766 variables SQLite accepts in a statement
+INSERT_ROWS_PER_STATEMENT = 1000
+
+
+def insert_users(session: Session, users: list[dict]) -> dict[str, int]:
+    """Inserts a batch of users (User columns, hash_pass set) with a single executemany and one commit.
+
+    Returns email -> id of the inserted users. When a concurrent request took an email or a login in the meantime,
+    the batch is inserted again row by row, each in a savepoint: the conflicting rows are missing from the result.
+    The rows go as multi-row INSERTs rather than an executemany: the search index triggers (migration 4)
+    flush the full text index at the end of every statement, once per row with an executemany.
+    """
+    rows = [{**user, "privileges": Privileges.user, "is_active": True, "updated_at": None,
+             "created_at": datetime.now().isoformat()} for user in users]
+    try:
+        _insert_user_rows(session, rows)
+        session.commit()
+    except IntegrityError:
+        session.rollback()
+        inserted = []
+        for row in rows:
+            try:
+                with session.begin_nested():
+                    _insert_user_rows(session, [row])
+            except IntegrityError:
+                continue
+            inserted.append(row)
+        session.commit()
+        rows = inserted
+    emails = [row["email"] for row in rows]
+    if not emails:
+        return {}
+    return dict(session.exec(select(User.email, User.id).where(User.email.in_(emails))).all())
+
+
+def _insert_user_rows(session: Session, rows: list[dict], rows_per_statement: int = INSERT_ROWS_PER_STATEMENT):
+    for start in range(0, len(rows), rows_per_statement):
+        session.execute(User.__table__.insert().values(rows[start:start + rows_per_statement]))
 
 
 def update_user(session: Session, user_update: UserUpdate) -> User:
@@ -56,17 +206,40 @@ def update_user(session: Session, user_update: UserUpdate) -> User:
     if not verify_password(user_update.old_password, db_user.hash_pass):
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect password")
-    user_update_data = user_update.dict(exclude_unset=True)
+    return apply_user_update(session, db_user, user_update, get_password_hash(user_update.password))
+
+
+def apply_user_update(session: Session, db_user: User, user_update: UserUpdate, hash_pass: str) -> User:
+    user_update_data = user_update.dict(exclude_unset=True, exclude={"password", "old_password"})
     for key, value in user_update_data.items():
-        try:
-            setattr(db_user, key, value)
-        except ValueError as ve:
-            if key == "password":
-                db_user.hash_pass = get_password_hash(value)
+        setattr(db_user, key, value)
+    db_user.hash_pass = hash_pass
     db_user.updated_at = datetime.now().isoformat()
     session.add(db_user)
     session.commit()
-    session.refresh(db_user)
+    invalidate_cached_user(session, db_user.email)
+    return get_user_by_id(session, db_user.id)
+
+
+def apply_verified_user_update(session: Session, user_id: int, verified_hash: str, user_update: UserUpdate,
+                               hash_pass: str) -> User:
+    """apply_user_update of a user whose old password was checked against verified_hash in an earlier
+    transaction: the user is read again, and refused when deleted or when the password changed since"""
+    db_user = get_user_by_id(session, user_id)
+    if not db_user:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Incorrect email")
+    if db_user.hash_pass != verified_hash:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
+                            detail="Incorrect password")
+    return apply_user_update(session, db_user, user_update, hash_pass)
+
+
+def set_user_hash_pass(session: Session, db_user: User, hash_pass: str) -> User:
+    # rehash with the current bcrypt cost, not a change of the user data: updated_at stays as is
+    db_user.hash_pass = hash_pass
+    session.add(db_user)
+    session.commit()
     return db_user
 
 
@@ -75,46 +248,257 @@ def delete_user_by_id(session: Session, user_id: int):
     if not db_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect user_id")
-    path_files = [media.media_path for media in db_user.media]
-    remove_files(path_files)
+    add_file_tombstones(session, release_media(session, db_user.media))
     session.delete(db_user)
     session.commit()
+    invalidate_cached_user(session, db_user.email)
     return JSONResponse({'ok': True})
 
 
 def get_media_user_by_media_id(session: Session, media_id: int) -> MediaUser:
-    return session.exec(select(MediaUser).where(MediaUser.id == media_id)).first()
+    return session.exec(select(MediaUser).where(MediaUser.id == media_id)
+                        .options(selectinload(MediaUser.user))).first()
+
+
+def get_medias_user_by_user_id(session: Session, user_id: int, limit: int = 100, offset: int = 0,
+                               after_id: int | None = None) -> list[MediaUser]:
+    statement = (select(MediaUser).where(MediaUser.user_id == user_id)
+                 .options(selectinload(MediaUser.user)).order_by(MediaUser.id).limit(limit))
+    if after_id is not None:
+        return session.exec(statement.where(MediaUser.id > after_id)).all()
+    return session.exec(statement.offset(offset)).all()
+
+
+def get_media_rows_by_user_id(session: Session, user_id: int, limit: int = 100, offset: int = 0,
+                              after_id: int | None = None) -> list[MediaUserRow]:
+    """get_medias_user_by_user_id as MediaUserRow. Every media of the page has the same user: it is read once,
+    with the page, and shared by the rows"""
+    statement = select(*MEDIA_USER_ROW_COLUMNS).where(MediaUser.__table__.c.user_id == user_id) \
+        .order_by(MediaUser.__table__.c.id).limit(limit)
+    if after_id is not None:
+        statement = statement.where(MediaUser.__table__.c.id > after_id)
+    else:
+        statement = statement.offset(offset)
+    medias = session.execute(statement).all()
+    if not medias:
+        return []
+    user = session.execute(select(*USER_ROW_COLUMNS).where(User.__table__.c.id == user_id)).first()
+    user = UserRow(*user) if user is not None else None
+    return [MediaUserRow(*media, user) for media in medias]
 
 
-def get_medias_user_by_user_id(session: Session, user_id: int, limit: int = 100, offset: int = 0) -> list[MediaUser]:
-    return session.exec(select(MediaUser).where(MediaUser.user_id == user_id).limit(limit).offset(offset)).all()
+# Versions of the read responses, for their ETag and Last-Modified (api/conditional.py): which rows the response
+# holds and when they last changed, from the indexes and a few aggregates, without loading the ORM objects.
+# A single row with the label changed_at, the latest created_at / updated_at / change mark.
+USERS_CHANGE_SCOPE = "users"
+MEDIA_CHANGE_SCOPE = "media_users:"
 
 
-def add_media_user(session: Session, media_user_create: MediaUserCreate) -> MediaUser:
+def _latest(*columns):
+    # scalar max() of SQLite over the columns, inside the aggregate max() over the rows
+    return func.max(func.max(*(func.coalesce(column, "") for column in columns))).label("changed_at")
+
+
+def _users_version(session: Session, page: Subquery, with_media: bool, with_deletions: bool) -> Row:
+    columns = [func.count(distinct(page.c.id)), func.min(page.c.id), func.max(page.c.id)]
+    changes = [page.c.created_at, page.c.updated_at]
+    source = page
+    if with_media:
+        columns += [func.count(MediaUser.id), func.max(MediaUser.id)]
+        changes += [MediaUser.created_at, ChangeMark.changed_at]
+        source = (page.outerjoin(MediaUser, MediaUser.user_id == page.c.id)
+                  .outerjoin(ChangeMark, ChangeMark.scope == MEDIA_CHANGE_SCOPE + cast(page.c.id, String)))
+    if with_deletions:
+        changes.append(select(ChangeMark.changed_at).where(ChangeMark.scope == USERS_CHANGE_SCOPE).scalar_subquery())
+    return session.execute(select(*columns, _latest(*changes)).select_from(source)).one()
+
+
+def get_user_version(session: Session, user_id: int | None = None, email: str | None = None) -> Row:
+    """Version of get_user_by_id / get_user_by_email"""
+    condition = User.id == user_id if email is None else User.email == email
+    page = select(User.id, User.created_at, User.updated_at).where(condition).subquery()
+    return _users_version(session, page, with_media=True, with_deletions=False)
+
+
+def get_users_version(session: Session, limit: int = 100, offset: int = 0, after_id: int | None = None,
+                      with_media: bool = True) -> Row:
+    """Version of get_user_all, same arguments"""
+    page = select(User.id, User.created_at, User.updated_at).order_by(User.id).limit(limit)
+    page = page.where(User.id > after_id) if after_id is not None else page.offset(offset)
+    return _users_version(session, page.subquery(), with_media, with_deletions=True)
+
+
+def get_medias_version(session: Session, user_id: int, limit: int = 100, offset: int = 0,
+                       after_id: int | None = None) -> Row:
+    """Version of get_medias_user_by_user_id, same arguments. Every media embeds its user"""
+    page = select(MediaUser.id, MediaUser.created_at).where(MediaUser.user_id == user_id).order_by(MediaUser.id) \
+        .limit(limit)
+    page = (page.where(MediaUser.id > after_id) if after_id is not None else page.offset(offset)).subquery()
+    owner = select(func.coalesce(User.updated_at, User.created_at)).where(User.id == user_id).scalar_subquery()
+    mark = select(ChangeMark.changed_at).where(ChangeMark.scope == f"{MEDIA_CHANGE_SCOPE}{user_id}").scalar_subquery()
+    return session.execute(select(func.count(page.c.id), func.min(page.c.id), func.max(page.c.id),
+                                  _latest(page.c.created_at, owner, mark))).one()
+
+
+# Exports: plain column selects, streamed by db/utils/export.py without building ORM objects
+
+def select_users_export() -> Select:
+    return select(User.id, User.login, User.email, User.full_name, User.privileges, User.is_active,
+                  User.created_at, User.updated_at).order_by(User.id)
+
+
+def select_medias_export(user_id: int | None = None) -> Select:
+    statement = select(MediaUser.id, MediaUser.user_id, MediaUser.media_path, MediaUser.sha256,
+                       MediaUser.derivatives, MediaUser.created_at).order_by(MediaUser.id)
+    return statement if user_id is None else statement.where(MediaUser.user_id == user_id)
+
+
+def get_media_blob(session: Session, sha256: str) -> MediaBlob:
+    return session.get(MediaBlob, sha256)
+
+
+def acquire_media_blob(session: Session, sha256: str, path: str, size: int) -> MediaBlob:
+    # counts are changed by the DB, concurrent uploads of the same content do not lose references
+    result = session.execute(update(MediaBlob).where(MediaBlob.sha256 == sha256)
+                             .values(ref_count=MediaBlob.ref_count + 1))
+    if result.rowcount:
+        return session.get(MediaBlob, sha256, populate_existing=True)
+    db_blob = MediaBlob(sha256=sha256, path=path, size=size, ref_count=1)
+    session.add(db_blob)
+    return db_blob
+
+
+def release_media(session: Session, medias: list[MediaUser]) -> list[str]:
+    """Drops one blob reference per media and returns the files nobody references anymore"""
+    path_files = []
+    for media in medias:
+        if media.sha256 is None:  # stored before the blob store
+            path_files.extend([media.media_path, *derivative_paths(media.media_path)])
+    for sha256, count in Counter(media.sha256 for media in medias if media.sha256 is not None).items():
+        session.execute(update(MediaBlob).where(MediaBlob.sha256 == sha256)
+                        .values(ref_count=MediaBlob.ref_count - count))
+        db_blob = session.get(MediaBlob, sha256, populate_existing=True)
+        if db_blob and db_blob.ref_count <= 0:
+            path_files.extend([db_blob.path, *derivative_paths(db_blob.path)])
+            session.delete(db_blob)
+    return path_files
+
+
+def add_media_user(session: Session, media_user_create: MediaUserCreate, size: int = 0) -> MediaUser:
+    return _add_media_user(session, media_user_create, size)
+
+
+def add_uploaded_media_user(session: Session, media_user_create: MediaUserCreate, size: int, upload_id: str,
+                            path_file: str) -> MediaUser:
+    """add_media_user of a finalized upload: the upload session is dropped, and its part file path_file
+    tombstoned, in the transaction of the insert. A failed insert leaves the upload as it was, and an upload
+    a concurrent finalize already dropped rolls the insert back."""
+    def drop_upload():
+        result = session.execute(delete(UploadSession).where(UploadSession.id == upload_id))
+        if not result.rowcount:
+            session.rollback()
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                                detail="Unknown upload")
+        add_file_tombstones(session, [path_file])
+    return _add_media_user(session, media_user_create, size, drop_upload)
+
+
+def _add_media_user(session: Session, media_user_create: MediaUserCreate, size: int,
+                    before_commit: Callable[[], None] | None = None) -> MediaUser:
     db_user = get_user_by_id(session, media_user_create.user_id)
     if not db_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect user_id")
+    try:
+        db_media_user = _insert_media_user(session, media_user_create, size, before_commit)
+    except IntegrityError:
+        # a concurrent upload of the same content created the blob first, the retry takes a reference on it
+        session.rollback()
+        db_media_user = _insert_media_user(session, media_user_create, size, before_commit)
+    invalidate_cached_user(session, db_user.email)  # the cached principal embeds the media list
+    return get_media_user_by_media_id(session, db_media_user.id)
+
+
+def _insert_media_user(session: Session, media_user_create: MediaUserCreate, size: int,
+                       before_commit: Callable[[], None] | None = None) -> MediaUser:
     db_media_user = MediaUser(**media_user_create.dict())
+    if media_user_create.sha256:
+        db_media_user.media_path = acquire_media_blob(session, media_user_create.sha256,
+                                                      media_user_create.media_path, size).path
     session.add(db_media_user)
+    if before_commit is not None:
+        before_commit()
     session.commit()
-    session.refresh(db_media_user)
     return db_media_user
 
 
+def set_media_derivatives(session: Session, media_path: str, derivatives: list[str]):
+    # every media sharing the stored file gets them
+    session.execute(update(MediaUser).where(MediaUser.media_path == media_path)
+                    .values(derivatives=",".join(derivatives) or None))
+    session.commit()
+
+
 def delete_media_user(session: Session, media_id: int):
     db_media_user = get_media_user_by_media_id(session, media_id)
     if not db_media_user:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED,
                             detail="Incorrect media_id")
-    remove_files(db_media_user.media_path)
+    add_file_tombstones(session, release_media(session, [db_media_user]))
     session.delete(db_media_user)
     session.commit()
+    if db_media_user.user:
+        invalidate_cached_user(session, db_media_user.user.email)
     return JSONResponse({'ok': True})
 
 
-def remove_files(path_files: str | list[str]):
-    path_files = [path_files] if isinstance(path_files, str) else path_files
-    for path_file in path_files:
-        if os.path.exists(path_file):
-            os.remove(path_file)
+def create_upload_session(session: Session, user_id: int, ext: str, size: int) -> UploadSession:
+    db_upload = UploadSession(user_id=user_id, ext=ext, size=size)
+    session.add(db_upload)
+    session.commit()
+    return db_upload
+
+
+def get_upload_session(session: Session, upload_id: str) -> UploadSession:
+    return session.get(UploadSession, upload_id)
+
+
+def get_upload_sessions_created_before(session: Session, created_before: str) -> list[UploadSession]:
+    return session.exec(select(UploadSession).where(UploadSession.created_at < created_before)).all()
+
+
+def delete_upload_sessions(session: Session, upload_ids: list[str], path_files: list[str] = ()):
+    """Drops the sessions, path_files are their part files still on disk"""
+    session.execute(delete(UploadSession).where(UploadSession.id.in_(upload_ids)))
+    add_file_tombstones(session, list(path_files))
+    session.commit()
+
+
+# Files are never removed in the request: the tombstones are committed with the rows deletion,
+# db/utils/deletion.py removes the files afterwards
+
+def add_file_tombstones(session: Session, path_files: list[str]):
+    # no commit: the tombstones belong to the caller transaction
+    session.add_all([FileTombstone(path=path_file) for path_file in path_files])
+
+
+def get_file_tombstones(session: Session, limit: int) -> list[FileTombstone]:
+    return session.exec(select(FileTombstone).order_by(FileTombstone.id).limit(limit)).all()
+
+
+def delete_file_tombstones(session: Session, tombstone_ids: list[int]):
+    session.execute(delete(FileTombstone).where(FileTombstone.id.in_(tombstone_ids)))
+    session.commit()
+
+
+def get_referenced_paths(session: Session, path_files: list[str]) -> set[str]:
+    """The given files (derivatives through their original) still used by a media, e.g. content uploaded again"""
+    originals = list({original_path(path_file) for path_file in path_files})
+    referenced = set(session.exec(select(MediaBlob.path).where(MediaBlob.path.in_(originals))).all())
+    referenced.update(session.exec(select(MediaUser.media_path).where(MediaUser.media_path.in_(originals))).all())
+    return {path_file for path_file in path_files if original_path(path_file) in referenced}
+
+
+def get_stored_media_paths(session: Session) -> set[str]:
+    return (set(session.exec(select(MediaBlob.path)).all())
+            | set(session.exec(select(MediaUser.media_path).distinct()).all()))
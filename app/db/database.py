@@ -1,20 +1,55 @@
-from sqlmodel import SQLModel, create_engine, Session
+from typing import Callable
+
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel.sql.expression import Select, SelectOfScalar
 
+from .config import get_settings, build_engine, build_async_engine
+from .migrations import upgrade
+
 
 SelectOfScalar.inherit_cache = True  # type: ignore
 Select.inherit_cache = True  # type: ignore
 
-SQL_ALCHEMY_DATABASE_URL = "sqlite:///sql_app.db"
+settings = get_settings()
 
-engine = create_engine(
-    SQL_ALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}, echo="debug")
+engine = build_engine(settings)
+async_engine = build_async_engine(settings)
+# Read-only pool of the GET routes, so they never wait behind the writes for a connection. Without a read
+# pool (an in-memory DB, DB_READ_URL=primary) the reads use the primary engine.
+async_read_engine = build_async_engine(settings.for_reads(), read_only=True) if settings.has_read_pool \
+    else async_engine
 
 
-def create_db_and_tables():
-    SQLModel.metadata.create_all(engine)
+def migrate_db() -> int:
+    return upgrade(engine)
 
 
 def get_session():
     with Session(engine) as session:
         yield session
+
+
+def make_async_session(read_only: bool = False) -> AsyncSession:
+    # expire_on_commit=False: objects are serialized after the commit, outside the greenlet,
+    # where an expired attribute can not be lazy loaded
+    return AsyncSession(async_read_engine if read_only else async_engine, expire_on_commit=False)
+
+
+# Routes declare the session they need. get_async_session: writes, and the reads that must see the last
+# committed write (read then write in the same request, the authentication of a user just changed).
+# get_async_read_session: the other reads, which accept a replica lagging behind the primary.
+async def get_async_session():
+    async with make_async_session() as session:
+        yield session
+
+
+async def get_async_read_session():
+    async with make_async_session(read_only=True) as session:
+        yield session
+
+
+# The work a request leaves to a background task opens its own short session with this factory: the session of
+# the request is only closed after the background tasks, it must not stay checked out while they run.
+def get_async_session_factory() -> Callable[[], AsyncSession]:
+    return make_async_session
@@ -0,0 +1,136 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from fastapi.concurrency import run_in_threadpool
+from passlib.context import CryptContext
+
+from .utils.metrics import password_hash_duration
+
+# bcrypt cost. Hashes stored with another cost are upgraded on the next successful login.
+# Pick the value for the target hardware with: python -m db.hashing --target-ms 250
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+# Worker processes of the hashing pool, 0 runs bcrypt in the threadpool instead
+HASH_POOL_SIZE = int(os.environ.get("HASH_POOL_SIZE", os.cpu_count() or 1))
+# Jobs submitted to the pool at once, the others wait in the event loop
+HASH_MAX_CONCURRENCY = int(os.environ.get("HASH_MAX_CONCURRENCY", max(HASH_POOL_SIZE, 1) * 2))
+
+_contexts: dict[int, CryptContext] = {}
+
+
+def make_context(rounds: int = BCRYPT_ROUNDS) -> CryptContext:
+    # min == max == default, so needs_update() flags every hash with a different cost
+    return CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__default_rounds=rounds,
+                        bcrypt__min_rounds=rounds, bcrypt__max_rounds=rounds)
+
+
+def _get_context(rounds: int) -> CryptContext:
+    if rounds not in _contexts:
+        _contexts[rounds] = make_context(rounds)
+    return _contexts[rounds]
+
+
+# Module level functions: they are pickled by reference into the worker processes
+
+def hash_password(password: str, rounds: int = BCRYPT_ROUNDS) -> str:
+    return _get_context(rounds).hash(password)
+
+
+def hash_passwords(passwords: list[str], rounds: int = BCRYPT_ROUNDS) -> list[str]:
+    context = _get_context(rounds)
+    return [context.hash(password) for password in passwords]
+
+
+def verify_password(password: str, hashed_password: str, rounds: int = BCRYPT_ROUNDS) -> bool:
+    return _get_context(rounds).verify(password, hashed_password)
+
+
+def verify_and_update(password: str, hashed_password: str, rounds: int = BCRYPT_ROUNDS) -> tuple[bool, str | None]:
+    """Returns (is_valid, new_hash), new_hash is set when the stored hash has to be upgraded"""
+    return _get_context(rounds).verify_and_update(password, hashed_password)
+
+
+class PasswordHasher:
+    """Runs bcrypt on a dedicated process pool, so logins do not starve the request workers"""
+
+    def __init__(self, workers: int = HASH_POOL_SIZE, max_concurrency: int = HASH_MAX_CONCURRENCY,
+                 rounds: int = BCRYPT_ROUNDS):
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.rounds = rounds
+        self._executor: ProcessPoolExecutor | None = None
+        self._loop = None
+        self._semaphore: asyncio.Semaphore | None = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            # spawn: forking a process that already runs the event loop and the DB threads is unsafe
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_running_loop()
+        if self._loop is not loop:
+            self._loop, self._semaphore = loop, asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def _run(self, func, *args):
+        with password_hash_duration.time(func.__name__):
+            async with self._get_semaphore():
+                if self.workers <= 0:
+                    return await run_in_threadpool(func, *args, self.rounds)
+                return await asyncio.get_running_loop().run_in_executor(self._get_executor(), func, *args,
+                                                                        self.rounds)
+
+    async def hash(self, password: str) -> str:
+        return await self._run(hash_password, password)
+
+    async def hash_many(self, passwords: list[str]) -> list[str]:
+        """Bulk version of hash(): one job per worker instead of one per password,
+        the inter-process round trip is paid once per slice"""
+        size = max(-(-len(passwords) // max(self.workers, 1)), 1)
+        slices = await asyncio.gather(*(self._run(hash_passwords, passwords[start:start + size])
+                                        for start in range(0, len(passwords), size)))
+        return [hashed for hashes in slices for hashed in hashes]
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._run(verify_password, password, hashed_password)
+
+    async def verify_and_update(self, password: str, hashed_password: str) -> tuple[bool, str | None]:
+        return await self._run(verify_and_update, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
+
+
+def calibrate_rounds(target_ms: float, min_rounds: int = 4, max_rounds: int = 16, samples: int = 3) -> int:
+    """Highest bcrypt cost whose hash time stays within target_ms on this machine"""
+    best = min_rounds
+    make_context(min_rounds).hash("warmup")  # the first call loads the bcrypt backend
+    for rounds in range(min_rounds, max_rounds + 1):
+        context = make_context(rounds)
+        start = time.perf_counter()
+        for _ in range(samples):
+            context.hash("calibration-password")
+        elapsed_ms = (time.perf_counter() - start) / samples * 1000
+        print(f"rounds={rounds:>2} {elapsed_ms:8.1f} ms")
+        if elapsed_ms > target_ms:
+            break
+        best = rounds
+    return best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Pick the bcrypt cost for a target hash latency")
+    parser.add_argument("--target-ms", type=float, default=250)
+    parser.add_argument("--max-rounds", type=int, default=16)
+    args = parser.parse_args()
+    print(f"BCRYPT_ROUNDS={calibrate_rounds(args.target_ms, max_rounds=args.max_rounds)}")
@@ -0,0 +1,168 @@
+import logging
+from dataclasses import dataclass
+from typing import Callable
+
+from sqlalchemy import inspect, text
+from sqlalchemy.engine import Connection, Engine
+from sqlmodel import SQLModel
+
+from models.models import ChangeMark, UploadSession  # importing models.models registers the tables on SQLModel.metadata
+
+logger = logging.getLogger(__name__)
+
+# Versioned schema changes. The DB stores the version it was brought to in schema_version, startup
+# compares it with the last migration and only runs the missing ones: a current schema costs two queries
+# instead of the table by table reflection of metadata.create_all.
+# A migration must work on the DBs created by metadata.create_all before the migrations existed,
+# so every step checks what is already there. New migrations go at the end, never edit a released one.
+
+SCHEMA_VERSION_TABLE = "schema_version"
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    description: str
+    upgrade: Callable[[Connection], None]
+
+
+MIGRATIONS: list[Migration] = []
+
+
+def migration(version: int, description: str):
+    def register(upgrade: Callable[[Connection], None]):
+        assert not MIGRATIONS or MIGRATIONS[-1].version < version, "migrations are registered in version order"
+        MIGRATIONS.append(Migration(version, description, upgrade))
+        return upgrade
+    return register
+
+
+def _columns(conn: Connection, table: str) -> set[str]:
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+@migration(1, "base schema")
+def _base_schema(conn: Connection):
+    # only creates the missing tables, the existing ones are completed by the next migrations
+    SQLModel.metadata.create_all(conn)
+
+
+@migration(2, "media_users.sha256 and media_users.derivatives")
+def _media_user_columns(conn: Connection):
+    columns = _columns(conn, "media_users")
+    for column in ("sha256", "derivatives"):
+        if column not in columns:
+            conn.execute(text(f"ALTER TABLE media_users ADD COLUMN {column} VARCHAR"))
+
+
+# media_users.user_id: the media of a user (listing, selectinload, the cascade of a user deletion)
+# media_users.media_path, media_blobs.path: set_media_derivatives, get_referenced_paths
+# media_users.sha256: foreign key to media_blobs
+# users.created_at: users by creation date
+@migration(3, "indexes of the foreign keys and hot filters")
+def _indexes(conn: Connection):
+    for table, column in (("media_users", "user_id"), ("media_users", "media_path"), ("media_users", "sha256"),
+                          ("media_blobs", "path"), ("users", "created_at")):
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_{column} ON {table} ({column})"))
+
+
+# Full text indexes of the user search (crud.search_users), external content tables over users: they store
+# the index only, the values are read back from users. users_fts splits on word boundaries (diacritics
+# folded) with prefix indexes for the 2 and 3 first characters; users_trigram indexes every 3 characters
+# sequence, for the fragments inside a word. Triggers keep both in sync with every write to users,
+# the ORM ones as well as the bulk inserts of the import and the deletions.
+USER_SEARCH_COLUMNS = "login, email, full_name"
+
+
+@migration(4, "full text search indexes of the users")
+def _user_search(conn: Connection):
+    if conn.dialect.name != "sqlite":
+        return
+    conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5({USER_SEARCH_COLUMNS}, "
+                      "content='users', content_rowid='id', tokenize='unicode61 remove_diacritics 2', "
+                      "prefix='2 3')"))
+    conn.execute(text(f"CREATE VIRTUAL TABLE IF NOT EXISTS users_trigram USING fts5({USER_SEARCH_COLUMNS}, "
+                      "content='users', content_rowid='id', tokenize='trigram')"))
+    new_row = "new.id, new.login, new.email, new.full_name"
+    old_row = "'delete', old.id, old.login, old.email, old.full_name"
+    insert = "".join(f"INSERT INTO {index} (rowid, {USER_SEARCH_COLUMNS}) VALUES ({new_row}); "
+                     for index in ("users_fts", "users_trigram"))
+    delete = "".join(f"INSERT INTO {index} ({index}, rowid, {USER_SEARCH_COLUMNS}) VALUES ({old_row}); "
+                     for index in ("users_fts", "users_trigram"))
+    conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS users_search_insert AFTER INSERT ON users BEGIN {insert}END"))
+    conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS users_search_delete AFTER DELETE ON users BEGIN {delete}END"))
+    # a password change or a rehash does not touch the indexes
+    conn.execute(text(f"CREATE TRIGGER IF NOT EXISTS users_search_update AFTER UPDATE OF {USER_SEARCH_COLUMNS} "
+                      f"ON users BEGIN {delete}{insert}END"))
+    for index in ("users_fts", "users_trigram"):
+        conn.execute(text(f"INSERT INTO {index} ({index}) VALUES ('rebuild')"))
+
+
+# change_marks: the deletions and the derivatives updates, which leave no timestamp behind, for the ETag and
+# Last-Modified of the read responses. Scope "users" for a deleted user (every user list changes), scope
+# "media_users:<user_id>" for a deleted media or new derivatives of a media of that user. Local time, as the
+# created_at / updated_at written by the application.
+CHANGE_MARK_NOW = "strftime('%Y-%m-%dT%H:%M:%f', 'now', 'localtime')"
+
+
+def _change_mark(scope: str) -> str:
+    return (f"INSERT INTO change_marks (scope, changed_at) VALUES ({scope}, {CHANGE_MARK_NOW}) "
+            "ON CONFLICT (scope) DO UPDATE SET changed_at = excluded.changed_at; ")
+
+
+@migration(5, "change marks of the deletions and derivatives")
+def _change_marks(conn: Connection):
+    SQLModel.metadata.create_all(conn, tables=[ChangeMark.__table__])
+    if conn.dialect.name != "sqlite":
+        return
+    users_scope, media_scope = "'users'", "'media_users:' || {}.user_id"
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS users_change_delete AFTER DELETE ON users BEGIN "
+                      f"{_change_mark(users_scope)}"
+                      "DELETE FROM change_marks WHERE scope = 'media_users:' || old.id; END"))
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS media_users_change_delete AFTER DELETE ON media_users BEGIN "
+                      f"{_change_mark(media_scope.format('old'))}END"))
+    conn.execute(text("CREATE TRIGGER IF NOT EXISTS media_users_change_derivatives AFTER UPDATE OF derivatives "
+                      f"ON media_users BEGIN {_change_mark(media_scope.format('new'))}END"))
+
+
+@migration(6, "upload sessions")
+def _upload_sessions(conn: Connection):
+    SQLModel.metadata.create_all(conn, tables=[UploadSession.__table__])
+
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def get_schema_version(conn: Connection) -> int:
+    """0 for a DB that never went through the migrations"""
+    if not inspect(conn).has_table(SCHEMA_VERSION_TABLE):
+        return 0
+    return conn.execute(text(f"SELECT version FROM {SCHEMA_VERSION_TABLE}")).scalar() or 0
+
+
+def _set_schema_version(conn: Connection, version: int):
+    conn.execute(text(f"CREATE TABLE IF NOT EXISTS {SCHEMA_VERSION_TABLE} (version INTEGER NOT NULL)"))
+    conn.execute(text(f"DELETE FROM {SCHEMA_VERSION_TABLE}"))
+    conn.execute(text(f"INSERT INTO {SCHEMA_VERSION_TABLE} (version) VALUES (:version)"), {"version": version})
+
+
+def upgrade(engine: Engine, target: int = LATEST_VERSION) -> int:
+    """Runs the migrations up to target in one transaction and returns the schema version"""
+    with engine.connect() as conn:
+        version = get_schema_version(conn)
+    if version >= target:
+        return version
+    with engine.begin() as conn:
+        if engine.dialect.name == "sqlite":
+            # pysqlite runs DDL outside of any transaction and does not lock on BEGIN: take the write lock
+            # first, so the workers starting together migrate one after the other
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        version = get_schema_version(conn)
+        pending = [migration for migration in MIGRATIONS if version < migration.version <= target]
+        if not pending:
+            return version
+        for migration in pending:
+            logger.info("Schema migration %s: %s", migration.version, migration.description)
+            migration.upgrade(conn)
+        _set_schema_version(conn, pending[-1].version)
+        return pending[-1].version
@@ -1,13 +1,14 @@
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 import datetime
 
+from .hashing import make_context
+
 
 SECRET_KEY = "228df6cae9ff2b003a4d9643f5a436fb40b8f94269292e2e010e71c1949ed30d"  # TODO regenerate
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = make_context()
 
 
 def verify_password(plain_password, hashed_password):
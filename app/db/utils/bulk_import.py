@@ -0,0 +1,98 @@
+import codecs
+import csv
+import io
+import json
+import os
+from typing import AsyncIterator
+
+from fastapi import Request, HTTPException, status
+
+# Rows checked, hashed and inserted together. Each batch costs two IN queries, one executemany and one commit
+IMPORT_BATCH_SIZE = int(os.environ.get("IMPORT_BATCH_SIZE", 500))
+# Largest batch_size a request may ask for: a batch is buffered in memory and committed in one transaction
+IMPORT_MAX_BATCH_SIZE = int(os.environ.get("IMPORT_MAX_BATCH_SIZE", 5000))
+IMPORT_CONTENT_TYPES = ("application/x-ndjson", "text/csv")
+
+# OpenAPI description of the raw body read by read_import_rows
+IMPORT_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {
+            "application/x-ndjson": {"schema": {"type": "string"},
+                                     "example": '{"login": "user1", "email": "user1@mail.ru", '
+                                                '"full_name": "User1 U", "password": "password1"}\n'},
+            "text/csv": {"schema": {"type": "string"},
+                         "example": "login,email,full_name,password\nuser1,user1@mail.ru,User1 U,password1\n"},
+        },
+    },
+}
+
+
+def _complete_records(buffer: str) -> int:
+    """Length of the part of a CSV buffer made of whole records: up to the last newline outside of quotes"""
+    end = buffer.rfind("\n")
+    while end != -1 and buffer.count('"', 0, end) % 2:
+        end = buffer.rfind("\n", 0, end)
+    return end + 1
+
+
+async def _ndjson_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict | str]:
+    buffer = b""
+    async for chunk in chunks:
+        *lines, buffer = (buffer + chunk).split(b"\n")
+        for line in lines:
+            if line.strip():
+                yield _parse_json_line(line)
+    if buffer.strip():
+        yield _parse_json_line(buffer)
+
+
+def _parse_json_line(line: bytes) -> dict | str:
+    try:
+        row = json.loads(line)
+    except ValueError as ex:
+        return f"Invalid JSON: {ex}"
+    return row if isinstance(row, dict) else "A JSON object is expected"
+
+
+async def _csv_texts(chunks: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    decoder = codecs.getincrementaldecoder("utf-8-sig")(errors="replace")
+    buffer = ""
+    async for chunk in chunks:
+        buffer += decoder.decode(chunk)
+        end = _complete_records(buffer)
+        if end:
+            yield buffer[:end]
+            buffer = buffer[end:]
+    yield buffer + decoder.decode(b"", final=True)
+
+
+async def _csv_rows(chunks: AsyncIterator[bytes]) -> AsyncIterator[dict | str]:
+    header = None
+    async for text in _csv_texts(chunks):
+        for record in csv.reader(io.StringIO(text)):
+            if not record:  # blank line
+                continue
+            if header is None:
+                header = record
+            elif len(record) == len(header):
+                yield dict(zip(header, record))
+            else:
+                yield f"{len(record)} columns, the header has {len(header)}"
+
+
+async def read_import_rows(request: Request) -> AsyncIterator[dict | str]:
+    """Rows of an NDJSON or CSV (with a header line) request body, parsed as the body arrives.
+
+    A row that can not be parsed is yielded as the error message, so it is reported without stopping the import.
+    """
+    content_type = request.headers.get("content-type", "").split(";")[0].strip().lower()
+    if content_type == "application/x-ndjson":
+        rows = _ndjson_rows(request.stream())
+    elif content_type == "text/csv":
+        rows = _csv_rows(request.stream())
+    else:
+        raise HTTPException(status_code=status.HTTP_415_UNSUPPORTED_MEDIA_TYPE,
+                            detail=f"Unsupported content type. Support {', '.join(IMPORT_CONTENT_TYPES)}")
+    async for row in rows:
+        yield row
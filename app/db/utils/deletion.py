@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import time
+from datetime import datetime
+from typing import Callable
+
+from fastapi.concurrency import run_in_threadpool
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from models.models import UploadSession
+from .. import crud
+from .derivatives import original_path
+from .metrics import file_io_duration
+from .uploads import UPLOAD_DIR, UPLOAD_SESSION_TTL, upload_path, forget_upload
+
+logger = logging.getLogger(__name__)
+
+# Tombstones handled per transaction
+DELETION_BATCH_SIZE = int(os.environ.get("DELETION_BATCH_SIZE", 500))
+# Seconds between two passes when no deletion wakes the worker up, e.g. deletions made by another process
+DELETION_INTERVAL = float(os.environ.get("DELETION_INTERVAL", 5))
+# Seconds between two reconciliations of the media directory with the DB
+MEDIA_GC_INTERVAL = float(os.environ.get("MEDIA_GC_INTERVAL", 3600))
+# Files younger than this are never orphans: their upload may not be committed yet
+MEDIA_GC_GRACE = float(os.environ.get("MEDIA_GC_GRACE", 3600))
+
+
+def remove_tombstoned_files(files: list[tuple[str, float]]) -> int:
+    """Removes (path, tombstone timestamp) files. A file modified after its tombstone was stored again
+    in the meantime (see MediaWriter.commit) and is kept."""
+    removed = 0
+    for path_file, deleted_at in files:
+        try:
+            if os.stat(path_file).st_mtime <= deleted_at:
+                os.remove(path_file)
+                removed += 1
+        except FileNotFoundError:
+            pass
+    return removed
+
+
+def find_orphan_files(directory: str, referenced: set[str], grace: float) -> list[str]:
+    """Files of the directory (derivatives through their original) no media references, older than grace"""
+    oldest = time.time() - grace
+    orphans = []
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            path_file = os.path.join(directory, entry.name)
+            if (entry.is_file() and original_path(path_file) not in referenced
+                    and entry.stat().st_mtime < oldest):
+                orphans.append(path_file)
+    return orphans
+
+
+def find_expired_uploads(uploads: list[UploadSession], expired_before: float,
+                         directory: str = UPLOAD_DIR) -> tuple[list[str], list[str]]:
+    """Among the upload sessions created before expired_before, the ids of those without a chunk since, and
+    the part files to remove: theirs and the ones left without a session (a crash between row and file)"""
+    expired, active = [], set()
+    for upload in uploads:
+        path_file = upload_path(upload.id, directory)
+        try:
+            if os.stat(path_file).st_mtime >= expired_before:
+                active.add(path_file)
+                continue
+        except FileNotFoundError:
+            pass
+        expired.append(upload.id)
+    if not os.path.isdir(directory):
+        return expired, []
+    # a part file is never older than its session: the files older than expired_before are all accounted for
+    return expired, find_orphan_files(directory, active, time.time() - expired_before)
+
+
+class DeletionWorker:
+    """Removes the files of deleted media in the background.
+
+    crud stores a FileTombstone per file in the transaction deleting the rows, so a failed commit leaves the
+    files in place and a request never waits on os.remove. The worker removes the files of the committed
+    tombstones in batches, then drops the tombstones. A periodic pass reconciles the media directory with
+    the DB and tombstones the orphan files, e.g. left by a crash, and expires the abandoned upload sessions.
+    """
+
+    def __init__(self, directory: str = "static/media_user", batch_size: int = DELETION_BATCH_SIZE,
+                 interval: float = DELETION_INTERVAL, gc_interval: float = MEDIA_GC_INTERVAL,
+                 gc_grace: float = MEDIA_GC_GRACE, upload_directory: str = UPLOAD_DIR,
+                 upload_ttl: float = UPLOAD_SESSION_TTL):
+        self.directory = directory
+        self.upload_directory = upload_directory
+        self.upload_ttl = upload_ttl
+        self.batch_size = batch_size
+        self.interval = interval
+        self.gc_interval = gc_interval
+        self.gc_grace = gc_grace
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+
+    def start(self, session_factory: Callable[[], AsyncSession]):
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run(session_factory))
+
+    def wake(self):
+        """Called after a commit that stored tombstones, a no-op when the worker is not running"""
+        if self._loop is not None and not self._loop.is_closed():
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self._loop = self._wakeup = self._task = None
+
+    async def _run(self, session_factory: Callable[[], AsyncSession]):
+        next_gc = time.monotonic()  # the first reconciliation runs at startup
+        while True:
+            try:
+                async with session_factory() as session:
+                    if time.monotonic() >= next_gc:
+                        next_gc = time.monotonic() + self.gc_interval
+                        await self.collect_garbage(session)
+                        await self.expire_uploads(session)
+                    while await self.process_tombstones(session) == self.batch_size:
+                        pass
+            except Exception:
+                logger.exception("File deletion pass failed, retrying in %s s", self.interval)
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def process_tombstones(self, session: AsyncSession) -> int:
+        """Handles the oldest batch of tombstones, returns how many there were"""
+        tombstones = await session.run_sync(crud.get_file_tombstones, self.batch_size)
+        if not tombstones:
+            return 0
+        referenced = await session.run_sync(crud.get_referenced_paths, [tombstone.path for tombstone in tombstones])
+        with file_io_duration.time("delete_batch"):
+            await run_in_threadpool(remove_tombstoned_files, [
+                (tombstone.path, datetime.fromisoformat(tombstone.created_at).timestamp())
+                for tombstone in tombstones if tombstone.path not in referenced])
+        await session.run_sync(crud.delete_file_tombstones, [tombstone.id for tombstone in tombstones])
+        return len(tombstones)
+
+    async def collect_garbage(self, session: AsyncSession) -> int:
+        """Tombstones the orphan files of the media directory, returns how many were found"""
+        referenced = await session.run_sync(crud.get_stored_media_paths)
+        orphans = await run_in_threadpool(find_orphan_files, self.directory, referenced, self.gc_grace)
+        if orphans:
+            await session.run_sync(crud.add_file_tombstones, orphans)
+            await session.commit()
+            logger.info("%s orphan files in %s", len(orphans), self.directory)
+        return len(orphans)
+
+    async def expire_uploads(self, session: AsyncSession) -> int:
+        """Drops the upload sessions without a chunk for upload_ttl and tombstones their part files,
+        returns how many expired"""
+        expired_before = time.time() - self.upload_ttl
+        uploads = await session.run_sync(crud.get_upload_sessions_created_before,
+                                         datetime.fromtimestamp(expired_before).isoformat())
+        expired, path_files = await run_in_threadpool(find_expired_uploads, uploads, expired_before,
+                                                      self.upload_directory)
+        if expired or path_files:
+            await session.run_sync(crud.delete_upload_sessions, expired, path_files)
+            for upload_id in expired:
+                forget_upload(upload_id)
+            logger.info("%s upload sessions expired, %s part files", len(expired), len(path_files))
+        return len(expired)
+
+
+deletion_worker = DeletionWorker()
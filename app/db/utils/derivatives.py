@@ -0,0 +1,132 @@
+import asyncio
+import logging
+import multiprocessing
+import os
+import re
+from concurrent.futures import ProcessPoolExecutor
+from uuid import uuid4
+
+from PIL import Image
+
+from .metrics import file_io_duration
+
+logger = logging.getLogger(__name__)
+
+
+def parse_derivative_sizes(value: str) -> dict[str, int]:
+    """MEDIA_DERIVATIVE_SIZES "thumbnail:128,medium:512" -> {"thumbnail": 128, "medium": 512}"""
+    sizes = {}
+    for item in value.split(","):
+        name, _, side = item.strip().partition(":")
+        if not re.fullmatch(r"[A-Za-z0-9_-]+", name) or name == "original" or name in sizes \
+                or not side.strip().isdigit() or int(side) <= 0:
+            raise ValueError(f"Invalid MEDIA_DERIVATIVE_SIZES entry {item!r}: expected a unique name "
+                             f"(letters, digits, _ or -, not 'original') and a side in px > 0, e.g. 'thumbnail:128'")
+        sizes[name] = int(side)
+    return sizes
+
+
+# Resized copies of the uploaded images, name -> longest side in px.
+# Configured with MEDIA_DERIVATIVE_SIZES="thumbnail:128,medium:512"
+DERIVATIVE_SIZES = parse_derivative_sizes(os.environ.get("MEDIA_DERIVATIVE_SIZES", "thumbnail:128,medium:512"))
+# Errors of an image Pillow can not resize: corrupt, unsupported, or past MAX_IMAGE_PIXELS (a decompression bomb,
+# a highly compressible PNG fits under the upload size limit). The original is served instead.
+NOT_RESIZABLE = (OSError, ValueError, Image.DecompressionBombError)
+DERIVATIVE_POOL_SIZE = int(os.environ.get("DERIVATIVE_POOL_SIZE", max((os.cpu_count() or 1) // 2, 1)))
+
+
+def derivative_path(path: str, size_name: str) -> str:
+    """static/media_user/<sha256>.png -> static/media_user/<sha256>.thumbnail.png"""
+    base, ext = os.path.splitext(path)
+    return f"{base}.{size_name}{ext}"
+
+
+def derivative_paths(path: str) -> list[str]:
+    return [derivative_path(path, size_name) for size_name in DERIVATIVE_SIZES]
+
+
+def original_path(path: str) -> str:
+    """static/media_user/<sha256>.thumbnail.png -> static/media_user/<sha256>.png, other paths are returned as is"""
+    base, ext = os.path.splitext(path)
+    original_base, size_name = os.path.splitext(base)
+    return original_base + ext if size_name[1:] in DERIVATIVE_SIZES else path
+
+
+# Module level functions: they are pickled by reference into the worker processes
+
+def make_derivative(path: str, size_name: str, side: int) -> str:
+    out_path = derivative_path(path, size_name)
+    if os.path.exists(out_path):
+        return out_path
+    temp_path = f"{os.path.dirname(out_path)}/.{uuid4()}.part"
+    try:
+        with Image.open(path) as image:
+            image_format = image.format
+            image.thumbnail((side, side))
+            if image_format == "JPEG" and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+            image.save(temp_path, format=image_format)
+        os.replace(temp_path, out_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return out_path
+
+
+def make_derivatives(path: str, sizes: dict[str, int]) -> list[str]:
+    """Returns the names of the sizes produced, an image Pillow can not read produces none"""
+    done = []
+    for size_name, side in sizes.items():
+        try:
+            make_derivative(path, size_name, side)
+        except NOT_RESIZABLE as ex:
+            logger.warning("Derivative %s of %s failed: %s", size_name, path, ex)
+            break
+        done.append(size_name)
+    return done
+
+
+class DerivativePipeline:
+    """Produces the derivatives of uploaded images on a background process pool.
+
+    A derivative requested before its background job finished is produced on demand,
+    jobs for the same file are shared instead of being run twice.
+    """
+
+    def __init__(self, workers: int = DERIVATIVE_POOL_SIZE, sizes: dict[str, int] | None = None):
+        self.workers = workers
+        self.sizes = sizes or DERIVATIVE_SIZES
+        self._executor: ProcessPoolExecutor | None = None
+        self._pending: dict[tuple, asyncio.Future] = {}
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._executor
+
+    async def _submit(self, key: tuple, func, *args):
+        future = self._pending.get(key)
+        if future is None:
+            future = asyncio.wrap_future(self._get_executor().submit(func, *args))
+            self._pending[key] = future
+            future.add_done_callback(lambda done: self._pending.pop(key, None))
+        return await asyncio.shield(future)
+
+    async def process(self, path: str) -> list[str]:
+        with file_io_duration.time("derivatives"):
+            return await self._submit((path, None), make_derivatives, path, self.sizes)
+
+    async def get(self, path: str, size_name: str) -> str:
+        out_path = derivative_path(path, size_name)
+        if os.path.exists(out_path):
+            return out_path
+        with file_io_duration.time("derivative_on_demand"):
+            return await self._submit((path, size_name), make_derivative, path, size_name, self.sizes[size_name])
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+
+derivative_pipeline = DerivativePipeline()
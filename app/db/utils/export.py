@@ -0,0 +1,54 @@
+import csv
+import enum
+import io
+import json
+import os
+from typing import AsyncIterator
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy.sql import Select
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+# Rows fetched from the server-side cursor and encoded per response chunk
+EXPORT_BATCH_SIZE = int(os.environ.get("EXPORT_BATCH_SIZE", 1000))
+
+
+class ExportFormat(str, enum.Enum):
+    ndjson = "ndjson"
+    csv = "csv"
+
+
+EXPORT_MEDIA_TYPES = {ExportFormat.ndjson: "application/x-ndjson", ExportFormat.csv: "text/csv"}
+
+
+def _plain(value):
+    # enums are exported with the value the API shows, e.g. "User"
+    return value.value if isinstance(value, enum.Enum) else value
+
+
+def encode_ndjson(columns: list[str], rows) -> bytes:
+    return "".join(json.dumps(dict(zip(columns, map(_plain, row))), ensure_ascii=False) + "\n"
+                   for row in rows).encode()
+
+
+def encode_csv(rows) -> bytes:
+    out = io.StringIO()
+    csv.writer(out).writerows([_plain(value) for value in row] for row in rows)
+    return out.getvalue().encode()
+
+
+async def stream_export(session: AsyncSession, statement: Select, export_format: ExportFormat,
+                        batch_size: int = EXPORT_BATCH_SIZE) -> AsyncIterator[bytes]:
+    """Encoded chunks of the statement rows. The rows come from a server-side cursor batch_size at a time,
+    so the memory used does not depend on the table size."""
+    result = await session.stream(statement, execution_options={"max_row_buffer": batch_size})
+    columns = list(result.keys())
+    if export_format == ExportFormat.csv:
+        yield encode_csv([columns])
+    async for rows in result.partitions(batch_size):
+        yield encode_ndjson(columns, rows) if export_format == ExportFormat.ndjson else encode_csv(rows)
+
+
+def export_response(chunks: AsyncIterator[bytes], export_format: ExportFormat, name: str) -> StreamingResponse:
+    return StreamingResponse(chunks, media_type=EXPORT_MEDIA_TYPES[export_format],
+                             headers={"content-disposition": f'attachment; filename="{name}.{export_format.value}"'})
@@ -0,0 +1,34 @@
+import base64
+import json
+import os
+
+from fastapi import HTTPException, status
+
+# Keyset pagination cursors. Opaque for the clients: base64 of the last primary key of the page,
+# so the cursor format can change without breaking them.
+
+# Largest `limit` of the list endpoints: a whole table is read through the export endpoints
+PAGE_MAX_LIMIT = int(os.environ.get("PAGE_MAX_LIMIT", 1000))
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"id": last_id}).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> int:
+    """Primary key the next page starts after, an empty cursor asks for the first page"""
+    if not cursor:
+        return 0
+    try:
+        last_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))["id"]
+    except (ValueError, TypeError, KeyError):
+        last_id = None
+    if not isinstance(last_id, int):
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Invalid cursor")
+    return last_id
+
+
+def make_page(items: list, limit: int) -> dict:
+    next_cursor = encode_cursor(items[-1].id) if items and len(items) >= limit else None
+    return {"items": items, "next_cursor": next_cursor}
@@ -0,0 +1,28 @@
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+
+class QueryCounter:
+    """Counts the statements executed on an engine inside the `with` block.
+
+    with QueryCounter(engine) as counter:
+        client.get("/api/v1/users/")
+    assert counter.count == 2
+    """
+
+    def __init__(self, engine: Engine | AsyncEngine):
+        self.engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+        self.count = 0
+        self.statements: list[str] = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        self.count += 1
+        self.statements.append(statement)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
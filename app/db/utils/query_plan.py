@@ -0,0 +1,57 @@
+import re
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+# Tables that grow with the traffic: a full scan of one of them gets slower with every new row
+LARGE_TABLES = frozenset({"users", "media_users", "media_blobs", "file_tombstones"})
+
+# "SCAN users", "SCAN media_users USING INDEX ...", "SCAN TABLE users" before SQLite 3.36
+_SCAN = re.compile(r"^SCAN (?:TABLE )?(\w+)")
+
+
+def explain_query_plan(dbapi_connection, statement: str, parameters=()) -> list[str]:
+    """The EXPLAIN QUERY PLAN lines (SQLite) of a statement"""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"EXPLAIN QUERY PLAN {statement}", parameters)
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+class QueryPlanChecker:
+    """Explains every query executed on an engine inside the `with` block and records the full scans
+    of the large tables, as (table, plan line, statement).
+
+    with QueryPlanChecker(engine) as checker:
+        crud.get_medias_user_by_user_id(session, 1)
+    assert not checker.full_scans, checker.full_scans
+    """
+
+    def __init__(self, engine: Engine | AsyncEngine, tables: frozenset[str] = LARGE_TABLES):
+        self.engine = engine.sync_engine if isinstance(engine, AsyncEngine) else engine
+        self.tables = tables
+        self.statements: list[tuple[str, list[str]]] = []
+        self.full_scans: list[tuple[str, str, str]] = []
+
+    def _on_execute(self, conn, cursor, statement, parameters, context, executemany):
+        if executemany or not statement.lstrip().upper().startswith(("SELECT", "UPDATE", "DELETE", "WITH")):
+            return
+        plan = explain_query_plan(conn.connection, statement, parameters)
+        self.statements.append((statement, plan))
+        for line in plan:
+            match = _SCAN.match(line)
+            if match and match.group(1) in self.tables:
+                self.full_scans.append((match.group(1), line, statement))
+
+    def scanned_tables(self) -> set[str]:
+        return {table for table, _, _ in self.full_scans}
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._on_execute)
@@ -0,0 +1,143 @@
+import fcntl
+import hashlib
+import os
+from contextlib import asynccontextmanager
+from datetime import datetime
+from functools import partial
+from typing import AsyncIterator
+
+import anyio
+from fastapi import HTTPException, status
+
+from models.models import UploadSession
+from .metrics import file_io_duration, file_io_bytes
+from .utils import SavedFile, store_file
+
+# Resumable uploads: the client creates an upload session with the size of the media, PUTs raw byte
+# ranges of the body at the offset the server has, and finalizes once every byte is there. Chunks are
+# appended to a part file as they arrive, without multipart parsing; the part file size is the offset.
+# The directory must be on the filesystem of the media directory: finalizing hard links the part file.
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "uploads")
+# Seconds without a chunk after which an upload session expires, see DeletionWorker.expire_uploads
+UPLOAD_SESSION_TTL = float(os.environ.get("UPLOAD_SESSION_TTL", 24 * 3600))
+
+# OpenAPI description of the raw chunk body read by append_chunks
+UPLOAD_CHUNK_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"application/octet-stream": {"schema": {"type": "string", "format": "binary"}}},
+    },
+}
+
+# sha256 of the bytes received so far per upload, with the offset it covers. A process only sees the chunks
+# it received itself: when the upload moved between workers or over a restart, finalize reads the file again.
+_hashers: dict[str, tuple[int, "hashlib._Hash"]] = {}
+
+
+def upload_path(upload_id: str, directory: str = UPLOAD_DIR) -> str:
+    return os.path.join(directory, f"{upload_id}.part")
+
+
+def _take_hasher(upload_id: str, offset: int):
+    covered, hasher = _hashers.pop(upload_id, (None, None))
+    if covered == offset:
+        return hasher
+    return hashlib.sha256() if offset == 0 else None
+
+
+def forget_upload(upload_id: str):
+    _hashers.pop(upload_id, None)
+
+
+async def create_upload_file(upload_id: str, directory: str = UPLOAD_DIR):
+    await anyio.Path(directory).mkdir(parents=True, exist_ok=True)
+    await (await anyio.open_file(upload_path(upload_id, directory), "xb")).aclose()
+
+
+def upload_status(upload: UploadSession, directory: str = UPLOAD_DIR) -> dict:
+    """The UploadSessionResponse of an upload: the bytes received and when it expires without a new chunk"""
+    last_activity = datetime.fromisoformat(upload.created_at).timestamp()
+    try:
+        stat_result = os.stat(upload_path(upload.id, directory))
+        offset, last_activity = stat_result.st_size, max(last_activity, stat_result.st_mtime)
+    except FileNotFoundError:
+        offset = 0
+    return {"id": upload.id, "user_id": upload.user_id, "size": upload.size, "offset": offset,
+            "expires_at": datetime.fromtimestamp(last_activity + UPLOAD_SESSION_TTL).isoformat()}
+
+
+@asynccontextmanager
+async def _locked_upload(upload_id: str, directory: str) -> AsyncIterator[anyio.AsyncFile]:
+    """The part file, locked against the other requests on the same upload, in any worker process"""
+    try:
+        file = await anyio.open_file(upload_path(upload_id, directory), "r+b")
+    except FileNotFoundError:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND,
+                            detail="Unknown upload")
+    try:
+        try:
+            fcntl.flock(file.wrapped.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail="The upload is busy with another request")
+        yield file
+    finally:
+        await file.aclose()
+
+
+async def append_chunks(upload: UploadSession, offset: int, chunks: AsyncIterator[bytes],
+                        directory: str = UPLOAD_DIR) -> int:
+    """Appends a byte range starting at offset, returns the new offset. A range that does not start at the
+    current offset is refused with the current offset in Upload-Offset. When the request is cut in the middle,
+    the bytes already written are kept: the client resumes from the offset the server reports."""
+    async with _locked_upload(upload.id, directory) as file:
+        received = os.fstat(file.wrapped.fileno()).st_size
+        if offset != received:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=f"Upload offset is {received}", headers={"Upload-Offset": str(received)})
+        await file.seek(received)
+        hasher = _take_hasher(upload.id, received)
+        try:
+            async for chunk in chunks:
+                if received + len(chunk) > upload.size:
+                    raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                        detail=f"The chunk goes past the upload size, {upload.size} bytes")
+                with file_io_duration.time("upload_write"):
+                    await file.write(chunk)
+                file_io_bytes.inc("upload", amount=len(chunk))
+                if hasher is not None:
+                    hasher.update(chunk)
+                received += len(chunk)
+        finally:
+            if hasher is not None:
+                _hashers[upload.id] = (received, hasher)
+    return received
+
+
+def _file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        while block := file.read(1024 * 1024):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+async def finalize_upload(upload: UploadSession, media_directory: str, directory: str = UPLOAD_DIR) -> SavedFile:
+    """Stores the complete part file as a media file, see store_file. The part file is kept: it is dropped with
+    the upload session, in the transaction of the media insert (crud.add_uploaded_media_user). When the insert
+    fails the upload can be finalized again, the media file it left unreferenced goes to the media GC."""
+    async with _locked_upload(upload.id, directory) as file:
+        received = os.fstat(file.wrapped.fileno()).st_size
+        if received != upload.size:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT,
+                                detail=f"Upload incomplete, {received} of {upload.size} bytes received",
+                                headers={"Upload-Offset": str(received)})
+        hasher = _take_hasher(upload.id, received)
+        with file_io_duration.time("upload_commit"):
+            if hasher is not None:
+                digest = hasher.hexdigest()
+            else:
+                digest = await anyio.to_thread.run_sync(_file_sha256, upload_path(upload.id, directory))
+            return await anyio.to_thread.run_sync(partial(store_file, keep_temp=True),
+                                                  upload_path(upload.id, directory), media_directory, upload.ext,
+                                                  digest, received)
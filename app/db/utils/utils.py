@@ -1,31 +1,176 @@
+import hashlib
 import os
-import shutil
+from typing import NamedTuple
 
-from fastapi import UploadFile, HTTPException, status
+import anyio
+from fastapi import Request, HTTPException, status
+from multipart.exceptions import MultipartParseError
+from multipart.multipart import MultipartParser, parse_options_header
 from uuid import uuid4
 
+from .metrics import file_io_duration, file_io_bytes
+
 AVAILABLE_MEDIA_EXTENSIONS = ['.jpg', '.png']
+MAX_MEDIA_SIZE = 5 * 1024 * 1024  # 5MB
+
+# OpenAPI description of the multipart body read by save_file, FastAPI can not derive it from a raw Request
+UPLOAD_OPENAPI = {
+    "requestBody": {
+        "required": True,
+        "content": {"multipart/form-data": {"schema": {
+            "type": "object",
+            "required": ["in_file"],
+            "properties": {"in_file": {"type": "string", "format": "binary"}},
+        }}},
+    },
+}
+
 
+class SavedFile(NamedTuple):
+    path: str
+    sha256: str
+    size: int
 
-def save_file(in_file: UploadFile, path: str):
-    in_filename, in_ext = os.path.splitext(in_file.filename)
+
+def check_extension(filename: str) -> str:
+    in_filename, in_ext = os.path.splitext(filename)
     if in_ext not in AVAILABLE_MEDIA_EXTENSIONS:
         raise HTTPException(status_code=status.HTTP_409_CONFLICT,
                             detail=f"Unsupported file type. Support {', '.join(AVAILABLE_MEDIA_EXTENSIONS)}")
-    filename = uuid4().__str__()
-    file_path = path + filename + in_ext
-    in_file.file.seek(0, os.SEEK_END)
-    file_length = in_file.file.tell()
-    in_file.file.seek(0, os.SEEK_SET)
-    if file_length > 5*1024*1024: #  5MB
-        raise HTTPException(status_code=status.HTTP_411_LENGTH_REQUIRED,
-                            detail=f"Media is too large ({file_length/1024/1024}MB), 5MB max.")
-    with open(file_path, 'wb') as out_file:
+    return in_ext
+
+
+def store_file(temp_path: str, path: str, ext: str, digest: str, size: int, keep_temp: bool = False) -> SavedFile:
+    """Moves a complete temp file to <path><sha256><ext>. When the content is already stored the temp file
+    is dropped and the existing file is reused, whatever extension it was stored with.
+    With keep_temp the temp file stays: it is hard linked instead of moved, and never removed. Both names are
+    then one inode, so when the content is stored again (os.utime below) the temp file gets the new mtime as
+    well and its pending tombstone skips it: it is removed by the sweep of its directory instead, see
+    find_expired_uploads. Blocking file system calls, run it in a worker thread."""
+    for stored_ext in [ext] + AVAILABLE_MEDIA_EXTENSIONS:
         try:
-            shutil.copyfileobj(in_file.file, out_file)
-        except Exception as ex:  # TODO уточнить необходимый тип исключения
-            raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-                                detail="Failed to save file")
-        finally:
-            in_file.file.close()
-    return file_path
+            # a newer mtime than a pending tombstone keeps the file, see db/utils/deletion.py
+            os.utime(path + digest + stored_ext)
+        except FileNotFoundError:
+            continue
+        if not keep_temp:
+            os.remove(temp_path)
+        return SavedFile(path + digest + stored_ext, digest, size)
+    file_path = path + digest + ext
+    if not keep_temp:
+        os.replace(temp_path, file_path)
+        return SavedFile(file_path, digest, size)
+    try:
+        os.link(temp_path, file_path)
+    except FileExistsError:  # stored by a concurrent upload of the same content
+        os.utime(file_path)
+    return SavedFile(file_path, digest, size)
+
+
+class MediaWriter:
+    """Writes an upload chunk by chunk to a temp file next to its destination.
+
+    The size limit is checked on every chunk and the sha256 is computed in the same pass.
+    commit() renames the temp file into place, so a half written media is never visible.
+    Files are content addressed: <path><sha256><ext>.
+    """
+
+    def __init__(self, path: str, ext: str, max_size: int = MAX_MEDIA_SIZE):
+        self.path = path
+        self.ext = ext
+        self.max_size = max_size
+        self.size = 0
+        self.temp_path = f"{path}.{uuid4()}.part"
+        self._sha256 = hashlib.sha256()
+        self._file = None
+
+    async def open(self):
+        self._file = await anyio.open_file(self.temp_path, "wb")
+
+    async def write(self, chunk: bytes):
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise HTTPException(status_code=status.HTTP_411_LENGTH_REQUIRED,
+                                detail=f"Media is too large, {self.max_size / 1024 / 1024:g}MB max.")
+        self._sha256.update(chunk)
+        with file_io_duration.time("upload_write"):
+            await self._file.write(chunk)
+        file_io_bytes.inc("upload", amount=len(chunk))
+
+    async def commit(self) -> SavedFile:
+        """Stores the file under its sha256, see store_file"""
+        with file_io_duration.time("upload_commit"):
+            return await self._commit()
+
+    async def _commit(self) -> SavedFile:
+        await self._file.aclose()
+        return await anyio.to_thread.run_sync(store_file, self.temp_path, self.path, self.ext,
+                                              self._sha256.hexdigest(), self.size)
+
+    async def abort(self):
+        if self._file is not None:
+            await self._file.aclose()
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+async def save_file(request: Request, path: str, field_name: str = "in_file") -> SavedFile:
+    """Streams the `field_name` file of a multipart request body straight to `path`.
+
+    Nothing is spooled: the body is parsed as it arrives, an unsupported extension or an oversized
+    file stops the upload at the chunk where it is detected.
+    """
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type != b"multipart/form-data" or b"boundary" not in params:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail="multipart/form-data body expected")
+    messages = []
+    parser = MultipartParser(params[b"boundary"], {
+        "on_part_begin": lambda: messages.append(("part_begin", b"")),
+        "on_header_field": lambda data, start, end: messages.append(("header_field", data[start:end])),
+        "on_header_value": lambda data, start, end: messages.append(("header_value", data[start:end])),
+        "on_header_end": lambda: messages.append(("header_end", b"")),
+        "on_headers_finished": lambda: messages.append(("headers_finished", b"")),
+        "on_part_data": lambda data, start, end: messages.append(("part_data", data[start:end])),
+        "on_part_end": lambda: messages.append(("part_end", b"")),
+    })
+    header_field, header_value, content_disposition = b"", b"", b""
+    writer, in_field, saved = None, False, None
+    try:
+        async for chunk in request.stream():
+            parser.write(chunk)
+            current = list(messages)
+            messages.clear()
+            for message, data in current:
+                if message == "part_begin":
+                    content_disposition = b""
+                elif message == "header_field":
+                    header_field += data
+                elif message == "header_value":
+                    header_value += data
+                elif message == "header_end":
+                    if header_field.lower() == b"content-disposition":
+                        content_disposition = header_value
+                    header_field, header_value = b"", b""
+                elif message == "headers_finished":
+                    disposition, options = parse_options_header(content_disposition)
+                    in_field = saved is None and options.get(b"name") == field_name.encode()
+                    if in_field:
+                        ext = check_extension(options.get(b"filename", b"").decode("utf-8", "replace"))
+                        writer = MediaWriter(path, ext)
+                        await writer.open()
+                elif message == "part_data" and in_field:
+                    await writer.write(data)
+                elif message == "part_end" and in_field:
+                    saved, in_field = await writer.commit(), False
+        parser.finalize()
+    except MultipartParseError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST,
+                            detail="Malformed multipart body")
+    finally:
+        if writer is not None and saved is None:
+            await writer.abort()
+    if saved is None:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY,
+                            detail=f"Field {field_name} is required")
+    return saved
@@ -0,0 +1,177 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Callable
+
+from sqlalchemy import inspect
+from sqlalchemy.engine import Connection
+from sqlalchemy.ext.asyncio import AsyncEngine
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
+
+from ..cache import token_cache
+from .metrics import write_batch_size, write_batch_duration
+
+logger = logging.getLogger(__name__)
+
+# Group commit of the request writes, off by default. SQLite has one writer at a time and a commit per
+# request: under a steady write load the requests mostly wait for the write lock and the WAL syncs.
+# With WRITE_COALESCING=1 a single writer task takes the pending writes every WRITE_BATCH_DELAY_MS
+# (or as soon as WRITE_BATCH_MAX_OPS are waiting) and applies them in one transaction.
+WRITE_COALESCING = os.environ.get("WRITE_COALESCING", "0") == "1"
+WRITE_BATCH_MAX_OPS = int(os.environ.get("WRITE_BATCH_MAX_OPS", 64))
+WRITE_BATCH_DELAY_MS = float(os.environ.get("WRITE_BATCH_DELAY_MS", 2))
+
+
+class _BatchSession(Session):
+    """The session the crud write functions run in inside a batch. Every operation has its own savepoint:
+    their commit only flushes, their rollback (the IntegrityError retries) only undoes their own changes.
+    The batch commits once, after the last operation."""
+
+    _savepoint = None
+
+    def commit(self):
+        self.flush()
+
+    def rollback(self):
+        self._savepoint.rollback()
+        self._savepoint = self.begin_nested()
+
+
+class _Operation:
+    __slots__ = ("function", "args", "future", "result", "error")
+
+    def __init__(self, function: Callable, args: tuple, future: asyncio.Future):
+        self.function = function
+        self.args = args
+        self.future = future
+        self.result = None
+        self.error: BaseException | None = None
+
+
+class WriteBatcher:
+    """Applies the writes of many requests in one transaction.
+
+    run() queues a crud write function with its arguments and waits for its own result or exception.
+    The writer task takes up to max_ops queued operations, runs each one in a savepoint of a single
+    transaction and commits once: an operation that raises is rolled back alone, the others are kept.
+    A failed commit fails every operation of the batch. When the batcher is not started, run() executes
+    the function in the session of the request, as before.
+    """
+
+    def __init__(self, max_ops: int = WRITE_BATCH_MAX_OPS, delay_ms: float = WRITE_BATCH_DELAY_MS):
+        self.max_ops = max_ops
+        self.delay = delay_ms / 1000
+        self._queue: asyncio.Queue | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None
+
+    def start(self, engine: AsyncEngine):
+        self._queue = asyncio.Queue()
+        self._task = asyncio.create_task(self._run(engine))
+
+    async def stop(self):
+        """Applies the operations queued so far, then stops the writer task. Operations queued after the stop
+        fail. When stop() itself is cancelled, the writer is cancelled and fails its batch, see _run."""
+        if self._task is None:
+            return
+        self._queue.put_nowait(None)  # the writer exits once it reaches it
+        try:
+            await asyncio.wait([self._task])
+        except asyncio.CancelledError:
+            self._task.cancel()
+            raise
+        finally:
+            while not self._queue.empty():
+                operation = self._queue.get_nowait()
+                if operation is not None and not operation.future.done():
+                    operation.future.set_exception(RuntimeError("The write batcher was stopped"))
+            self._queue = self._task = None
+
+    async def run(self, session: AsyncSession, function: Callable, *args) -> Any:
+        """function(session, *args) in the next batch. ORM instances in args are merged into the batch
+        session, the ORM instances returned are detached from it with their loaded attributes."""
+        if self._task is None:
+            return await session.run_sync(function, *args)
+        future = asyncio.get_running_loop().create_future()
+        self._queue.put_nowait(_Operation(function, args, future))
+        return await future
+
+    async def _run(self, engine: AsyncEngine):
+        stopping = False
+        while not stopping:
+            batch = [await self._queue.get()]
+            if batch[0] is None:
+                return
+            try:
+                if self._queue.qsize() < self.max_ops - 1:
+                    await asyncio.sleep(self.delay)  # let the concurrent requests join the batch
+                while len(batch) < self.max_ops and not self._queue.empty():
+                    operation = self._queue.get_nowait()
+                    if operation is None:
+                        stopping = True
+                        break
+                    batch.append(operation)
+                await self._commit_batch(engine, batch)
+            except asyncio.CancelledError:
+                # the operations were dequeued already, stop() can not fail them: their requests would wait
+                # forever. Cancelled in the middle of the transaction, their writes may or may not be committed.
+                for operation in batch:
+                    if not operation.future.done():
+                        operation.future.set_exception(RuntimeError("The write batcher was stopped"))
+                raise
+
+    async def _commit_batch(self, engine: AsyncEngine, batch: list[_Operation]):
+        try:
+            start = time.perf_counter()
+            async with engine.connect() as conn:
+                await conn.run_sync(self._apply, batch)
+            write_batch_duration.observe(time.perf_counter() - start)
+            write_batch_size.observe(len(batch))
+        except Exception as ex:
+            logger.exception("Write batch of %s operations failed", len(batch))
+            for operation in batch:
+                operation.error = ex
+        for operation in batch:
+            if operation.future.done():  # the request was cancelled, its write stays committed
+                continue
+            if operation.error is not None:
+                operation.future.set_exception(operation.error)
+            else:
+                operation.future.set_result(operation.result)
+
+    @staticmethod
+    def _apply(conn: Connection, batch: list[_Operation]):
+        if conn.dialect.name == "sqlite":
+            # take the write lock before the first read, a deferred transaction could not be upgraded later
+            conn.exec_driver_sql("BEGIN IMMEDIATE")
+        # bound to a connection in a transaction, the session never commits it: conn.commit() below does
+        session = _BatchSession(bind=conn, expire_on_commit=False)
+        try:
+            for operation in batch:
+                session._savepoint = session.begin_nested()
+                try:
+                    args = tuple(session.merge(arg, load=False) if inspect(arg, raiseerr=False) is not None
+                                 else arg for arg in operation.args)
+                    operation.result = operation.function(session, *args)
+                    session.flush()
+                    session._savepoint.commit()
+                except Exception as ex:
+                    session._savepoint.rollback()
+                    operation.error = ex
+                # the next operations see the DB, not the objects of this one
+                session.expunge_all()
+            conn.commit()
+        finally:
+            session.close()
+        # the crud functions dropped the cached principals they changed when the batch was not committed
+        # yet, a concurrent authentication may have cached the old state again
+        for email in session.info.get("invalidated_users", ()):
+            token_cache.invalidate_user(email)
+
+
+write_batcher = WriteBatcher()
@@ -1,3 +1,5 @@
+import os
+
 from fastapi import FastAPI
 from fastapi.responses import RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
@@ -10,7 +12,13 @@ import uvicorn
 from api.v1.user import api_router as user_route
 from api.v1.media_user import api_router as media_user_route
 from api.v1.security import api_router as security_route
-from db.database import create_db_and_tables
+from api.media_files import MediaFiles
+from api.metrics import MetricsMiddleware, api_router as metrics_route
+from db.database import migrate_db, make_async_session, async_engine
+from db.hashing import password_hasher
+from db.utils.derivatives import derivative_pipeline
+from db.utils.deletion import deletion_worker
+from db.utils.write_batch import write_batcher, WRITE_COALESCING
 
 
 # logger = logging.getLogger(__name__)
@@ -22,10 +30,12 @@ app = FastAPI()
 # logger = CustomizeLogger.make_logger(config_path)
 # app.logger = logger
 
+app.mount("/static/media_user", MediaFiles(directory="static/media_user"), name="media_user")
 app.mount("/static", StaticFiles(directory="static"), name="static")
 app.include_router(user_route, prefix='/api/v1/users', tags=['user'])
 app.include_router(media_user_route, prefix='/api/v1/media_user', tags=['media_user'])
 app.include_router(security_route, prefix='/api/v1/security', tags=['security'])
+app.include_router(metrics_route)
 
 
 # Enable CORS
@@ -36,11 +46,26 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+# Outermost, so the latency covers the other middlewares
+app.add_middleware(MetricsMiddleware)
 
 
 @app.on_event("startup")
-def on_startup():
-    create_db_and_tables()
+async def on_startup():
+    migrate_db()
+    # read at startup, not at import: serve.py sets it per worker, after a --preload import
+    if os.environ.get("DELETION_WORKER", "1") != "0":
+        deletion_worker.start(make_async_session)
+    if WRITE_COALESCING:
+        write_batcher.start(async_engine)
+
+
+@app.on_event("shutdown")
+async def on_shutdown():
+    await write_batcher.stop()
+    await deletion_worker.stop()
+    password_hasher.shutdown()
+    derivative_pipeline.shutdown()
 
 
 @app.get("/")
@@ -1,4 +1,4 @@
-from typing import Optional, List
+from typing import Optional, List, NamedTuple
 import enum
 from sqlmodel import SQLModel, Field, Relationship
 from sqlalchemy import Column, VARCHAR
@@ -29,18 +29,21 @@ class User(BaseUser, table=True):
     hash_pass: str = Field(exclude=True)
     privileges: Privileges
     is_active: bool
-    created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+    created_at: str = Field(default_factory=lambda: datetime.now().isoformat(), index=True)
     updated_at: str | None
     media: Optional[List["MediaUser"]] = Relationship(sa_relationship_kwargs={"cascade": "delete"},
                                                       back_populates="user")
 
 
-class UserResponse(BaseUser):
+class UserSummary(BaseUser):
     id: int = Field(primary_key=True)
     privileges: Privileges
     is_active: bool
     created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
     updated_at: str | None
+
+
+class UserResponse(UserSummary):
     media: Optional[List["MediaUser"]]
 
 
@@ -53,14 +56,68 @@ class UserUpdateAdmin(BaseUser):
     is_active: bool
 
 
+class MediaBlob(SQLModel, table=True):
+    """Content addressed media file, shared by every MediaUser with the same content"""
+    __tablename__ = "media_blobs"
+    sha256: str = Field(primary_key=True)
+    path: str = Field(index=True)
+    size: int
+    ref_count: int = 0
+    created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+
+
+class FileTombstone(SQLModel, table=True):
+    """File to remove, written in the transaction that deletes its last reference, see db/utils/deletion.py"""
+    __tablename__ = "file_tombstones"
+    id: int = Field(primary_key=True)
+    path: str
+    created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
+
+
+class ChangeMark(SQLModel, table=True):
+    """Last change that left no timestamp on the rows (deletions, new derivatives) per scope,
+    written by the triggers of migration 5, read by the response versions of db/crud.py"""
+    __tablename__ = "change_marks"
+    scope: str = Field(primary_key=True)
+    changed_at: str
+
+
+class UploadSession(SQLModel, table=True):
+    """Resumable upload of a media in chunks, see db/utils/uploads.py. The bytes received so far are the
+    size of its part file, not a column: a chunk costs no write to the DB."""
+    __tablename__ = "upload_sessions"
+    id: str = Field(default_factory=lambda: uuid4().hex, primary_key=True)
+    user_id: int = Field(foreign_key='users.id')
+    ext: str
+    size: int  # announced at creation, the upload is complete when the part file has this size
+    created_at: str = Field(default_factory=lambda: datetime.now().isoformat(), index=True)
+
+
+class UploadSessionCreate(SQLModel):
+    filename: str
+    size: int
+
+
+class UploadSessionResponse(SQLModel):
+    id: str
+    user_id: int
+    size: int
+    offset: int  # bytes received, the next chunk starts there
+    expires_at: str
+
+
 class MediaUserBase(SQLModel):
     media_path: str
+    sha256: Optional[str] = None
+    derivatives: Optional[str] = None  # comma separated sizes ready to be fetched, see db/utils/derivatives.py
 
 
 class MediaUser(MediaUserBase, table=True):
     __tablename__ = "media_users"
     id: int = Field(primary_key=True)
-    user_id: Optional[int] = Field(foreign_key='users.id')
+    media_path: str = Field(index=True)
+    user_id: Optional[int] = Field(foreign_key='users.id', index=True)
+    sha256: Optional[str] = Field(default=None, foreign_key='media_blobs.sha256', index=True)
     created_at: str = Field(default_factory=lambda: datetime.now().isoformat())
     user: Optional[User] = Relationship(back_populates="media")  # TODO почему не могу заменить на UserResponse?
 
@@ -75,5 +132,60 @@ class MediaUserResponse(MediaUserBase):
     user: Optional[User]  # TODO почему не могу заменить на UserResponse?
 
 
+# Read model of the list endpoints (crud.get_user_rows, crud.get_media_rows_by_user_id): plain tuples of the
+# response columns, no identity map, no validation and no hash_pass. Same attribute names as the ORM
+# classes, the payload builders of api/serialization.py take either.
+class MediaRow(NamedTuple):
+    media_path: str
+    sha256: Optional[str]
+    derivatives: Optional[str]
+    id: int
+    user_id: Optional[int]
+    created_at: str
+
+
+class UserRow(NamedTuple):
+    login: str
+    email: str
+    full_name: str
+    id: int
+    privileges: Privileges
+    is_active: bool
+    created_at: str
+    updated_at: Optional[str]
+    media: Optional[List[MediaRow]] = None  # None when the media were not loaded
+
+
+class MediaUserRow(NamedTuple):
+    media_path: str
+    sha256: Optional[str]
+    derivatives: Optional[str]
+    id: int
+    created_at: str
+    user: Optional[UserRow]
+
+
+class UserImportResult(SQLModel):
+    row: int  # 1-based, header line excluded
+    id: Optional[int]
+    error: Optional[str]
+
+
+class UserImportReport(SQLModel):
+    created: int
+    failed: int
+    results: List[UserImportResult]
+
+
+class UserPage(SQLModel):
+    items: List[UserResponse]
+    next_cursor: Optional[str]
+
+
+class MediaUserPage(SQLModel):
+    items: List[MediaUserResponse]
+    next_cursor: Optional[str]
+
+
 User.update_forward_refs()
 UserResponse.update_forward_refs()
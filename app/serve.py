@@ -0,0 +1,271 @@
+"""Production launcher: python serve.py --workers 4 [--preload]
+
+The supervisor binds the listening socket once and runs the uvicorn workers on it, with uvloop and httptools.
+A worker opens its DB connections and sends one request to every read route in-process before it starts
+accepting connections, so the first clients do not pay for the connection setup and the route, validator
+and SQL statement compilation. Until then the kernel queues the connections in the backlog.
+
+--preload imports the application once in the supervisor and forks the workers from it: the workers share
+the imported code and start faster. Without it every worker is a fresh process importing the application.
+
+Signals to the supervisor:
+    SIGTERM, SIGINT   graceful shutdown: the workers stop accepting, finish their requests, then exit,
+                      they are killed after --graceful-timeout seconds
+    SIGHUP            rolling restart: one worker at a time, a new worker is started and warmed up before
+                      the old one is stopped, so the capacity never drops. Without --preload the new
+                      workers load the current code; with it they are forked from the code loaded at startup.
+A worker that dies is replaced.
+
+Per process resources are sized for the whole machine, not for one worker: unless set explicitly, the supervisor
+exports HASH_POOL_SIZE and DERIVATIVE_POOL_SIZE divided by the number of workers, so the bcrypt and resizing
+processes of all the workers add up to the CPUs. The deletion worker and the media GC run in one worker only
+(DELETION_WORKER=0 in the others), the one that replaces it takes them over.
+"""
+import argparse
+import asyncio
+import logging
+import multiprocessing
+import os
+import signal
+import socket
+import time
+
+import uvicorn
+from uvicorn.importer import import_from_string
+
+logger = logging.getLogger("serve")
+# in the workers, where uvicorn configured the logging
+worker_logger = logging.getLogger("uvicorn.error")
+
+SERVER_HOST = os.environ.get("SERVER_HOST", "0.0.0.0")
+SERVER_PORT = int(os.environ.get("SERVER_PORT", 8000))
+# Same variable as gunicorn / the uvicorn docker images
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", os.cpu_count() or 1))
+# Pending connections the kernel queues while every worker is busy (capped by net.core.somaxconn)
+SERVER_BACKLOG = int(os.environ.get("SERVER_BACKLOG", 2048))
+# Idle keep-alive seconds, above the 60s idle timeout of the usual load balancers: the proxy, not the
+# worker, closes idle connections, so it never sends a request on a connection being closed
+SERVER_KEEP_ALIVE = int(os.environ.get("SERVER_KEEP_ALIVE", 75))
+SERVER_GRACEFUL_TIMEOUT = float(os.environ.get("SERVER_GRACEFUL_TIMEOUT", 30))
+# Seconds a new worker has to import the application and warm up
+SERVER_START_TIMEOUT = float(os.environ.get("SERVER_START_TIMEOUT", 60))
+
+# Sent to every worker before it accepts traffic, the status does not matter
+WARMUP_REQUESTS = [
+    ("GET", "/api/v1/users/", "limit=1"),
+    ("GET", "/api/v1/users/", "limit=1&cursor="),
+    ("GET", "/api/v1/users/", "limit=1&media=false"),
+    ("GET", "/api/v1/users/1", ""),
+    ("GET", "/api/v1/users/user1@mail.ru", ""),
+    ("GET", "/api/v1/users/search", "q=user1"),
+    ("GET", "/api/v1/users/search", "q=user1&fuzzy=true"),
+    ("GET", "/api/v1/media_user/1", "limit=1"),
+    ("GET", "/api/v1/media_user/1", "limit=1&cursor="),
+    ("GET", "/api/v1/security/about_me", ""),
+    ("GET", "/metrics", ""),
+]
+
+
+async def local_request(app, method: str, path: str, query_string: str = "") -> int:
+    """One request through the ASGI app, without a connection, returns the status"""
+    scope = {
+        "type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": method, "scheme": "http",
+        "path": path, "raw_path": path.encode(), "root_path": "", "query_string": query_string.encode(),
+        "headers": [(b"host", b"localhost"), (b"x-request-id", b"warmup")],
+        "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 0),
+    }
+    response = {"status": 0}
+    response_done = asyncio.Event()
+    request_sent = False
+
+    async def receive():
+        nonlocal request_sent
+        if not request_sent:
+            request_sent = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await response_done.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        if message["type"] == "http.response.start":
+            response["status"] = message["status"]
+        elif message["type"] == "http.response.body" and not message.get("more_body", False):
+            response_done.set()
+
+    await app(scope, receive, send)
+    return response["status"]
+
+
+async def warmup(app):
+    from db.database import async_engine, async_read_engine
+
+    # fills the pools: checked out all at once, every connection is a new one
+    pool_size = 0
+    for engine in {async_engine, async_read_engine}:
+        size = getattr(engine.sync_engine.pool, "size", lambda: 1)()
+        connections = await asyncio.gather(*(engine.connect() for _ in range(size)))
+        await asyncio.gather(*(connection.close() for connection in connections))
+        pool_size += size
+    start = time.perf_counter()
+    for method, path, query_string in WARMUP_REQUESTS:
+        try:
+            await local_request(app, method, path, query_string)
+        except Exception:
+            worker_logger.warning("Warmup request %s %s failed", method, path, exc_info=True)
+    worker_logger.info("Worker %s warmed up: %s connections, %s requests in %.0f ms", os.getpid(), pool_size,
+                len(WARMUP_REQUESTS), (time.perf_counter() - start) * 1000)
+
+
+def run_worker(options: argparse.Namespace, sock: socket.socket, ready, app=None, background: bool = True):
+    # the supervisor handles SIGHUP, a terminal hangup must not kill the workers
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    os.environ["DELETION_WORKER"] = "1" if background else "0"
+    # a forked worker inherits the supervisor root handler, uvicorn has its own
+    logging.getLogger().handlers.clear()
+    if app is None:
+        app = import_from_string(options.app)
+    config = uvicorn.Config(
+        app, loop=options.loop, http=options.http, lifespan="on", backlog=options.backlog,
+        timeout_keep_alive=options.keep_alive, limit_concurrency=options.limit_concurrency,
+        limit_max_requests=options.max_requests, access_log=options.access_log, log_level=options.log_level,
+        proxy_headers=True, forwarded_allow_ips=options.forwarded_allow_ips, server_header=False)
+
+    async def warmup_then_ready():
+        # last startup handler: the DB tables exist and the background workers run
+        if options.warmup:
+            await warmup(app)
+        ready.set()
+
+    app.router.on_startup.append(warmup_then_ready)
+    uvicorn.Server(config).run(sockets=[sock])
+
+
+class Supervisor:
+    def __init__(self, options: argparse.Namespace):
+        self.options = options
+        self.context = multiprocessing.get_context("fork" if options.preload else "spawn")
+        self.app = import_from_string(options.app) if options.preload else None
+        self.workers: list[multiprocessing.Process] = []
+        # the worker running the background jobs
+        self.background: multiprocessing.Process | None = None
+        self.sock: socket.socket | None = None
+        self.should_exit = False
+        self.should_restart = False
+
+    def bind(self) -> socket.socket:
+        family = socket.AF_INET6 if ":" in self.options.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.options.host, self.options.port))
+        sock.listen(self.options.backlog)
+        sock.set_inheritable(True)
+        return sock
+
+    def spawn(self, background: bool = False) -> multiprocessing.Process | None:
+        """Starts a worker and waits until it is warmed up, None when it does not get there"""
+        ready = self.context.Event()
+        kwargs = {"app": self.app} if self.options.preload else {}
+        process = self.context.Process(target=run_worker, args=(self.options, self.sock, ready),
+                                       kwargs={**kwargs, "background": background})
+        process.start()
+        deadline = time.monotonic() + self.options.start_timeout
+        while not ready.wait(0.1):
+            if not process.is_alive() or time.monotonic() > deadline or self.should_exit:
+                logger.error("Worker %s failed to start", process.pid)
+                self.stop_worker(process)
+                return None
+        logger.info("Worker %s ready%s", process.pid, ", running the background jobs" if background else "")
+        if background:
+            self.background = process
+        return process
+
+    def stop_worker(self, process: multiprocessing.Process):
+        if process.is_alive():
+            process.terminate()  # SIGTERM: uvicorn drains the connections then exits
+        process.join(self.options.graceful_timeout)
+        if process.is_alive():
+            logger.warning("Worker %s still running after %s s, killed", process.pid, self.options.graceful_timeout)
+            process.kill()
+            process.join()
+
+    def rolling_restart(self):
+        logger.info("Rolling restart of %s workers", len(self.workers))
+        for index, old in enumerate(list(self.workers)):
+            # the jobs run twice until the old worker is stopped, they are safe to run concurrently
+            new = self.spawn(background=old is self.background)
+            if new is None:
+                logger.error("Rolling restart aborted, the remaining workers keep running")
+                return
+            self.workers[index] = new
+            self.stop_worker(old)
+
+    def handle_signal(self, signum, frame):
+        if signum == signal.SIGHUP:
+            self.should_restart = True
+        else:
+            self.should_exit = True
+
+    def run(self):
+        self.sock = self.bind()
+        for signum in (signal.SIGTERM, signal.SIGINT, signal.SIGHUP):
+            signal.signal(signum, self.handle_signal)
+        logger.info("Listening on %s:%s, %s workers, loop=%s http=%s%s", self.options.host, self.options.port,
+                    self.options.workers, self.options.loop, self.options.http,
+                    ", preloaded" if self.options.preload else "")
+        try:
+            while not self.should_exit:
+                if self.should_restart:
+                    self.should_restart = False
+                    self.rolling_restart()
+                self.workers = [process for process in self.workers if process.is_alive()]
+                if len(self.workers) < self.options.workers:
+                    process = self.spawn(background=self.background not in self.workers)
+                    if process is not None:
+                        self.workers.append(process)
+                    elif not self.workers and not self.should_exit:
+                        time.sleep(1)  # the application does not start, do not spin
+                    continue
+                time.sleep(0.2)
+        finally:
+            logger.info("Shutting down %s workers", len(self.workers))
+            for process in self.workers:
+                if process.is_alive():
+                    process.terminate()
+            for process in self.workers:
+                self.stop_worker(process)
+            self.sock.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--app", default="main:app")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--workers", type=int, default=WEB_CONCURRENCY)
+    parser.add_argument("--preload", action="store_true", help="import the application before forking the workers")
+    parser.add_argument("--loop", choices=["uvloop", "asyncio"], default="uvloop")
+    parser.add_argument("--http", choices=["httptools", "h11"], default="httptools")
+    parser.add_argument("--backlog", type=int, default=SERVER_BACKLOG)
+    parser.add_argument("--keep-alive", type=int, default=SERVER_KEEP_ALIVE, help="idle keep-alive seconds")
+    parser.add_argument("--limit-concurrency", type=int, default=None,
+                        help="connections + tasks a worker accepts before answering 503")
+    parser.add_argument("--max-requests", type=int, default=None, help="requests after which a worker is replaced")
+    parser.add_argument("--graceful-timeout", type=float, default=SERVER_GRACEFUL_TIMEOUT)
+    parser.add_argument("--start-timeout", type=float, default=SERVER_START_TIMEOUT)
+    parser.add_argument("--no-warmup", dest="warmup", action="store_false")
+    parser.add_argument("--forwarded-allow-ips", default=os.environ.get("FORWARDED_ALLOW_IPS", "127.0.0.1"))
+    parser.add_argument("--access-log", action="store_true")
+    parser.add_argument("--log-level", default="info")
+    options = parser.parse_args()
+    logging.basicConfig(level=options.log_level.upper(), format="%(asctime)s [%(process)d] %(levelname)s %(message)s")
+    # before the application is imported: the workers size their per process state on them, e.g. the token cache
+    # TTL, and the process pools share the CPUs between the workers
+    os.environ["WEB_CONCURRENCY"] = str(options.workers)
+    cpus = os.cpu_count() or 1
+    os.environ.setdefault("HASH_POOL_SIZE", str(max(cpus // options.workers, 1)))
+    os.environ.setdefault("DERIVATIVE_POOL_SIZE", str(max(cpus // 2 // options.workers, 1)))
+    Supervisor(options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+import asyncio
+
+import pytest
+from fastapi.exceptions import HTTPException
+
+from api.admission import ConcurrencyLimiter, TokenBucketLimiter
+
+
+def test_concurrency_limiter_queue_and_rejection():
+    limiter = ConcurrencyLimiter("test", limit=1, queue=1, timeout=0.2, retry_after=2)
+
+    async def hold(seconds: float):
+        async with limiter:
+            await asyncio.sleep(seconds)
+        return "ok"
+
+    async def run():
+        return await asyncio.gather(hold(0.1), hold(0), hold(0), return_exceptions=True)
+
+    first, queued, rejected = asyncio.run(run())
+    assert (first, queued) == ("ok", "ok")
+    assert isinstance(rejected, HTTPException) and rejected.status_code == 503
+    assert rejected.headers["Retry-After"] == "2"
+
+    async def run_timeout():
+        return await asyncio.gather(hold(0.5), hold(0), return_exceptions=True)
+
+    _, timed_out = asyncio.run(run_timeout())
+    assert isinstance(timed_out, HTTPException) and timed_out.status_code == 503
+    assert limiter.waiting == 0
+
+
+def test_token_bucket_limiter():
+    limiter = TokenBucketLimiter("test", rate=10, burst=2)
+    assert limiter.take("a") == 0 and limiter.take("a") == 0
+    assert limiter.take("a") == pytest.approx(0.1, abs=0.01)
+    assert limiter.take("b") == 0
+    assert TokenBucketLimiter("test", rate=0, burst=0).take("a") == 0
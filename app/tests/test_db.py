@@ -1,21 +1,41 @@
-from sqlmodel import SQLModel, create_engine, Session
+from sqlmodel import Session
+from sqlmodel.ext.asyncio.session import AsyncSession
 from sqlmodel.sql.expression import Select, SelectOfScalar
 import os.path
 
+from db.config import get_settings, build_engine, build_async_engine
+from db.migrations import upgrade
+
 SelectOfScalar.inherit_cache = True  # type: ignore
 Select.inherit_cache = True  # type: ignore
 
-SQL_ALCHEMY_DATABASE_URL = "sqlite:///test_sql_app.db"
+settings = get_settings("test")
 
-engine = create_engine(
-    SQL_ALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+engine = build_engine(settings)
+async_engine = build_async_engine(settings)
+async_read_engine = build_async_engine(settings.for_reads(), read_only=True)
 
-if os.path.exists("test_sql_app.db"):
-    os.remove("test_sql_app.db")
+for path in ("test_sql_app.db", "test_sql_app.db-wal", "test_sql_app.db-shm"):
+    if os.path.exists(path):
+        os.remove(path)
 
-SQLModel.metadata.create_all(engine)
+upgrade(engine)
 
 
 def override_get_session():
     with Session(engine) as session:
         yield session
+
+
+async def override_get_async_session():
+    async with AsyncSession(async_engine, expire_on_commit=False) as session:
+        yield session
+
+
+async def override_get_async_read_session():
+    async with AsyncSession(async_read_engine, expire_on_commit=False) as session:
+        yield session
+
+
+def override_get_async_session_factory():
+    return lambda: AsyncSession(async_engine, expire_on_commit=False)
@@ -0,0 +1,41 @@
+import asyncio
+
+from db.hashing import PasswordHasher, make_context, verify_and_update, calibrate_rounds
+
+
+def test_verify_and_update_rehashes_other_cost():
+    old_hash = make_context(4).hash("password1")
+    is_valid, new_hash = verify_and_update("password1", old_hash, rounds=5)
+    assert is_valid
+    assert new_hash.startswith("$2b$05$")
+    assert verify_and_update("password1", new_hash, rounds=5) == (True, None)
+    assert verify_and_update("wrong", old_hash, rounds=5) == (False, None)
+
+
+def test_password_hasher_pool():
+    hasher = PasswordHasher(workers=1, max_concurrency=1, rounds=4)
+
+    async def run():
+        hashes = await asyncio.gather(*(hasher.hash(f"password{i}") for i in range(3)))
+        return [await hasher.verify(f"password{i}", hashed) for i, hashed in enumerate(hashes)]
+
+    try:
+        assert asyncio.run(run()) == [True, True, True]
+    finally:
+        hasher.shutdown()
+
+
+def test_password_hasher_hash_many():
+    hasher = PasswordHasher(workers=2, max_concurrency=2, rounds=4)
+    passwords = [f"password{i}" for i in range(5)]
+    try:
+        hashes = asyncio.run(hasher.hash_many(passwords))
+    finally:
+        hasher.shutdown()
+    assert len(hashes) == 5
+    assert all(make_context(4).verify(password, hashed) for password, hashed in zip(passwords, hashes))
+    assert asyncio.run(PasswordHasher(workers=0).hash_many([])) == []
+
+
+def test_calibrate_rounds():
+    assert calibrate_rounds(target_ms=0, min_rounds=4, max_rounds=5, samples=1) == 4
@@ -1,14 +1,64 @@
+import asyncio
+import csv
+import hashlib
+import io
+import json
+import os
+import time
+
+import msgpack
 import pytest
+from PIL import Image
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi.encoders import jsonable_encoder
+from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.testclient import TestClient
+from starlette.datastructures import Headers
 
 from main import app
-from db.database import get_session
-from tests.test_db import override_get_session
+from api.media_files import MediaFiles, MediaFileResponse
+from api.serialization import user_payload, media_user_payload
+from models.models import UserResponse, MediaUserResponse
+import db.async_crud as async_crud
+import db.crud as crud
+from db.config import EngineSettings
+from db.database import get_session, get_async_session, get_async_read_session, get_async_session_factory
+from db.utils.query_counter import QueryCounter
+from db.utils.deletion import DeletionWorker
+from db.utils import uploads
+from api.admission import login_rate_limit, login_limiter
+from api.v1 import security, media_user as media_user_api
+from db.cache import token_cache
+from db.hashing import password_hasher
+from db.utils.derivatives import derivative_pipeline, parse_derivative_sizes, make_derivatives
+from tests.test_db import override_get_session, override_get_async_session, override_get_async_read_session, \
+    override_get_async_session_factory, async_engine, async_read_engine
 
 app.dependency_overrides[get_session] = override_get_session
+app.dependency_overrides[get_async_session] = override_get_async_session
+app.dependency_overrides[get_async_read_session] = override_get_async_read_session
+app.dependency_overrides[get_async_session_factory] = override_get_async_session_factory
 client = TestClient(app, root_path='/app')
 
 
+def run_deletion_worker(worker: DeletionWorker | None = None, gc: bool = False) -> int:
+    worker = worker or DeletionWorker()
+
+    async def run():
+        async for session in override_get_async_session():
+            if gc:
+                await worker.collect_garbage(session)
+            return await worker.process_tombstones(session)
+    return asyncio.run(run())
+
+
+def file_sha256(path):
+    with open(path, 'rb') as file:
+        return hashlib.sha256(file.read()).hexdigest()
+
+
 @pytest.mark.parametrize("user_id", [-1, 0, 1, 'user', ' ', '123'])
 def test_get_user_by_id_or_email(user_id):
     response = client.get(f"/api/v1/users/{user_id}")
@@ -45,6 +95,21 @@ def test_add_user_ok(login, email, full_name, password):
     # assert response.json() == []
 
 
+def test_get_users_cursor():
+    response = client.get(f"/api/v1/users/", params={"cursor": "", "limit": 1})
+    assert response.status_code == 200
+    page = response.json()
+    assert [user["login"] for user in page["items"]] == ["user1"]
+    page = client.get(f"/api/v1/users/", params={"cursor": page["next_cursor"], "limit": 1}).json()
+    assert [user["login"] for user in page["items"]] == ["user2"]
+    page = client.get(f"/api/v1/users/", params={"cursor": page["next_cursor"], "limit": 1}).json()
+    assert page == {"items": [], "next_cursor": None}
+    assert client.get(f"/api/v1/users/", params={"cursor": "not a cursor"}).status_code == 400
+    for url in ["/api/v1/users/", "/api/v1/media_user/1"]:  # SQLite reads a negative LIMIT as no limit
+        for params in [{"limit": -1}, {"limit": 0}, {"limit": 10 ** 6}, {"offset": -1}]:
+            assert client.get(url, params={"cursor": "", **params}).status_code == 422
+
+
 @pytest.mark.parametrize("login, email, full_name, password",
                          [("user1", "user3@mail.ru", "User3 U", "password3"),
                           ("user4", "user1@mail.ru", "User4 U", "password4"),
@@ -102,6 +167,77 @@ def test_update_user_bad(login, email, full_name, password, old_password):
     assert response.status_code == 401
 
 
+def test_login_and_about_me():
+    response = client.post(f"/api/v1/security/token",
+                           data={"username": "user1@mail.ru", "password": "password1"})
+    assert response.status_code == 200
+    token = response.json()["access_token"]
+    response = client.get(f"/api/v1/security/about_me", headers={"Authorization": f"Bearer {token}"})
+    assert response.status_code == 200
+    assert response.json()["email"] == "user1@mail.ru"
+
+
+def test_login_burst_releases_connections(monkeypatch):
+    # every login of the burst waits on bcrypt at the same time: none of them may hold a pooled connection
+    burst, checked_out = login_limiter.limit, []
+    verify_and_update = password_hasher.verify_and_update
+
+    async def run():
+        all_in = asyncio.Event()
+
+        async def verify_all_in(password, hash_pass):
+            index = len(checked_out)
+            checked_out.append(None)
+            if len(checked_out) == burst:
+                all_in.set()
+            await all_in.wait()
+            checked_out[index] = async_engine.pool.checkedout()
+            return await verify_and_update(password, hash_pass)
+        monkeypatch.setattr(password_hasher, "verify_and_update", verify_all_in)
+
+        async def login():
+            async for session in override_get_async_session():
+                form = OAuth2PasswordRequestForm(username="user1@mail.ru", password="password1", scope="")
+                return await security.login(form, session)
+        return await asyncio.gather(*(login() for _ in range(burst)))
+    assert all(token["access_token"] for token in asyncio.run(run()))
+    assert checked_out == [0] * burst
+
+
+def test_user_writes_hash_without_connection(monkeypatch):
+    checked_out = []
+
+    def checking(function):
+        async def checked(*args):
+            checked_out.append(async_engine.pool.checkedout())
+            return await function(*args)
+        return checked
+    monkeypatch.setattr(password_hasher, "hash", checking(password_hasher.hash))
+    monkeypatch.setattr(password_hasher, "verify", checking(password_hasher.verify))
+    user = {"login": "hasher", "email": "hasher@mail.ru", "full_name": "Hasher H", "password": "secret"}
+    user_id = client.post(f"/api/v1/users/", json=user).json()["id"]
+    response = client.put(f"/api/v1/users/", json={**user, "full_name": "Hasher I", "old_password": "secret"})
+    assert response.status_code == 200 and response.json()["full_name"] == "Hasher I"
+    assert checked_out == [0, 0, 0]
+    assert client.delete(f"/api/v1/users/{user_id}").status_code == 200
+
+
+def test_about_me_token_cache():
+    token = client.post(f"/api/v1/security/token",
+                        data={"username": "user1@mail.ru", "password": "password1"}).json()["access_token"]
+    headers = {"Authorization": f"Bearer {token}"}
+    hits = token_cache.hits
+    assert client.get(f"/api/v1/security/about_me", headers=headers).json()["full_name"] == "User1 U"
+    assert client.get(f"/api/v1/security/about_me", headers=headers).json()["full_name"] == "User1 U"
+    assert token_cache.hits == hits + 1
+    assert client.get(f"/api/v1/security/token_cache").status_code == 404  # the counters are on /metrics
+    response = client.put(f"/api/v1/users/",
+                          json={"login": "user1", "email": "user1@mail.ru", "full_name": "User1 U cached",
+                                "password": "password1", "old_password": "password1"})
+    assert response.status_code == 200
+    assert client.get(f"/api/v1/security/about_me", headers=headers).json()["full_name"] == "User1 U cached"
+
+
 @pytest.mark.parametrize("user_id, img_path",
                          [(1, "tests/test_static/img_1.png"),
                           (1, "tests/test_static/img_1.png"),
@@ -125,6 +261,229 @@ def test_create_file_bad(user_id, img_path):
     assert response.status_code in [401, 409, 411]
 
 
+# the version query of the conditional requests, then the page
+@pytest.mark.parametrize("url, params, queries", [("/api/v1/users/", {}, 3),
+                                                  ("/api/v1/users/", {"cursor": ""}, 3),
+                                                  ("/api/v1/users/", {"media": False}, 2),
+                                                  ("/api/v1/media_user/1", {}, 3),
+                                                  ("/api/v1/users/1", {}, 3)])
+def test_list_query_count_constant(url, params, queries):
+    for limit in (1, 2, 3):
+        with QueryCounter(async_read_engine) as counter:
+            response = client.get(url, params={**params, "limit": limit})
+        assert response.status_code == 200
+        assert counter.count == queries, counter.statements
+        with QueryCounter(async_read_engine) as counter:
+            response = client.get(url, params={**params, "limit": limit},
+                                  headers={"If-None-Match": response.headers["etag"]})
+        assert response.status_code == 304
+        assert counter.count == 1, counter.statements
+
+
+def test_get_users_without_media():
+    users = client.get(f"/api/v1/users/", params={"media": False}).json()
+    assert len(users) == 2
+    assert all("media" not in user and "hash_pass" not in user for user in users)
+    assert len(client.get(f"/api/v1/users/").json()[0]["media"]) == 3
+
+
+def test_payloads_match_response_models():
+    async def load():
+        async for session in override_get_async_session():
+            return await async_crud.get_user_all(session), await async_crud.get_medias_user_by_user_id(session, 1)
+    users, medias = asyncio.run(load())
+    assert [user_payload(user) for user in users] == jsonable_encoder([UserResponse.validate(user) for user in users])
+    assert [media_user_payload(media) for media in medias] == \
+        jsonable_encoder([MediaUserResponse.validate(media) for media in medias])
+
+    async def load_rows():
+        async for session in override_get_async_session():
+            return await async_crud.get_user_rows(session), await async_crud.get_media_rows_by_user_id(session, 1)
+    user_rows, media_rows = asyncio.run(load_rows())
+    assert [user_payload(user) for user in user_rows] == [user_payload(user) for user in users]
+    assert [media_user_payload(media) for media in media_rows] == [media_user_payload(media) for media in medias]
+
+
+def test_get_users_msgpack():
+    json_users = client.get(f"/api/v1/users/").json()
+    response = client.get(f"/api/v1/users/", headers={"Accept": "application/msgpack"})
+    assert response.headers["content-type"] == "application/msgpack"
+    assert msgpack.unpackb(response.content) == json_users
+    response = client.get(f"/api/v1/users/", headers={"Accept": "application/json, application/msgpack;q=0.5"})
+    assert response.json() == json_users
+
+
+def test_conditional_requests(monkeypatch):
+    urls = ["/api/v1/users/1", "/api/v1/users/user1@mail.ru", "/api/v1/users/", "/api/v1/media_user/1"]
+    etags = {url: client.get(url).headers["etag"] for url in urls}
+    for url, etag in etags.items():
+        response = client.get(url, headers={"If-None-Match": f'W/"other", {etag}'})
+        assert (response.status_code, response.content, response.headers["etag"]) == (304, b"", etag)
+        assert client.get(url, headers={"If-None-Match": etag, "Accept": "application/msgpack"}).status_code == 304
+    for full_name in ("User1 renamed", "User1 U"):
+        response = client.put(f"/api/v1/users/", json={"login": "user1", "email": "user1@mail.ru",
+                                                       "full_name": full_name, "password": "password1",
+                                                       "old_password": "password1"})
+        assert response.status_code == 200
+    for url, etag in etags.items():
+        response = client.get(url, headers={"If-None-Match": etag})
+        assert response.status_code == 200 and response.headers["etag"] != etag, url
+    # Last-Modified once the second of the change is over
+    now = time.time()
+    monkeypatch.setattr("api.conditional.time.time", lambda: now + 2)
+    last_modified = client.get("/api/v1/users/").headers["last-modified"]
+    assert client.get("/api/v1/users/", headers={"If-Modified-Since": last_modified}).status_code == 304
+    assert client.get("/api/v1/users/", headers={"If-Modified-Since": "Sat, 01 Jan 2000 00:00:00 GMT"}).status_code \
+        == 200
+    # If-None-Match wins over If-Modified-Since
+    assert client.get("/api/v1/users/", headers={"If-Modified-Since": last_modified,
+                                                 "If-None-Match": 'W/"other"'}).status_code == 200
+
+
+def test_large_responses_gzipped(monkeypatch):
+    monkeypatch.setattr("api.serialization.RESPONSE_GZIP_MIN_SIZE", 200)
+    plain = client.get(f"/api/v1/users/", headers={"Accept-Encoding": "identity"})
+    assert "content-encoding" not in plain.headers
+    response = client.get(f"/api/v1/users/", headers={"Accept-Encoding": "br, gzip"})
+    assert response.headers["content-encoding"] == "gzip"
+    assert int(response.headers["content-length"]) < len(plain.content)
+    assert response.json() == plain.json() and "Accept-Encoding" in response.headers["vary"]
+    assert "content-encoding" not in client.get(f"/api/v1/users/1", params={"media": False},
+                                                headers={"Accept-Encoding": "gzip;q=0"}).headers
+
+
+def test_export_users_and_media():
+    response = client.get(f"/api/v1/users/export")
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    users = [json.loads(line) for line in response.text.splitlines()]
+    assert [user["login"] for user in users] == ["user1", "user2"]
+    assert users[0]["privileges"] == "User" and "hash_pass" not in users[0]
+    rows = list(csv.reader(io.StringIO(client.get(f"/api/v1/users/export", params={"format": "csv"}).text)))
+    assert rows[0] == ["id", "login", "email", "full_name", "privileges", "is_active", "created_at", "updated_at"]
+    assert len(rows) == 3
+    medias = client.get(f"/api/v1/media_user/export", params={"user_id": 1}).text.splitlines()
+    assert len(medias) == 3
+    assert client.get(f"/api/v1/users/export", params={"format": "xml"}).status_code == 422
+
+
+def test_media_deduplicated():
+    medias = client.get(f"/api/v1/media_user/1").json() + client.get(f"/api/v1/media_user/2").json()
+    sha256 = file_sha256("tests/test_static/img_1.png")
+    paths = {media["media_path"] for media in medias if media["sha256"] == sha256}
+    assert paths == {f"static/media_user/{sha256}.png"}
+    assert os.path.exists(paths.pop())
+
+
+def test_create_file_by_hash():
+    sha256 = file_sha256("tests/test_static/img_2.png")
+    response = client.post(f"/api/v1/media_user/1/by_hash/{sha256}")
+    assert response.status_code == 200
+    assert response.json()["media_path"] == f"static/media_user/{sha256}.png"
+    response = client.post(f"/api/v1/media_user/1/by_hash/{'0' * 64}")
+    assert response.status_code == 404
+
+
+def test_media_derivatives():
+    media = client.get(f"/api/v1/media_user/1").json()[0]
+    assert media["derivatives"] == "thumbnail,medium"
+    response = client.get(f"/api/v1/media_user/{media['id']}/file", params={"size": "thumbnail"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert os.path.exists(media["media_path"].replace(".png", ".thumbnail.png"))
+    response = client.get(f"/api/v1/media_user/{media['id']}/file", params={"size": "huge"})
+    assert response.status_code == 422
+
+
+def test_decompression_bomb_is_not_resized(monkeypatch, tmp_path):
+    path = str(tmp_path / "bomb.png")
+    with open("tests/test_static/img_1.png", "rb") as source, open(path, "wb") as file:
+        file.write(source.read())
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 10)  # img_1 is then past twice the limit, like a bomb
+    assert make_derivatives(path, {"thumbnail": 128}) == []
+
+    async def get(media_path, size):
+        raise Image.DecompressionBombError("too many pixels")
+    monkeypatch.setattr(derivative_pipeline, "get", get)  # the pool processes do not see the patched limit
+    media = client.get(f"/api/v1/media_user/1").json()[0]
+    response = client.get(f"/api/v1/media_user/{media['id']}/file", params={"size": "medium"})
+    assert response.status_code == 200 and len(response.content) == os.path.getsize(media["media_path"])
+
+
+def test_parse_derivative_sizes():
+    assert parse_derivative_sizes("thumbnail:128, medium: 512") == {"thumbnail": 128, "medium": 512}
+    for value in ("thumb", "thumb:x", "thumb:0", ":128", "a.b:128", "original:128", "a:1,a:2"):
+        with pytest.raises(ValueError, match="MEDIA_DERIVATIVE_SIZES"):
+            parse_derivative_sizes(value)
+
+
+def test_derivatives_task_holds_no_connection(monkeypatch):
+    checked_out = []
+    process = derivative_pipeline.process
+
+    async def process_checked(path):
+        checked_out.append(async_engine.pool.checkedout())
+        return await process(path)
+    monkeypatch.setattr(derivative_pipeline, "process", process_checked)
+    sha256 = file_sha256("tests/test_static/img_1.png")
+    assert client.post(f"/api/v1/media_user/2/by_hash/{sha256}").status_code == 200
+    assert checked_out == [0]
+
+
+def test_media_file_conditional_and_range():
+    media = client.get(f"/api/v1/media_user/1").json()[0]
+    size = os.path.getsize(media["media_path"])
+    for url in [f"/{media['media_path']}", f"/api/v1/media_user/{media['id']}/file"]:
+        response = client.get(url)
+        assert response.status_code == 200
+        assert response.headers["etag"] == f'"{os.path.basename(media["media_path"])}"'
+        assert "immutable" in response.headers["cache-control"]
+        assert len(response.content) == size
+        response = client.get(url, headers={"If-None-Match": response.headers["etag"]})
+        assert response.status_code == 304
+        assert response.content == b""
+        response = client.get(url, headers={"Range": "bytes=0-9"})
+        assert response.status_code == 206
+        assert response.headers["content-range"] == f"bytes 0-9/{size}"
+        assert len(response.content) == 10
+        response = client.get(url, headers={"Range": f"bytes={size}-"})
+        assert response.status_code == 416
+        response = client.get(url, headers={"Range": "bytes=5-3"})  # invalid: ignored, not unsatisfiable
+        assert response.status_code == 200 and len(response.content) == size
+        last_modified = client.get(url).headers["last-modified"]
+        response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": last_modified})
+        assert response.status_code == 206 and len(response.content) == 10
+        response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": "Thu, 01 Jan 1970 00:00:00 GMT"})
+        assert response.status_code == 200 and len(response.content) == size
+        response = client.get(url, headers={"Range": "bytes=0-9", "If-Range": '"other"'})
+        assert response.status_code == 200
+
+
+def test_media_file_zerocopy():
+    media_path = client.get(f"/api/v1/media_user/1").json()[0]["media_path"]
+    response = MediaFileResponse(media_path, os.stat(media_path), Headers({"range": "bytes=2-5"}))
+    messages = []
+
+    async def send(message):
+        if message["type"] == "http.response.zerocopysend":
+            message["file"].seek(message["offset"])
+            message = {**message, "file": message["file"].read(message["count"])}
+        messages.append(message)
+    asyncio.run(response({"type": "http", "extensions": {"http.response.zerocopysend": {}}}, None, send))
+    with open(media_path, "rb") as file:
+        assert messages[0]["status"] == 206 and messages[1]["file"] == file.read()[2:6]
+
+
+def test_media_file_offload():
+    offload_app = FastAPI()
+    offload_app.mount("/static/media_user", MediaFiles(directory="static/media_user", offload="x-accel-redirect"))
+    media_path = client.get(f"/api/v1/media_user/1").json()[0]["media_path"]
+    response = TestClient(offload_app).get(f"/{media_path}")
+    assert response.status_code == 200
+    assert response.headers["x-accel-redirect"] == f"/protected/media_user/{os.path.basename(media_path)}"
+    assert response.content == b""
+
+
 @pytest.mark.parametrize("media_id", [2, 4, 6])
 def test_delete_media_user_ok(media_id):
     response = client.delete(f"/api/v1/media_user/{media_id}")
@@ -143,6 +502,25 @@ def test_delete_user_by_id_ok(user_id):
     assert response.status_code == 200
 
 
+def test_media_blobs_collected():
+    # the deletions only stored tombstones, the files are removed by the deletion worker
+    assert os.path.exists(f"static/media_user/{file_sha256('tests/test_static/img_1.png')}.png")
+    assert run_deletion_worker() == 6
+    for img_path in ("tests/test_static/img_1.png", "tests/test_static/img_2.png"):
+        for suffix in (".png", ".thumbnail.png", ".medium.png"):
+            assert not os.path.exists(f"static/media_user/{file_sha256(img_path)}{suffix}")
+
+
+def test_orphan_files_collected(tmp_path):
+    orphan, recent = tmp_path / "orphan.png", tmp_path / "recent.png"
+    for path in (orphan, recent):
+        path.write_bytes(b"orphan")
+    os.utime(orphan, (time.time() - 7200, time.time() - 7200))
+    assert run_deletion_worker(DeletionWorker(directory=str(tmp_path), gc_grace=3600), gc=True) == 1
+    assert not orphan.exists()
+    assert recent.exists()
+
+
 def test_get_users_2():
     response = client.get(f"/api/v1/users/")
     assert response.status_code == 200
@@ -154,3 +532,246 @@ def test_get_media_user_2(user_id):
     response = client.get(f"/api/v1/media_user/{user_id}")
     assert response.status_code == 200
     assert response.json() == []
+
+
+def test_import_users_ndjson():
+    body = "\n".join([
+        '{"login": "bulk1", "email": "bulk1@mail.ru", "full_name": "Bulk1 U", "password": "password1"}',
+        '{"login": "bulk2", "email": "bulk1@mail.ru", "full_name": "Bulk2 U", "password": "password2"}',
+        '{"login": "bulk3", "email": "not an email", "full_name": "Bulk3 U", "password": "password3"}',
+        'not json',
+        '',
+        '{"login": "bulk4", "email": "bulk4@mail.ru", "full_name": "Bulk4 U", "password": "password4"}',
+    ])
+    response = client.post(f"/api/v1/users/import", params={"batch_size": 2}, data=body,
+                           headers={"Content-Type": "application/x-ndjson"})
+    assert response.status_code == 200
+    report = response.json()
+    assert (report["created"], report["failed"]) == (2, 3)
+    assert [result["row"] for result in report["results"]] == [1, 2, 3, 4, 5]
+    assert "id" in report["results"][0] and "id" in report["results"][4]
+    assert report["results"][1]["error"] == "Email must be unique"
+    assert report["results"][2]["error"].startswith("email")
+    assert report["results"][3]["error"].startswith("Invalid JSON")
+    response = client.post(f"/api/v1/security/token", data={"username": "bulk4@mail.ru", "password": "password4"})
+    assert response.status_code == 200
+    for batch_size in [0, 10 ** 7]:  # the import buffers and commits one batch at a time
+        response = client.post(f"/api/v1/users/import", params={"batch_size": batch_size}, data=body,
+                               headers={"Content-Type": "application/x-ndjson"})
+        assert response.status_code == 422
+
+
+def test_import_users_csv():
+    body = 'login,email,full_name,password\nbulk5,bulk5@mail.ru,"Bulk5, U",password5\nbulk1,bulk6@mail.ru,Bulk6 U,p\n'
+    response = client.post(f"/api/v1/users/import", data=body, headers={"Content-Type": "text/csv"})
+    report = response.json()
+    assert (report["created"], report["failed"]) == (1, 1)
+    assert client.get(f"/api/v1/users/bulk5@mail.ru").json()["full_name"] == "Bulk5, U"
+    assert report["results"][1]["error"] == "Login must be unique"
+    response = client.post(f"/api/v1/users/import", data=body, headers={"Content-Type": "text/plain"})
+    assert response.status_code == 415
+
+
+def test_import_users_taken_concurrently():
+    # rows taken by another request after the checks of import_users: only the conflicting ones are left out
+    def row(login, email):
+        return {"login": login, "email": email, "full_name": "Race U", "hash_pass": "x"}
+
+    async def insert(rows):
+        async for session in override_get_async_session():
+            ids = await session.run_sync(crud.insert_users, rows)
+            return ids, [await async_crud.get_user_by_email(session, row["email"]) for row in rows]
+    ids, users = asyncio.run(insert([row("race1", "race1@mail.ru"), row("bulk1", "race2@mail.ru"),
+                                     row("race3", "bulk4@mail.ru"), row("race4", "race4@mail.ru"),
+                                     row("race5", "race4@mail.ru")]))
+    assert sorted(ids) == ["race1@mail.ru", "race4@mail.ru"]
+    assert [user and user.login for user in users] == ["race1", None, "bulk4", "race4", "race4"]
+
+
+def test_search_users():
+    def search(q, **params):
+        response = client.get(f"/api/v1/users/search", params={"q": q, **params})
+        assert response.status_code == 200
+        return [user["login"] for user in response.json()]
+
+    assert search("bulk") == ["bulk1", "bulk4", "bulk5"]
+    assert search("BUL", limit=2, offset=1) == ["bulk4", "bulk5"]
+    assert search("bulk5@mail.ru") == search("bulk5 u") == ["bulk5"]
+    assert search("user1") == []  # deleted users leave the index
+    assert search("ulk4") == [] and search("ulk4", fuzzy=True) == ["bulk4"]
+    assert search("ul mail", fuzzy=True) == []
+    response = client.put(f"/api/v1/users/", json={"login": "bulk4", "email": "bulk4@mail.ru",
+                                                   "full_name": "Renée Roe", "password": "password4",
+                                                   "old_password": "password4"})
+    assert response.status_code == 200
+    assert search("renee") == search("roe") == ["bulk4"]
+    assert search("bulk4 u") == []
+    assert "media" not in client.get(f"/api/v1/users/search", params={"q": "bulk"}).json()[0]
+    assert client.get(f"/api/v1/users/search", params={"q": "bulk", "limit": 1000}).status_code == 422
+
+
+def test_read_sessions_read_only():
+    async def write():
+        async for session in override_get_async_read_session():
+            await session.execute(text("DELETE FROM users"))
+    with pytest.raises(OperationalError, match="readonly"):
+        asyncio.run(write())
+    # a write committed on the primary is visible to the next read
+    user_id = client.post("/api/v1/users/", json={"login": "pinned", "email": "pinned@mail.ru",
+                                                  "full_name": "Pinned P", "password": "secret"}).json()["id"]
+    assert client.get(f"/api/v1/users/{user_id}").json()["login"] == "pinned"
+    assert client.delete(f"/api/v1/users/{user_id}").status_code == 200
+
+
+def test_read_urls():
+    assert EngineSettings(url="sqlite:////var/app.db").get_read_url() == "sqlite:///file:/var/app.db?mode=ro&uri=true"
+    assert EngineSettings(url="sqlite:////var/app.db", read_url="primary").get_read_url() is None
+    assert EngineSettings(url="sqlite://").get_read_url() is None
+    assert EngineSettings(url="postgresql://app@db/app").get_read_url() is None
+    replica = EngineSettings(url="postgresql://app@db/app", read_url="postgresql://app@replica/app",
+                             read_pool_size=40)
+    assert (replica.for_reads().get_async_url(), replica.for_reads().pool_size) == \
+        ("postgresql+asyncpg://app@replica/app", 40)
+
+
+def test_metrics_endpoint():
+    response = client.get(f"/api/v1/users/1", headers={"X-Request-ID": "req-42"})
+    assert response.headers["x-request-id"] == "req-42"
+    assert len(client.get(f"/api/v1/users/").headers["x-request-id"]) == 32
+    response = client.get(f"/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain; version=0.0.4")
+    lines = response.text.splitlines()
+    assert any(line.startswith('http_requests_total{method="GET",route="/api/v1/users/{user_id_or_email}",status="200"}')
+               for line in lines)
+    assert any(line.startswith('db_queries_per_request_count{route="/api/v1/users/"}') for line in lines)
+    assert next(float(line.split()[1]) for line in lines if line.startswith("db_queries_total ")) > 0
+    assert any(line.startswith("token_cache_entries ") for line in lines)
+
+
+def test_login_throttled(monkeypatch):
+    monkeypatch.setattr(login_rate_limit, "rate", 0.01)
+    monkeypatch.setattr(login_rate_limit, "burst", 1)
+    login_rate_limit.clear()
+    try:
+        data = {"username": "user1@mail.ru", "password": "wrong"}
+        assert client.post(f"/api/v1/security/token", data=data).status_code == 401
+        response = client.post(f"/api/v1/security/token", data=data)
+        assert response.status_code == 429
+        assert int(response.headers["retry-after"]) > 1
+    finally:
+        login_rate_limit.clear()
+    assert 'admission_rejections_total{limiter="login",reason="rate_limited"}' in client.get(f"/metrics").text
+
+
+def test_resumable_upload():
+    user_id = client.post("/api/v1/users/", json={"login": "mobile", "email": "mobile@mail.ru",
+                                                  "full_name": "Mobile M", "password": "secret"}).json()["id"]
+    with open("tests/test_static/img_2.png", "rb") as file:
+        content = file.read()
+    response = client.post(f"/api/v1/media_user/{user_id}/uploads",
+                           json={"filename": "a.png", "size": len(content)})
+    assert response.status_code == 201
+    upload = response.json()
+    assert (upload["user_id"], upload["size"], upload["offset"]) == (user_id, len(content), 0)
+    url = f"/api/v1/media_user/uploads/{upload['id']}"
+
+    half = len(content) // 2
+    assert client.put(url, params={"offset": 0}, data=content[:half]).json()["offset"] == half
+    assert client.get(url).json()["offset"] == half
+    response = client.put(url, params={"offset": 0}, data=content[:half])  # a retry of a chunk already received
+    assert response.status_code == 409 and response.headers["upload-offset"] == str(half)
+    assert client.post(f"{url}/finalize").status_code == 409
+    uploads._hashers.clear()  # the rest arrives in another worker: finalize hashes the file
+    assert client.put(url, params={"offset": half}, data=content[half:]).json()["offset"] == len(content)
+    response = client.post(f"{url}/finalize")
+    assert response.status_code == 200
+    sha256 = file_sha256("tests/test_static/img_2.png")
+    assert response.json()["sha256"] == sha256 and response.json()["user"]["id"] == user_id
+    assert client.get(f"/api/v1/media_user/{user_id}").json()[0]["media_path"] == f"static/media_user/{sha256}.png"
+    assert client.get(url).status_code == 404 and client.post(f"{url}/finalize").status_code == 404
+
+    response = client.post(f"/api/v1/media_user/{user_id}/uploads", json={"filename": "a.gif", "size": 10})
+    assert response.status_code == 409
+    response = client.post(f"/api/v1/media_user/{user_id}/uploads", json={"filename": "a.png", "size": 10 ** 9})
+    assert response.status_code == 411
+    upload = client.post(f"/api/v1/media_user/{user_id}/uploads", json={"filename": "a.png", "size": 4}).json()
+    url = f"/api/v1/media_user/uploads/{upload['id']}"
+    assert client.put(url, data=b"12345").status_code == 409  # past the announced size
+    assert client.delete(url).status_code == 204
+    run_deletion_worker()
+    assert not os.path.exists(uploads.upload_path(upload["id"]))
+
+    upload = client.post(f"/api/v1/media_user/{user_id}/uploads", json={"filename": "a.png", "size": 4}).json()
+    worker = DeletionWorker(upload_ttl=-1)
+
+    async def expire():
+        async for session in override_get_async_session():
+            return await worker.expire_uploads(session)
+    assert asyncio.run(expire()) == 1
+    run_deletion_worker(worker)
+    assert not os.path.exists(uploads.upload_path(upload["id"]))
+    assert client.get(f"/api/v1/media_user/uploads/{upload['id']}").status_code == 404
+    assert client.delete(f"/api/v1/users/{user_id}").status_code == 200
+
+
+def test_finalize_upload_failure_keeps_upload(monkeypatch):
+    user_id = client.post("/api/v1/users/", json={"login": "flaky", "email": "flaky@mail.ru",
+                                                  "full_name": "Flaky F", "password": "secret"}).json()["id"]
+    with open("tests/test_static/img_1.png", "rb") as file:
+        content = file.read()
+    upload = client.post(f"/api/v1/media_user/{user_id}/uploads", json={"filename": "a.png", "size": len(content)})
+    url = f"/api/v1/media_user/uploads/{upload.json()['id']}"
+    assert client.put(url, data=content).json()["offset"] == len(content)
+
+    add_uploaded_media_user = crud.add_uploaded_media_user
+
+    def failing(*args):
+        raise HTTPException(status_code=503, detail="DB unavailable")
+    monkeypatch.setattr(crud, "add_uploaded_media_user", failing)
+    assert client.post(f"{url}/finalize").status_code == 503
+    assert client.get(url).json()["offset"] == len(content)  # the upload is intact, finalize can be retried
+    monkeypatch.setattr(crud, "add_uploaded_media_user", add_uploaded_media_user)
+    response = client.post(f"{url}/finalize")
+    assert response.status_code == 200 and response.json()["sha256"] == file_sha256("tests/test_static/img_1.png")
+    assert client.get(url).status_code == 404
+    assert os.path.exists(response.json()["media_path"])
+    run_deletion_worker()
+    assert not os.path.exists(uploads.upload_path(upload.json()["id"]))
+    assert client.delete(f"/api/v1/users/{user_id}").status_code == 200
+
+
+def test_concurrent_finalizes_add_one_media(monkeypatch):
+    user_id = client.post("/api/v1/users/", json={"login": "twice", "email": "twice@mail.ru",
+                                                  "full_name": "Twice T", "password": "secret"}).json()["id"]
+    with open("tests/test_static/img_1.png", "rb") as file:
+        content = file.read()
+    upload_id = client.post(f"/api/v1/media_user/{user_id}/uploads",
+                            json={"filename": "a.png", "size": len(content)}).json()["id"]
+    client.put(f"/api/v1/media_user/uploads/{upload_id}", data=content)
+    finalize_upload = media_user_api.finalize_upload
+
+    async def finalize_twice():
+        in_turn, both_finalized = asyncio.Lock(), asyncio.Barrier(2)
+
+        async def finalize_before_insert(*args):
+            # a double submit: the file step of each request done one after the other, no insert yet
+            async with in_turn:
+                saved_file = await finalize_upload(*args)
+            await asyncio.wait_for(both_finalized.wait(), 10)
+            return saved_file
+        monkeypatch.setattr(media_user_api, "finalize_upload", finalize_before_insert)
+        session_factory = override_get_async_session_factory()
+
+        async def finalize():
+            async with session_factory() as session:
+                return await media_user_api.finalize_media_upload(upload_id, BackgroundTasks(), session,
+                                                                  session_factory)
+        return await asyncio.gather(finalize(), finalize(), return_exceptions=True)
+    results = asyncio.run(finalize_twice())
+    assert sorted(type(result).__name__ for result in results) == ["HTTPException", "MediaUser"]
+    assert next(result for result in results if isinstance(result, HTTPException)).status_code == 404
+    assert len(client.get(f"/api/v1/media_user/{user_id}").json()) == 1
+    run_deletion_worker()
+    assert not os.path.exists(uploads.upload_path(upload_id))
+    assert client.delete(f"/api/v1/users/{user_id}").status_code == 200
@@ -0,0 +1,184 @@
+import inspect
+
+import pytest
+from sqlalchemy import inspect as sa_inspect, text
+from sqlmodel import Session
+
+import db.database  # noqa: F401  (enables statement caching for the sqlmodel select classes)
+from db import crud
+from db.config import EngineSettings, build_engine
+from db.migrations import upgrade, get_schema_version, LATEST_VERSION
+from db.utils.query_counter import QueryCounter
+from db.utils.query_plan import QueryPlanChecker
+from models.models import UserCreate, MediaUserCreate, UserUpdate
+
+# Full scans that are the point of the query, with the reason. Any other full scan of a large table fails.
+ALLOWED_SCANS = {
+    "get_user_all[offset]": {"users"},  # offset pagination walks the skipped rows, the cursor mode does not
+    "get_user_rows[offset]": {"users"},
+    "select_users_export": {"users"},  # exports read every row
+    "select_medias_export[all]": {"media_users"},
+    "get_users_version[offset]": {"users"},
+    "get_stored_media_paths": {"media_blobs", "media_users"},  # the media GC reconciles every stored path
+    "get_file_tombstones": {"file_tombstones"},  # oldest first in rowid order, stops after `limit` rows
+}
+# crud functions that run no query of their own, or only through the functions checked
+NOT_CHECKED = {"has_required_user_fields", "add_file_tombstones", "add_user", "update_user", "acquire_media_blob",
+               "release_media", "_add_media_user", "_insert_media_user", "_match_expression",
+               "_insert_user_rows", "_latest", "_users_version", "invalidate_cached_user",
+               "create_upload_session"}
+
+
+@pytest.fixture
+def engine(tmp_path):
+    engine = build_engine(EngineSettings(url=f"sqlite:///{tmp_path / 'plans.db'}", echo=False))
+    yield engine
+    engine.dispose()
+
+
+def seed(session: Session, users: int = 3):
+    for i in range(1, users + 1):
+        crud.create_user(session, UserCreate(login=f"user{i}", email=f"user{i}@mail.ru", full_name=f"User{i} U",
+                                             password="x"), "x")
+        for j in range(2):
+            crud.add_media_user(session, MediaUserCreate(user_id=i, media_path=f"static/media_user/{i}_{j}.png",
+                                                         sha256=f"{i}{j}".ljust(64, "0")), 10)
+
+
+def crud_calls(session: Session) -> dict:
+    """One call per query of crud.py, variants as name[variant]"""
+    new_user = UserCreate(login="new", email="new@mail.ru", full_name="New U", password="x")
+    return {
+        "get_user_by_id": lambda: crud.get_user_by_id(session, 1),
+        "get_user_by_login": lambda: crud.get_user_by_login(session, "user1"),
+        "get_user_by_email": lambda: crud.get_user_by_email(session, "user1@mail.ru"),
+        "search_users[prefix]": lambda: crud.search_users(session, "use mail"),
+        "search_users[fuzzy]": lambda: crud.search_users(session, "ser1 u", fuzzy=True),
+        "get_user_all[offset]": lambda: crud.get_user_all(session, 2, 1),
+        "get_user_all[cursor]": lambda: crud.get_user_all(session, 2, after_id=1),
+        "get_user_all[no media]": lambda: crud.get_user_all(session, 2, after_id=1, with_media=False),
+        "get_user_rows[offset]": lambda: crud.get_user_rows(session, 2, 1),
+        "get_user_rows[cursor]": lambda: crud.get_user_rows(session, 2, after_id=1),
+        "get_user_rows[no media]": lambda: crud.get_user_rows(session, 2, after_id=1, with_media=False),
+        "get_user_version[id]": lambda: crud.get_user_version(session, 1),
+        "get_user_version[email]": lambda: crud.get_user_version(session, email="user1@mail.ru"),
+        "get_users_version[offset]": lambda: crud.get_users_version(session, 2, 1),
+        "get_users_version[cursor]": lambda: crud.get_users_version(session, 2, after_id=1),
+        "get_users_version[no media]": lambda: crud.get_users_version(session, 2, after_id=1, with_media=False),
+        "get_medias_version[offset]": lambda: crud.get_medias_version(session, 1, 10),
+        "get_medias_version[cursor]": lambda: crud.get_medias_version(session, 1, 10, after_id=1),
+        "check_user_create": lambda: crud.check_user_create(session, new_user),
+        "find_taken_users": lambda: crud.find_taken_users(session, ["user1@mail.ru"], ["user2"]),
+        "insert_users": lambda: crud.insert_users(session, [{"login": "bulk", "email": "bulk@mail.ru",
+                                                             "full_name": "Bulk U", "hash_pass": "x"}]),
+        "create_user": lambda: crud.create_user(session, new_user, "x"),
+        "apply_user_update": lambda: crud.apply_user_update(
+            session, crud.get_user_by_id(session, 2),
+            UserUpdate(login="user2", email="user2@mail.ru", full_name="User2 V", password="y", old_password="x"), "y"),
+        "apply_verified_user_update": lambda: crud.apply_verified_user_update(
+            session, 2, crud.get_user_by_id(session, 2).hash_pass,
+            UserUpdate(login="user2", email="user2@mail.ru", full_name="User2 W", password="y", old_password="y"), "y"),
+        "set_user_hash_pass": lambda: crud.set_user_hash_pass(session, crud.get_user_by_id(session, 2), "z"),
+        "get_media_user_by_media_id": lambda: crud.get_media_user_by_media_id(session, 1),
+        "get_medias_user_by_user_id[offset]": lambda: crud.get_medias_user_by_user_id(session, 1, 10),
+        "get_medias_user_by_user_id[cursor]": lambda: crud.get_medias_user_by_user_id(session, 1, 10, after_id=1),
+        "get_media_rows_by_user_id[offset]": lambda: crud.get_media_rows_by_user_id(session, 1, 10),
+        "get_media_rows_by_user_id[cursor]": lambda: crud.get_media_rows_by_user_id(session, 1, 10, after_id=1),
+        "select_users_export": lambda: session.exec(crud.select_users_export()).all(),
+        "select_medias_export[all]": lambda: session.exec(crud.select_medias_export()).all(),
+        "select_medias_export[user]": lambda: session.exec(crud.select_medias_export(1)).all(),
+        "get_media_blob": lambda: crud.get_media_blob(session, "10".ljust(64, "0")),
+        "add_media_user": lambda: crud.add_media_user(
+            session, MediaUserCreate(user_id=1, media_path="static/media_user/other.png", sha256="10".ljust(64, "0")), 10),
+        "add_uploaded_media_user": lambda: crud.add_uploaded_media_user(
+            session, MediaUserCreate(user_id=1, media_path="static/media_user/up.png", sha256="11".ljust(64, "0")), 10,
+            crud.create_upload_session(session, 1, ".png", 10).id, "uploads/up.part"),
+        "set_media_derivatives": lambda: crud.set_media_derivatives(session, "static/media_user/1_0.png", ["thumbnail"]),
+        "delete_media_user": lambda: crud.delete_media_user(session, 3),
+        "get_referenced_paths": lambda: crud.get_referenced_paths(session, ["static/media_user/1_0.png"]),
+        "get_stored_media_paths": lambda: crud.get_stored_media_paths(session),
+        "get_file_tombstones": lambda: crud.get_file_tombstones(session, 10),
+        "delete_file_tombstones": lambda: crud.delete_file_tombstones(session, [1, 2]),
+        "get_upload_session": lambda: crud.get_upload_session(session, "0" * 32),
+        "get_upload_sessions_created_before": lambda: crud.get_upload_sessions_created_before(session, "2022-01-01"),
+        "delete_upload_sessions": lambda: crud.delete_upload_sessions(session, ["0" * 32]),
+        "delete_user_by_id": lambda: crud.delete_user_by_id(session, 3),
+    }
+
+
+def test_upgrade_fresh_db_and_fast_path(engine):
+    assert upgrade(engine) == LATEST_VERSION
+    indexes = {index["name"] for index in sa_inspect(engine).get_indexes("media_users")}
+    assert {"ix_media_users_user_id", "ix_media_users_media_path", "ix_media_users_sha256"} <= indexes
+    assert "ix_users_created_at" in {index["name"] for index in sa_inspect(engine).get_indexes("users")}
+    with QueryCounter(engine) as counter:
+        assert upgrade(engine) == LATEST_VERSION
+    assert counter.count <= 2, counter.statements
+
+
+def test_upgrade_db_created_before_migrations(engine):
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE users (login VARCHAR UNIQUE, email VARCHAR UNIQUE, full_name VARCHAR NOT NULL, "
+                          "id INTEGER PRIMARY KEY, hash_pass VARCHAR NOT NULL, privileges VARCHAR NOT NULL, "
+                          "is_active BOOLEAN NOT NULL, created_at VARCHAR NOT NULL, updated_at VARCHAR)"))
+        conn.execute(text("CREATE TABLE media_users (media_path VARCHAR NOT NULL, id INTEGER PRIMARY KEY, "
+                          "user_id INTEGER REFERENCES users (id), created_at VARCHAR NOT NULL)"))
+        conn.execute(text("INSERT INTO users VALUES ('user1', 'user1@mail.ru', 'User1 U', 1, 'x', 'User', 1, "
+                          "'2022-01-01', NULL)"))
+        conn.execute(text("INSERT INTO media_users VALUES ('static/media_user/a.png', 1, 1, '2022-01-01')"))
+    assert upgrade(engine) == LATEST_VERSION
+    assert {"sha256", "derivatives"} <= {column["name"] for column in sa_inspect(engine).get_columns("media_users")}
+    assert {"media_blobs", "file_tombstones", "upload_sessions"} <= set(sa_inspect(engine).get_table_names())
+    with Session(engine) as session:
+        assert crud.get_user_by_id(session, 1).media[0].media_path == "static/media_user/a.png"
+
+
+def test_crud_queries_use_indexes(engine):
+    upgrade(engine)
+    with Session(engine) as session:
+        seed(session)
+        calls = crud_calls(session)
+        checked = {name.split("[")[0] for name in calls}
+        functions = {name for name, function in inspect.getmembers(crud, inspect.isfunction)
+                     if function.__module__ == crud.__name__}
+        assert functions - NOT_CHECKED <= checked, functions - NOT_CHECKED - checked
+        for name, call in calls.items():
+            with QueryPlanChecker(engine) as checker:
+                call()
+            assert checker.statements, name
+            assert checker.scanned_tables() <= ALLOWED_SCANS.get(name, set()), (name, checker.full_scans)
+
+
+def test_query_plan_checker_sees_missing_index(engine):
+    upgrade(engine, target=2)
+    with engine.begin() as conn:
+        conn.execute(text("DROP INDEX ix_media_users_user_id"))
+    with engine.connect() as conn:
+        assert get_schema_version(conn) == 2
+    with Session(engine) as session, QueryPlanChecker(engine) as checker:
+        crud.get_medias_user_by_user_id(session, 1)
+    assert checker.scanned_tables() == {"media_users"}
+    upgrade(engine)
+    with Session(engine) as session, QueryPlanChecker(engine) as checker:
+        crud.get_medias_user_by_user_id(session, 1)
+    assert not checker.full_scans
+
+
+def test_versions_see_deletions_and_derivatives(engine):
+    upgrade(engine)
+    with Session(engine) as session:
+        seed(session)
+        versions = {"user": lambda: crud.get_user_version(session, 1), "users": lambda: crud.get_users_version(session),
+                    "medias": lambda: crud.get_medias_version(session, 1)}
+        before = {name: version() for name, version in versions.items()}
+        media = crud.add_media_user(session, MediaUserCreate(user_id=1, media_path="static/media_user/new.png",
+                                                             sha256="10".ljust(64, "0")), 10)
+        crud.delete_media_user(session, media.id)  # same rows as before, not the same version
+        after_delete = {name: version() for name, version in versions.items()}
+        assert all(after_delete[name] != before[name] for name in versions)
+        crud.set_media_derivatives(session, "static/media_user/1_0.png", ["thumbnail"])
+        assert all(versions[name]() != after_delete[name] for name in versions)
+        users = crud.get_users_version(session)
+        crud.delete_user_by_id(session, 3)
+        assert crud.get_users_version(session) != users
+        assert crud.get_user_version(session, 3).changed_at is None
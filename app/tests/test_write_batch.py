@@ -0,0 +1,121 @@
+import asyncio
+
+from fastapi.exceptions import HTTPException
+from sqlalchemy.exc import IntegrityError
+
+import db.async_crud as async_crud
+from db.utils.write_batch import WriteBatcher, write_batcher
+from models.models import UserCreate, UserUpdate, MediaUserCreate
+from tests.test_db import override_get_async_session, async_engine
+
+
+def run_batched(*writes):
+    """Runs the writes concurrently, each in its own session, with the batcher started"""
+    async def write(function, *args):
+        async for session in override_get_async_session():
+            return await function(session, *args)
+
+    async def run():
+        write_batcher.start(async_engine)
+        try:
+            return await asyncio.gather(*(write(*args) for args in writes), return_exceptions=True)
+        finally:
+            await write_batcher.stop()
+    return asyncio.run(run())
+
+
+def user_create(name: str) -> UserCreate:
+    return UserCreate(login=f"batch_{name}", email=f"batch_{name}@mail.ru", full_name=f"Batch {name}",
+                      password="secret")
+
+
+def test_batch_results_and_errors_per_operation():
+    first, duplicate, second = run_batched(
+        (async_crud.add_user, user_create("first")),
+        (async_crud.add_user, user_create("first")),
+        (async_crud.add_user, user_create("second")))
+    # the duplicate passed the checks with the first one still queued: the unique index rejects it alone.
+    # Which of the two is queued first depends on the order their password hashes complete.
+    if isinstance(first, IntegrityError):
+        first, duplicate = duplicate, first
+    assert first.login == "batch_first" and first.id and first.media == []
+    assert isinstance(duplicate, IntegrityError)
+    assert second.login == "batch_second" and second.id != first.id
+
+    updated, media, missing = run_batched(
+        (async_crud.update_user, UserUpdate(login="batch_first", email="batch_first@mail.ru", full_name="Batch First",
+                                            password="secret2", old_password="secret")),
+        (async_crud.add_media_user, MediaUserCreate(user_id=second.id, media_path="static/media_user/batch.png")),
+        (async_crud.add_media_user, MediaUserCreate(user_id=-1, media_path="static/media_user/batch.png")))
+    assert updated.id == first.id and updated.full_name == "Batch First" and updated.updated_at
+    assert media.user.id == second.id and media.media_path == "static/media_user/batch.png"
+    assert isinstance(missing, HTTPException) and missing.status_code == 401
+
+    async def load():
+        async for session in override_get_async_session():
+            return await async_crud.get_user_by_id(session, second.id)
+    assert [media.id for media in asyncio.run(load()).media] == [media.id]
+
+    deleted, = run_batched((async_crud.delete_user_by_id, second.id))
+    assert deleted.status_code == 200
+    assert asyncio.run(load()) is None
+
+
+def test_batch_size_bounded():
+    batcher = WriteBatcher(max_ops=2, delay_ms=0)
+    sizes = []
+
+    def apply(conn, batch):
+        sizes.append(len(batch))
+        for operation in batch:
+            operation.result = operation.args[0]
+    batcher._apply = apply
+
+    async def run():
+        batcher.start(async_engine)
+        try:
+            return await asyncio.gather(*(batcher.run(None, None, i) for i in range(5)))
+        finally:
+            await batcher.stop()
+    assert asyncio.run(run()) == [0, 1, 2, 3, 4]
+    assert sum(sizes) == 5 and max(sizes) == 2
+
+
+def test_stop_applies_queued_and_fails_cancelled_batch():
+    def apply(conn, batch):
+        for operation in batch:
+            operation.result = operation.args[0]
+
+    async def queue(batcher, count):
+        runs = [asyncio.ensure_future(batcher.run(None, None, i)) for i in range(count)]
+        await asyncio.sleep(0.01)  # queued, the writer waits for the batch delay
+        return runs
+
+    async def stop_gracefully():
+        batcher = WriteBatcher(max_ops=2, delay_ms=50)
+        batcher._apply = apply
+        batcher.start(async_engine)
+        runs = await queue(batcher, 5)
+        await batcher.stop()
+        return await asyncio.wait_for(asyncio.gather(*runs), 1)
+    assert asyncio.run(stop_gracefully()) == [0, 1, 2, 3, 4]
+
+    async def cancel_writer():
+        batcher = WriteBatcher(max_ops=10, delay_ms=10_000)
+        batcher._apply = apply
+        batcher.start(async_engine)
+        runs = await queue(batcher, 3)
+        batcher._task.cancel()  # e.g. the loop shutting down in the middle of a batch
+        await batcher.stop()
+        return await asyncio.wait_for(asyncio.gather(*runs, return_exceptions=True), 1)
+    assert all(isinstance(result, RuntimeError) for result in asyncio.run(cancel_writer()))
+
+
+def test_not_started_runs_in_request_session():
+    assert not write_batcher.running
+
+    async def run():
+        async for session in override_get_async_session():
+            return session.sync_session, await write_batcher.run(session, lambda sync_session: sync_session)
+    request_session, used_session = asyncio.run(run())
+    assert used_session is request_session